@@ -9,9 +9,18 @@ Copyright (c) 2012 Moonbot Studios. All rights reserved.
 Set of tools to assist in script debugging.
 """
 
+import os
+
 import gprof2dot
 from profile import *
 
+if os.environ.get('DEBUG_CONTINUOUS_PROFILE'):
+	# Sample the whole process in the background, see profile.ContinuousProfiler
+	startContinuousProfiler(
+		outputDir=os.environ.get('DEBUG_CONTINUOUS_PROFILE_DIR'),
+		rate=float(os.environ.get('DEBUG_CONTINUOUS_PROFILE_RATE', 100.0)),
+	)
+
 def reloadAll():
 	import profile
 	reload(profile)
@@ -25,10 +25,22 @@ __version__ = "1.0"
 import sys
 import math
 import os.path
+import bisect
+import gc
+import hashlib
+import heapq
+import itertools
+import marshal
 import re
+import struct
 import textwrap
 import optparse
-import xml.parsers.expat
+from array import array
+
+try:
+    import xml.etree.cElementTree as ElementTree
+except ImportError:
+    import xml.etree.ElementTree as ElementTree
 
 
 try:
@@ -44,6 +56,23 @@ def times(x):
 def percentage(p):
     return "%.02f%%" % (p*100.0,)
 
+def samples(x):
+    if x == int(x):
+        return str(int(x))
+    return repr(x)
+
+def signed_percentage(p):
+    return "%+.02f%%" % (p*100.0,)
+
+def size(n):
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if abs(n) < 1024.0 or unit == 'GiB':
+            break
+        n /= 1024.0
+    if unit == 'B':
+        return "%d %s" % (n, unit)
+    return "%.1f %s" % (n, unit)
+
 def add(a, b):
     return a + b
 
@@ -126,6 +155,14 @@ TIME_RATIO = Event("Time ratio", 0.0, add, lambda x: '(' + percentage(x) + ')')
 TOTAL_TIME = Event("Total time", 0.0, fail)
 TOTAL_TIME_RATIO = Event("Total time ratio", 0.0, fail, percentage)
 
+BYTES = Event("Bytes", 0, add, lambda x: '(' + size(x) + ')')
+TOTAL_BYTES = Event("Total bytes", 0, fail, size)
+ALLOCS = Event("Allocations", 0, add, lambda x: "%u blocks" % (x,))
+
+# Changes between two profiles, see diff_profiles
+DELTA_TIME_RATIO = Event("Time ratio delta", 0.0, add, lambda x: '(' + signed_percentage(x) + ')')
+DELTA_TOTAL_TIME_RATIO = Event("Total time ratio delta", 0.0, fail, signed_percentage)
+
 
 class Object(object):
     """Base class for all objects in profile which can store events."""
@@ -251,6 +288,14 @@ class Cycle(Object):
         function.cycle = self
 
 
+def _total_time_ratio(object):
+    """Total time ratio of a function or call, None when unknown."""
+    try:
+        return object[TOTAL_TIME_RATIO]
+    except UndefinedEvent:
+        return None
+
+
 class Profile(Object):
     """The whole profile."""
 
@@ -258,6 +303,8 @@ class Profile(Object):
         Object.__init__(self)
         self.functions = {}
         self.cycles = []
+        # Sampled stacks of function ids, outermost caller first, see add_stack
+        self.stacks = None
 
     def add_function(self, function):
         if function.id in self.functions:
@@ -267,6 +314,72 @@ class Profile(Object):
     def add_cycle(self, cycle):
         self.cycles.append(cycle)
 
+    def add_stack(self, stack, value=1):
+        """Count the samples of a full call stack, given as a tuple of function
+        ids from the outermost caller, so flame graphs can be exact."""
+
+        if self.stacks is None:
+            self.stacks = {}
+        try:
+            self.stacks[stack] += value
+        except KeyError:
+            self.stacks[stack] = value
+
+    def estimate_stacks(self, total=1000000, threshold=0.0001):
+        """Estimate full call stacks from the call ratios, for profiles without
+        sampled stacks.
+
+        Every function splits its share of the total between the functions it
+        calls, proportionally to the call total time ratios, and keeps the rest
+        for itself. Functions already on the stack are not entered again, and
+        stacks below threshold are not expanded further.
+
+        Returns a dict of stacks of function ids, outermost caller first, to
+        their share of total.
+        """
+
+        def component(function):
+            if function.cycle is not None:
+                return function.cycle
+            return function.id
+
+        called = set()
+        for function in self.functions.itervalues():
+            caller = component(function)
+            for callee_id in function.calls.iterkeys():
+                callee = component(self.functions[callee_id])
+                if callee != caller:
+                    called.add(callee)
+
+        stacks = {}
+        work = []
+        for function in self.functions.itervalues():
+            if component(function) not in called and TOTAL_TIME_RATIO in function:
+                work.append(((function.id,), function, function[TOTAL_TIME_RATIO]))
+
+        # Roots can share callees, so their ratios may add up to more than 1
+        roots_total = sum([weight for stack, function, weight in work])
+        if roots_total > 1.0:
+            work = [(stack, function, weight/roots_total) for stack, function, weight in work]
+
+        while work:
+            stack, function, weight = work.pop()
+            function_total = function[TOTAL_TIME_RATIO]
+            rest = weight
+            if function_total > 0:
+                for call in function.calls.itervalues():
+                    if TOTAL_TIME_RATIO not in call or call.callee_id in stack:
+                        continue
+                    call_weight = min(weight*call[TOTAL_TIME_RATIO]/function_total, rest)
+                    if call_weight < threshold:
+                        continue
+                    rest -= call_weight
+                    work.append((stack + (call.callee_id,), self.functions[call.callee_id], call_weight))
+            value = int(rest*total + 0.5)
+            if value > 0:
+                stacks[stack] = value
+        return stacks
+
     def validate(self):
         """Validate the edges."""
 
@@ -281,13 +394,19 @@ class Profile(Object):
         """Find cycles using Tarjan's strongly connected components algorithm."""
 
         # Apply the Tarjan's algorithm successively until all functions are visited
-        visited = set()
+        order = 0
+        stack = []
+        orders = {}
+        lowlinks = {}
+        on_stack = set()
         for function in self.functions.itervalues():
-            if function not in visited:
-                self._tarjan(function, 0, [], {}, {}, visited)
+            if function not in orders:
+                order = self._tarjan(function, order, stack, orders, lowlinks, on_stack)
         cycles = []
+        seen = set()
         for function in self.functions.itervalues():
-            if function.cycle is not None and function.cycle not in cycles:
+            if function.cycle is not None and function.cycle not in seen:
+                seen.add(function.cycle)
                 cycles.append(function.cycle)
         self.cycles = cycles
         if 0:
@@ -296,35 +415,54 @@ class Profile(Object):
                 for member in cycle.functions:
                     sys.stderr.write("\tFunction %s\n" % member.name)
     
-    def _tarjan(self, function, order, stack, orders, lowlinks, visited):
+    def _tarjan(self, function, order, stack, orders, lowlinks, on_stack):
         """Tarjan's strongly connected components algorithm.
 
+        The depth first search keeps its own stack of call iterators instead
+        of recursing, so that deep call chains do not hit the recursion limit.
+
         See also:
         - http://en.wikipedia.org/wiki/Tarjan's_strongly_connected_components_algorithm
         """
 
-        visited.add(function)
         orders[function] = order
         lowlinks[function] = order
         order += 1
-        pos = len(stack)
         stack.append(function)
-        for call in function.calls.itervalues():
-            callee = self.functions[call.callee_id]
-            # TODO: use a set to optimize lookup
-            if callee not in orders:
-                order = self._tarjan(callee, order, stack, orders, lowlinks, visited)
-                lowlinks[function] = min(lowlinks[function], lowlinks[callee])
-            elif callee in stack:
-                lowlinks[function] = min(lowlinks[function], orders[callee])
-        if lowlinks[function] == orders[function]:
-            # Strongly connected component found
-            members = stack[pos:]
-            del stack[pos:]
-            if len(members) > 1:
-                cycle = Cycle()
-                for member in members:
-                    cycle.add_function(member)
+        on_stack.add(function)
+        work = [(function, function.calls.itervalues())]
+        while work:
+            caller, calls = work[-1]
+            for call in calls:
+                callee = self.functions[call.callee_id]
+                if callee not in orders:
+                    orders[callee] = order
+                    lowlinks[callee] = order
+                    order += 1
+                    stack.append(callee)
+                    on_stack.add(callee)
+                    work.append((callee, callee.calls.itervalues()))
+                    break
+                elif callee in on_stack:
+                    lowlinks[caller] = min(lowlinks[caller], orders[callee])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    lowlinks[parent] = min(lowlinks[parent], lowlinks[caller])
+                if lowlinks[caller] == orders[caller]:
+                    # Strongly connected component found
+                    members = []
+                    while True:
+                        member = stack.pop()
+                        on_stack.remove(member)
+                        members.append(member)
+                        if member is caller:
+                            break
+                    if len(members) > 1:
+                        cycle = Cycle()
+                        for member in members:
+                            cycle.add_function(member)
         return order
 
     def call_ratios(self, event):
@@ -374,41 +512,84 @@ class Profile(Object):
                 if call.callee_id != function.id:
                     assert call.ratio is not None
 
-        # Aggregate the input for each cycle 
+        # Aggregate the input for each cycle, and index the calls entering
+        # each cycle from outside of it
+        cycle_callers = {}
         for cycle in self.cycles:
-            total = inevent.null()
-            for function in self.functions.itervalues():
-                total = inevent.aggregate(total, function[inevent])
-            self[inevent] = total
+            cycle[inevent] = inevent.null()
+            cycle_callers[cycle] = []
+        for function in self.functions.itervalues():
+            if function.cycle is not None:
+                function.cycle[inevent] = inevent.aggregate(function.cycle[inevent], function[inevent])
+            for call in function.calls.itervalues():
+                callee = self.functions[call.callee_id]
+                if callee.cycle is not None and callee.cycle is not function.cycle:
+                    cycle_callers[callee.cycle].append((callee, call))
 
         # Integrate along the edges
         total = inevent.null()
         for function in self.functions.itervalues():
             total = inevent.aggregate(total, function[inevent])
-            self._integrate_function(function, outevent, inevent)
+            self._integrate_function(function, outevent, inevent, cycle_callers)
         self[outevent] = total
 
-    def _integrate_function(self, function, outevent, inevent):
-        if function.cycle is not None:
-            return self._integrate_cycle(function.cycle, outevent, inevent)
-        else:
-            if outevent not in function:
-                total = function[inevent]
-                for call in function.calls.itervalues():
-                    if call.callee_id != function.id:
+    def _integrate_function(self, function, outevent, inevent, cycle_callers):
+        """Integrate a function after everything it calls.
+
+        Functions and cycles are integrated in depth first post-order from an
+        explicit stack, so that deep call chains do not hit the recursion limit.
+        """
+
+        node = function.cycle or function
+        stack = [(node, False)]
+        expanding = set()
+        while stack:
+            node, expanded = stack.pop()
+            if outevent in node:
+                continue
+            if not expanded:
+                assert node not in expanding
+                expanding.add(node)
+                stack.append((node, True))
+                for dependency in self._integrate_dependencies(node):
+                    if outevent not in dependency:
+                        stack.append((dependency, False))
+                continue
+            expanding.remove(node)
+            if isinstance(node, Cycle):
+                self._integrate_cycle(node, outevent, inevent, cycle_callers[node])
+            else:
+                total = node[inevent]
+                for call in node.calls.itervalues():
+                    if call.callee_id != node.id:
                         total += self._integrate_call(call, outevent, inevent)
-                function[outevent] = total
-            return function[outevent]
+                node[outevent] = total
+
+        return (function.cycle or function)[outevent]
+
+    def _integrate_dependencies(self, node):
+        """Functions and cycles that must be integrated before a function or cycle."""
+        if isinstance(node, Cycle):
+            members = node.functions
+        else:
+            members = (node,)
+        for member in members:
+            for call in member.calls.itervalues():
+                if call.callee_id != member.id:
+                    callee = self.functions[call.callee_id]
+                    dependency = callee.cycle or callee
+                    if dependency is not node:
+                        yield dependency
     
     def _integrate_call(self, call, outevent, inevent):
         assert outevent not in call
         assert call.ratio is not None
         callee = self.functions[call.callee_id]
-        subtotal = call.ratio *self._integrate_function(callee, outevent, inevent)
+        subtotal = call.ratio*(callee.cycle or callee)[outevent]
         call[outevent] = subtotal
         return subtotal
 
-    def _integrate_cycle(self, cycle, outevent, inevent):
+    def _integrate_cycle(self, cycle, outevent, inevent, callers):
         if outevent not in cycle:
 
             # Compute the outevent for the whole cycle
@@ -424,15 +605,11 @@ class Profile(Object):
             
             # Compute the time propagated to callers of this cycle
             callees = {}
-            for function in self.functions.itervalues():
-                if function.cycle is not cycle:
-                    for call in function.calls.itervalues():
-                        callee = self.functions[call.callee_id]
-                        if callee.cycle is cycle:
-                            try:
-                                callees[callee] += call.ratio
-                            except KeyError:
-                                callees[callee] = call.ratio
+            for callee, call in callers:
+                try:
+                    callees[callee] += call.ratio
+                except KeyError:
+                    callees[callee] = call.ratio
             
             for member in cycle.functions:
                 member[outevent] = outevent.null()
@@ -450,16 +627,24 @@ class Profile(Object):
         return cycle[outevent]
 
     def _rank_cycle_function(self, cycle, function, rank, ranks):
-        if function not in ranks or ranks[function] > rank:
-            ranks[function] = rank
+        """Rank the cycle members by their distance from function, breadth first."""
+        ranks[function] = rank
+        queue = [function]
+        for function in queue:
+            rank = ranks[function] + 1
             for call in function.calls.itervalues():
                 if call.callee_id != function.id:
                     callee = self.functions[call.callee_id]
-                    if callee.cycle is cycle:
-                        self._rank_cycle_function(cycle, callee, rank + 1, ranks)
+                    if callee.cycle is cycle and callee not in ranks:
+                        ranks[callee] = rank
+                        queue.append(callee)
 
     def _call_ratios_cycle(self, cycle, function, ranks, call_ratios, visited):
-        if function not in visited:
+        stack = [function]
+        while stack:
+            function = stack.pop()
+            if function in visited:
+                continue
             visited.add(function)
             for call in function.calls.itervalues():
                 if call.callee_id != function.id:
@@ -467,20 +652,38 @@ class Profile(Object):
                     if callee.cycle is cycle:
                         if ranks[callee] > ranks[function]:
                             call_ratios[callee] = call_ratios.get(callee, 0.0) + call.ratio
-                            self._call_ratios_cycle(cycle, callee, ranks, call_ratios, visited)
+                            stack.append(callee)
 
     def _integrate_cycle_function(self, cycle, function, partial_ratio, partials, ranks, call_ratios, outevent, inevent):
-        if function not in partials:
-            partial = partial_ratio*function[inevent]
-            for call in function.calls.itervalues():
-                if call.callee_id != function.id:
+        # Calls deeper into the cycle always go to higher ranks, so the partials
+        # can be computed in depth first post-order from an explicit stack
+        stack = [function]
+        while stack:
+            caller = stack[-1]
+            if caller in partials:
+                stack.pop()
+                continue
+            callees = []
+            for call in caller.calls.itervalues():
+                if call.callee_id != caller.id:
+                    callee = self.functions[call.callee_id]
+                    if callee.cycle is cycle and ranks[callee] > ranks[caller] and callee not in partials:
+                        callees.append(callee)
+            if callees:
+                stack.extend(callees)
+                continue
+            stack.pop()
+
+            partial = partial_ratio*caller[inevent]
+            for call in caller.calls.itervalues():
+                if call.callee_id != caller.id:
                     callee = self.functions[call.callee_id]
                     if callee.cycle is not cycle:
                         assert outevent in call
                         partial += partial_ratio*call[outevent]
                     else:
-                        if ranks[callee] > ranks[function]:
-                            callee_partial = self._integrate_cycle_function(cycle, callee, partial_ratio, partials, ranks, call_ratios, outevent, inevent)
+                        if ranks[callee] > ranks[caller]:
+                            callee_partial = partials[callee]
                             call_ratio = ratio(call.ratio, call_ratios[callee])
                             call_partial = call_ratio*callee_partial
                             try:
@@ -488,11 +691,11 @@ class Profile(Object):
                             except UndefinedEvent:
                                 call[outevent] = call_partial
                             partial += call_partial
-            partials[function] = partial
+            partials[caller] = partial
             try:
-                function[outevent] += partial
+                caller[outevent] += partial
             except UndefinedEvent:
-                function[outevent] = partial
+                caller[outevent] = partial
         return partials[function]
 
     def aggregate(self, event):
@@ -542,6 +745,11 @@ class Profile(Object):
                     except UndefinedEvent:
                         pass
 
+        self._prune_weights(node_thres, edge_thres)
+
+    def _prune_weights(self, node_thres, edge_thres):
+        """Remove the functions and calls weighting less than the thresholds."""
+
         # prune the nodes
         for function_id in self.functions.keys():
             function = self.functions[function_id]
@@ -556,6 +764,287 @@ class Profile(Object):
                 if callee_id not in self.functions or call.weight is not None and call.weight < edge_thres:
                     del function.calls[callee_id]
     
+    def top_paths(self, count):
+        """Find the heaviest call paths from a root to a leaf.
+
+        A path weighs as much as its lightest call, using the call total time
+        ratios. Recursive functions are condensed into their cycle, so the
+        search runs on a DAG and is best-first: paths come out heaviest
+        first, and every function or cycle is expanded at most count times.
+        Paths leaving a cycle from another function than the one they
+        entered it through follow the shortest chain of calls between them.
+        Ties are broken by function ids, so the result does not depend on
+        the dict order.
+
+        Returns a list of (weight, [function id, ...]) tuples.
+        """
+
+        def component(function):
+            if function.cycle is not None:
+                return function.cycle
+            return function.id
+
+        inner_paths = {}
+        def inner_path(cycle, start_id, end_id):
+            """Shortest chain of calls inside a cycle, start excluded."""
+            try:
+                return inner_paths[start_id, end_id]
+            except KeyError:
+                pass
+            parents = {start_id: None}
+            queue = [start_id]
+            for function_id in queue:
+                if function_id == end_id:
+                    break
+                for callee_id in sorted(self.functions[function_id].calls.iterkeys()):
+                    if callee_id not in parents and self.functions[callee_id].cycle is cycle:
+                        parents[callee_id] = function_id
+                        queue.append(callee_id)
+            path = []
+            function_id = end_id
+            while function_id != start_id:
+                path.append(function_id)
+                function_id = parents[function_id]
+            path.reverse()
+            inner_paths[start_id, end_id] = path = tuple(path)
+            return path
+
+        # Calls between components, and the components called by others
+        edges = {}
+        called = set()
+        for function in self.functions.itervalues():
+            caller = component(function)
+            for call in function.calls.itervalues():
+                callee = self.functions[call.callee_id]
+                if component(callee) == caller:
+                    continue
+                if TOTAL_TIME_RATIO in call:
+                    weight = call[TOTAL_TIME_RATIO]
+                else:
+                    try:
+                        weight = min(function[TOTAL_TIME_RATIO], callee[TOTAL_TIME_RATIO])
+                    except UndefinedEvent:
+                        continue
+                edges.setdefault(caller, []).append((weight, function.id, callee.id))
+                called.add(component(callee))
+
+        heap = []
+        for function in self.functions.itervalues():
+            if component(function) not in called:
+                try:
+                    weight = function[TOTAL_TIME_RATIO]
+                except UndefinedEvent:
+                    continue
+                heap.append((-weight, (function.id,)))
+        heapq.heapify(heap)
+
+        paths = []
+        expanded = {}
+        while heap and len(paths) < count:
+            weight, path = heapq.heappop(heap)
+            node = component(self.functions[path[-1]])
+            visits = expanded.get(node, 0)
+            if visits >= count:
+                continue
+            expanded[node] = visits + 1
+            try:
+                calls = edges[node]
+            except KeyError:
+                paths.append((-weight, list(path)))
+                continue
+            for call_weight, caller_id, callee_id in calls:
+                if caller_id == path[-1]:
+                    extension = (callee_id,)
+                else:
+                    # Leaving the cycle from another of its functions
+                    extension = inner_path(node, path[-1], caller_id) + (callee_id,)
+                heapq.heappush(heap, (max(weight, -call_weight), path + extension))
+        return paths
+
+    def keep_paths(self, paths):
+        """Remove the functions and calls not on any of the given paths."""
+
+        function_ids = set()
+        call_ids = set()
+        for weight, path in paths:
+            function_ids.update(path)
+            call_ids.update(zip(path[:-1], path[1:]))
+
+        for function_id in self.functions.keys():
+            if function_id not in function_ids:
+                del self.functions[function_id]
+
+        for function in self.functions.itervalues():
+            for callee_id in function.calls.keys():
+                if (function.id, callee_id) not in call_ids:
+                    del function.calls[callee_id]
+
+    def find_functions(self, pattern):
+        """Return the ids of the functions whose name matches a regular expression."""
+
+        # Match every distinct name once
+        index = {}
+        for function in self.functions.itervalues():
+            index.setdefault(function.name, []).append(function.id)
+
+        regex = re.compile(pattern)
+        function_ids = []
+        for name, ids in index.iteritems():
+            if regex.search(name):
+                function_ids.extend(ids)
+        return function_ids
+
+    def descendants(self, function_ids):
+        """Return the ids of the given functions and of all they call."""
+
+        visited = set(function_ids)
+        stack = list(visited)
+        while stack:
+            function = self.functions[stack.pop()]
+            for callee_id in function.calls.iterkeys():
+                if callee_id not in visited:
+                    visited.add(callee_id)
+                    stack.append(callee_id)
+        return visited
+
+    def ancestors(self, function_ids):
+        """Return the ids of the given functions and of all their callers."""
+
+        callers = {}
+        for function in self.functions.itervalues():
+            for callee_id in function.calls.iterkeys():
+                callers.setdefault(callee_id, []).append(function.id)
+
+        visited = set(function_ids)
+        stack = list(visited)
+        while stack:
+            for caller_id in callers.get(stack.pop(), ()):
+                if caller_id not in visited:
+                    visited.add(caller_id)
+                    stack.append(caller_id)
+        return visited
+
+    def keep_functions(self, function_ids):
+        """Remove the functions not in the given ids, and the calls to them."""
+
+        for function_id in self.functions.keys():
+            if function_id not in function_ids:
+                del self.functions[function_id]
+
+        for function in self.functions.itervalues():
+            for callee_id in function.calls.keys():
+                if callee_id not in function_ids:
+                    del function.calls[callee_id]
+
+    def renormalize(self, root_ids):
+        """Make the time ratios relative to the time spent under the given
+        roots, keeping only the share of every function spent under them.
+
+        Must be called before removing the functions outside the roots.
+        """
+
+        scale = self._root_scale(root_ids, _total_time_ratio)
+        if scale is None:
+            return
+        for function in self.functions.itervalues():
+            factor = scale.get(function.id, 0.0)
+            for object in [function] + list(function.calls.itervalues()):
+                for event in TOTAL_TIME_RATIO, TIME_RATIO:
+                    if event in object:
+                        object[event] *= factor
+
+    def _root_scale(self, root_ids, total):
+        """Return the factors turning the ratios of every function, and of
+        its calls, into ratios of the time spent under the given roots."""
+
+        # Roots called by other roots are already counted
+        nested = self.descendants([callee_id
+            for root_id in root_ids
+            for callee_id in self.functions[root_id].calls.iterkeys()])
+        root_total = 0.0
+        for root_id in root_ids:
+            if root_id not in nested:
+                root_total += total(self.functions[root_id]) or 0.0
+        if not root_total:
+            root_total = max([total(self.functions[root_id]) or 0.0 for root_id in root_ids])
+        if not root_total:
+            return None
+
+        scale = {}
+        for function_id, share in self.root_shares(root_ids, total).iteritems():
+            scale[function_id] = share/root_total
+        return scale
+
+    def root_shares(self, root_ids, total):
+        """Return the share of the time of every function spent under the
+        given roots, by function id.
+
+        The shares flow down from the roots along the calls, in proportion
+        to the total time ratio of each call, given by total(object).
+        Recursive functions take the share of their cycle. Must be called
+        before removing the functions outside the roots.
+        """
+
+        def component(function):
+            if function.cycle is not None:
+                return function.cycle
+            return function.id
+
+        descendant_ids = self.descendants(root_ids)
+
+        # Time entering each component, and the calls between components
+        # under the roots
+        inflows = {}
+        edges = {}
+        indegrees = {}
+        for function in self.functions.itervalues():
+            caller = component(function)
+            for call in function.calls.itervalues():
+                callee = component(self.functions[call.callee_id])
+                if callee == caller:
+                    continue
+                value = total(call)
+                if value is not None:
+                    inflows[callee] = inflows.get(callee, 0.0) + value
+                if function.id in descendant_ids:
+                    edges.setdefault(caller, []).append((function.id, callee, value))
+                    indegrees[callee] = indegrees.get(callee, 0) + 1
+
+        # Visit the components in topological order from the roots
+        shares = {}
+        flows = {}
+        ready = []
+        for root_id in root_ids:
+            root = component(self.functions[root_id])
+            if root not in shares:
+                shares[root] = 1.0
+        for function_id in descendant_ids:
+            node = component(self.functions[function_id])
+            if not indegrees.get(node) and node not in flows:
+                flows[node] = 0.0
+                ready.append(node)
+        while ready:
+            node = ready.pop()
+            if node not in shares:
+                if isinstance(node, Cycle):
+                    node_total = inflows.get(node)
+                else:
+                    node_total = total(self.functions[node])
+                shares[node] = min(flows[node]/node_total, 1.0) if node_total else 0.0
+            for caller_id, callee, value in edges.get(node, ()):
+                if value is not None:
+                    flows[callee] = flows.get(callee, 0.0) + shares[node]*value
+                else:
+                    flows.setdefault(callee, 0.0)
+                indegrees[callee] -= 1
+                if not indegrees[callee]:
+                    ready.append(callee)
+
+        function_shares = {}
+        for function_id in descendant_ids:
+            function_shares[function_id] = shares.get(component(self.functions[function_id]), 0.0)
+        return function_shares
+
     def dump(self):
         for function in self.functions.itervalues():
             sys.stderr.write('Function %s:\n' % (function.name,))
@@ -575,236 +1064,967 @@ class Profile(Object):
             sys.stderr.write('    %s: %s\n' % (event.name, event.format(value)))
 
 
-class Struct:
-    """Masquerade a dictionary with a structure-like behavior."""
+NAN = float('nan')
 
-    def __init__(self, attrs = None):
-        if attrs is None:
-            attrs = {}
-        self.__dict__['_attrs'] = attrs
-    
-    def __getattr__(self, name):
-        try:
-            return self._attrs[name]
-        except KeyError:
-            raise AttributeError(name)
 
-    def __setattr__(self, name, value):
-        self._attrs[name] = value
+class CompactProfile(Profile):
+    """A profile storing functions and calls in flat arrays instead of objects.
 
-    def __str__(self):
-        return str(self._attrs)
+    Functions are numbered densely in creation order and every function event
+    is kept in an array('d') column, NaN standing for an undefined value.
+    Calls are accumulated in edge arrays while building, and are sorted into
+    compressed sparse rows (CSR) by caller when the profile is frozen, which
+    happens the first time the calls are looked at.
 
-    def __repr__(self):
-        return repr(self._attrs)
-    
+    The functions mapping and the FunctionView/CallView objects it returns
+    mimic Function and Call objects, so the code written for Profile, like
+    prune() or DotWriter.graph(), works unchanged.
+    """
 
-class ParseError(Exception):
-    """Raised when parsing to signal mismatches."""
+    def __init__(self):
+        Object.__init__(self)
+        self.cycles = []
 
-    def __init__(self, msg, line):
-        self.msg = msg
-        # TODO: store more source line information
-        self.line = line
+        # Functions
+        self.function_ids = {}
+        self.ids = []
+        self.names = []
+        self.modules = []
+        self.processes = []
+        self.called = []
+        self.weights = []
+        self.function_cycles = []
+        self.function_events = {}
+        self.function_alive = bytearray()
+
+        # Calls
+        self.call_index = {}
+        self.call_callers = array('l')
+        self.call_callees = array('l')
+        self.call_events = {}
+        self.ratios = array('d')
+        self.call_weights = array('d')
+        self.call_alive = bytearray()
+        self.call_offsets = None
+
+        # Strongly connected components, callees first
+        self.components = None
+
+        self.stacks = None
+        self.functions = FunctionTable(self)
+
+    def get_function_index(self, id, name, module=None, process=None):
+        """Return the index of a function, creating it if needed."""
+        try:
+            return self.function_ids[id]
+        except KeyError:
+            pass
+        index = len(self.ids)
+        self.function_ids[id] = index
+        self.ids.append(id)
+        self.names.append(name)
+        self.modules.append(module)
+        self.processes.append(process)
+        self.called.append(None)
+        self.weights.append(None)
+        self.function_cycles.append(None)
+        self.function_alive.append(1)
+        for column in self.function_events.itervalues():
+            column.append(NAN)
+        return index
+
+    def get_call_index(self, caller, callee):
+        """Return the index of the call between two function indices, creating it if needed."""
+        key = caller, callee
+        try:
+            return self.call_index[key]
+        except KeyError:
+            pass
+        assert self.call_offsets is None, 'calls cannot be added to a frozen profile'
+        index = len(self.call_callees)
+        self.call_index[key] = index
+        self.call_callers.append(caller)
+        self.call_callees.append(callee)
+        self.ratios.append(NAN)
+        self.call_weights.append(NAN)
+        self.call_alive.append(1)
+        for column in self.call_events.itervalues():
+            column.append(NAN)
+        return index
+
+    def function_column(self, event):
+        try:
+            return self.function_events[event]
+        except KeyError:
+            column = array('d', [NAN])*len(self.ids)
+            self.function_events[event] = column
+            return column
 
-    def __str__(self):
-        return '%s: %r' % (self.msg, self.line)
+    def call_column(self, event):
+        try:
+            return self.call_events[event]
+        except KeyError:
+            column = array('d', [NAN])*len(self.call_callees)
+            self.call_events[event] = column
+            return column
+
+    def add_function_value(self, function, event, value):
+        column = self.function_column(event)
+        total = column[function]
+        if total != total:
+            column[function] = value
+        else:
+            column[function] = total + value
 
+    def add_call_value(self, call, event, value):
+        column = self.call_column(event)
+        total = column[call]
+        if total != total:
+            column[call] = value
+        else:
+            column[call] = total + value
 
-class Parser:
-    """Parser interface."""
+    def add_callchain(self, callchain, event, call_event, value=1):
+        """Add a sampled callchain of function indices, innermost function first."""
+        callee = callchain[0]
+        self.add_function_value(callee, event, value)
+        for caller in callchain[1:]:
+            self.add_call_value(self.get_call_index(caller, callee), call_event, value)
+            callee = caller
 
-    def __init__(self):
-        pass
+    def add_function(self, function):
+        index = self.get_function_index(function.id, function.name, function.module, function.process)
+        self.called[index] = function.called
+        for event, value in function.events.iteritems():
+            self.function_column(event)[index] = value
+        for call in function.calls.itervalues():
+            callee = self.get_function_index(call.callee_id, call.callee_id)
+            call_index = self.get_call_index(index, callee)
+            for event, value in call.events.iteritems():
+                self.call_column(event)[call_index] = value
+
+    def freeze(self):
+        """Sort the calls by caller into compressed sparse rows."""
+        if self.call_offsets is not None:
+            return
+        num_functions = len(self.ids)
+        num_calls = len(self.call_callees)
+
+        offsets = array('l', [0])*(num_functions + 1)
+        for caller in self.call_callers:
+            offsets[caller + 1] += 1
+        for function in xrange(num_functions):
+            offsets[function + 1] += offsets[function]
+
+        order = array('l', [0])*num_calls
+        slots = array('l', offsets)
+        for call in xrange(num_calls):
+            caller = self.call_callers[call]
+            order[slots[caller]] = call
+            slots[caller] += 1
+
+        def permute(column):
+            return array(column.typecode, [column[call] for call in order])
+
+        self.call_callers = permute(self.call_callers)
+        self.call_callees = permute(self.call_callees)
+        self.ratios = permute(self.ratios)
+        self.call_weights = permute(self.call_weights)
+        self.call_alive = bytearray([self.call_alive[call] for call in order])
+        for event in self.call_events.keys():
+            self.call_events[event] = permute(self.call_events[event])
+        self.call_offsets = offsets
+        self.call_index = None
 
-    def parse(self):
-        raise NotImplementedError
+    def validate(self):
+        # Calls refer to function indices, so they cannot be dangling
+        self.freeze()
 
-    
-class LineParser(Parser):
-    """Base class for parsers that read line-based formats."""
+    def find_cycles(self):
+        """Find cycles using an iterative Tarjan's algorithm over the call rows."""
 
-    def __init__(self, file):
-        Parser.__init__(self)
-        self._file = file
-        self.__line = None
-        self.__eof = False
-        self.line_no = 0
+        self.freeze()
+        self.components = self._components()
+        cycles = []
+        for members in self.components:
+            if len(members) > 1:
+                cycle = Cycle()
+                for member in members:
+                    cycle.add_function(FunctionView(self, member))
+                cycles.append(cycle)
+        self.cycles = cycles
 
-    def readline(self):
-        line = self._file.readline()
-        if not line:
-            self.__line = ''
-            self.__eof = True
-        else:
-            self.line_no += 1
-        self.__line = line.rstrip('\r\n')
+    def _components(self):
+        """Return the strongly connected components, callees before callers."""
 
-    def lookahead(self):
-        assert self.__line is not None
-        return self.__line
+        offsets = self.call_offsets
+        callees = self.call_callees
+        alive = self.call_alive
+        num_functions = len(self.ids)
 
-    def consume(self):
-        assert self.__line is not None
-        line = self.__line
-        self.readline()
-        return line
+        orders = array('l', [-1])*num_functions
+        lowlinks = array('l', [0])*num_functions
+        on_stack = bytearray(num_functions)
+        stack = []
+        components = []
+        order = 0
 
-    def eof(self):
-        assert self.__line is not None
-        return self.__eof
+        for root in xrange(num_functions):
+            if orders[root] != -1 or not self.function_alive[root]:
+                continue
+            orders[root] = lowlinks[root] = order
+            order += 1
+            stack.append(root)
+            on_stack[root] = 1
+            work = [(root, offsets[root])]
+            while work:
+                function, call = work[-1]
+                end = offsets[function + 1]
+                callee = -1
+                while call < end:
+                    if alive[call]:
+                        callee = callees[call]
+                        if orders[callee] == -1:
+                            break
+                        if on_stack[callee] and orders[callee] < lowlinks[function]:
+                            lowlinks[function] = orders[callee]
+                    call += 1
+                if call < end:
+                    # Descend into an unvisited callee
+                    work[-1] = function, call + 1
+                    orders[callee] = lowlinks[callee] = order
+                    order += 1
+                    stack.append(callee)
+                    on_stack[callee] = 1
+                    work.append((callee, offsets[callee]))
+                    continue
+                work.pop()
+                if work:
+                    caller = work[-1][0]
+                    if lowlinks[function] < lowlinks[caller]:
+                        lowlinks[caller] = lowlinks[function]
+                if lowlinks[function] == orders[function]:
+                    # Strongly connected component found
+                    pos = len(stack) - 1
+                    while stack[pos] != function:
+                        pos -= 1
+                    members = stack[pos:]
+                    del stack[pos:]
+                    for member in members:
+                        on_stack[member] = 0
+                    components.append(members)
+        return components
+
+    def _call_cycles(self):
+        """Return the cycle of every function, and whether each call enters a cycle from outside."""
+
+        cycles = self.function_cycles
+        callers = self.call_callers
+        callees = self.call_callees
+        enters = bytearray(len(callees))
+        for call in xrange(len(callees)):
+            cycle = cycles[callees[call]]
+            if cycle is not None and cycle is not cycles[callers[call]]:
+                enters[call] = 1
+        return cycles, enters
+
+    def call_ratios(self, event):
+        self.freeze()
+        values = self.call_column(event)
+        callers = self.call_callers
+        callees = self.call_callees
+        alive = self.call_alive
+        ratios = self.ratios
+        cycles, enters = self._call_cycles()
 
+        # Aggregate for incoming calls
+        function_totals = array('d', [0.0])*len(self.ids)
+        cycle_totals = {}
+        for cycle in self.cycles:
+            cycle_totals[cycle] = 0.0
+        for call in xrange(len(callees)):
+            callee = callees[call]
+            if alive[call] and callee != callers[call]:
+                value = values[call]
+                if value != value:
+                    raise UndefinedEvent(event)
+                function_totals[callee] += value
+                if enters[call]:
+                    cycle_totals[cycles[callee]] += value
 
-XML_ELEMENT_START, XML_ELEMENT_END, XML_CHARACTER_DATA, XML_EOF = range(4)
+        # Compute the ratios
+        for call in xrange(len(callees)):
+            callee = callees[call]
+            if alive[call] and callee != callers[call]:
+                assert ratios[call] != ratios[call]
+                if enters[call]:
+                    total = cycle_totals[cycles[callee]]
+                else:
+                    total = function_totals[callee]
+                ratios[call] = ratio(values[call], total)
 
+    def ratio(self, outevent, inevent):
+        assert outevent not in self
+        assert inevent in self
+        total = self[inevent]
+        invalues = self.function_column(inevent)
+        outvalues = self.function_column(outevent)
+        for function in xrange(len(self.ids)):
+            if self.function_alive[function]:
+                assert outvalues[function] != outvalues[function]
+                assert invalues[function] == invalues[function]
+                outvalues[function] = ratio(invalues[function], total)
+        if inevent in self.call_events:
+            invalues = self.call_events[inevent]
+            outvalues = self.call_column(outevent)
+            for call in xrange(len(self.call_callees)):
+                if self.call_alive[call] and invalues[call] == invalues[call]:
+                    outvalues[call] = ratio(invalues[call], total)
+        self[outevent] = 1.0
 
-class XmlToken:
+    def integrate(self, outevent, inevent):
+        """Propagate function time ratio along the calls.
 
-    def __init__(self, type, name_or_data, attrs = None, line = None, column = None):
-        assert type in (XML_ELEMENT_START, XML_ELEMENT_END, XML_CHARACTER_DATA, XML_EOF)
-        self.type = type
-        self.name_or_data = name_or_data
-        self.attrs = attrs
-        self.line = line
-        self.column = column
+        Same algorithm as Profile.integrate, but the strongly connected
+        components are visited callees first so no recursion is needed.
+        """
 
-    def __str__(self):
-        if self.type == XML_ELEMENT_START:
-            return '<' + self.name_or_data + ' ...>'
-        if self.type == XML_ELEMENT_END:
-            return '</' + self.name_or_data + '>'
-        if self.type == XML_CHARACTER_DATA:
-            return self.name_or_data
-        if self.type == XML_EOF:
-            return 'end of file'
-        assert 0
+        self.freeze()
+        assert outevent not in self
+        assert outevent not in self.function_events
+        assert outevent not in self.call_events
+
+        offsets = self.call_offsets
+        callees = self.call_callees
+        alive = self.call_alive
+        ratios = self.ratios
+        invalues = self.function_column(inevent)
+        outvalues = self.function_column(outevent)
+        call_outvalues = self.call_column(outevent)
+        cycles, enters = self._call_cycles()
 
+        total = inevent.null()
+        for function in xrange(len(self.ids)):
+            value = invalues[function]
+            assert value == value
+            total += value
+            for call in xrange(offsets[function], offsets[function + 1]):
+                if alive[call] and callees[call] != function:
+                    assert ratios[call] == ratios[call]
+
+        # Aggregate the input for each cycle
+        for cycle in self.cycles:
+            cycle[inevent] = inevent.null()
+        for function in xrange(len(self.ids)):
+            cycle = cycles[function]
+            if cycle is not None:
+                cycle[inevent] = inevent.aggregate(cycle[inevent], invalues[function])
+
+        # Sum the ratios of the calls entering each cycle, per cycle member
+        entries = {}
+        for call in xrange(len(callees)):
+            if alive[call] and enters[call]:
+                callee = callees[call]
+                entries[callee] = entries.get(callee, 0.0) + ratios[call]
+
+        # Totals of the functions and cycles integrated so far
+        totals = array('d', [0.0])*len(self.ids)
+
+        components = self.components
+        if components is None:
+            components = self._components()
+        for members in components:
+            cycle = cycles[members[0]]
+            if cycle is None:
+                for function in members:
+                    subtotal = invalues[function]
+                    for call in xrange(offsets[function], offsets[function + 1]):
+                        callee = callees[call]
+                        if alive[call] and callee != function:
+                            call_total = ratios[call]*totals[callee]
+                            call_outvalues[call] = call_total
+                            subtotal += call_total
+                    totals[function] = subtotal
+                    outvalues[function] = subtotal
+            else:
+                self._integrate_component(cycle, members, entries, totals, invalues, outvalues, call_outvalues)
 
-class XmlTokenizer:
-    """Expat based XML tokenizer."""
+        self[outevent] = total
 
-    def __init__(self, fp, skip_ws = True):
-        self.fp = fp
-        self.tokens = []
-        self.index = 0
-        self.final = False
-        self.skip_ws = skip_ws
-        
-        self.character_pos = 0, 0
-        self.character_data = ''
-        
-        self.parser = xml.parsers.expat.ParserCreate()
-        self.parser.StartElementHandler  = self.handle_element_start
-        self.parser.EndElementHandler    = self.handle_element_end
-        self.parser.CharacterDataHandler = self.handle_character_data
-    
-    def handle_element_start(self, name, attributes):
-        self.finish_character_data()
-        line, column = self.pos()
-        token = XmlToken(XML_ELEMENT_START, name, attributes, line, column)
-        self.tokens.append(token)
-    
-    def handle_element_end(self, name):
-        self.finish_character_data()
-        line, column = self.pos()
-        token = XmlToken(XML_ELEMENT_END, name, None, line, column)
-        self.tokens.append(token)
-
-    def handle_character_data(self, data):
-        if not self.character_data:
-            self.character_pos = self.pos()
-        self.character_data += data
-    
-    def finish_character_data(self):
-        if self.character_data:
-            if not self.skip_ws or not self.character_data.isspace(): 
-                line, column = self.character_pos
-                token = XmlToken(XML_CHARACTER_DATA, self.character_data, None, line, column)
-                self.tokens.append(token)
-            self.character_data = ''
-    
-    def next(self):
-        size = 16*1024
-        while self.index >= len(self.tokens) and not self.final:
-            self.tokens = []
-            self.index = 0
-            data = self.fp.read(size)
-            self.final = len(data) < size
+    def _integrate_component(self, cycle, members, entries, totals, invalues, outvalues, call_outvalues):
+        offsets = self.call_offsets
+        callees = self.call_callees
+        alive = self.call_alive
+        ratios = self.ratios
+        cycles = self.function_cycles
+
+        # Compute the outevent for the whole cycle
+        total = 0.0
+        for member in members:
+            subtotal = invalues[member]
+            for call in xrange(offsets[member], offsets[member + 1]):
+                callee = callees[call]
+                if alive[call] and cycles[callee] is not cycle:
+                    call_total = ratios[call]*totals[callee]
+                    call_outvalues[call] = call_total
+                    subtotal += call_total
+            total += subtotal
+        for member in members:
+            totals[member] = total
+            outvalues[member] = 0.0
+
+        # Distribute the time propagated by each caller of the cycle along the
+        # calls that go deeper into the cycle, starting from the called member
+        for entry in members:
             try:
-                self.parser.Parse(data, self.final)
-            except xml.parsers.expat.ExpatError, e:
-                #if e.code == xml.parsers.expat.errors.XML_ERROR_NO_ELEMENTS:
-                if e.code == 3:
-                    pass
-                else:
-                    raise e
-        if self.index >= len(self.tokens):
-            line, column = self.pos()
-            token = XmlToken(XML_EOF, None, None, line, column)
-        else:
-            token = self.tokens[self.index]
-            self.index += 1
-        return token
+                entry_ratio = entries[entry]
+            except KeyError:
+                continue
 
-    def pos(self):
-        return self.parser.CurrentLineNumber, self.parser.CurrentColumnNumber
+            # Rank the members by their distance from the called member
+            ranks = {entry: 0}
+            queue = [entry]
+            for function in queue:
+                rank = ranks[function] + 1
+                for call in xrange(offsets[function], offsets[function + 1]):
+                    callee = callees[call]
+                    if alive[call] and cycles[callee] is cycle and callee not in ranks:
+                        ranks[callee] = rank
+                        queue.append(callee)
+
+            # Sum the ratios of the calls from lower to higher ranks
+            call_ratios = {}
+            for function in queue:
+                for call in xrange(offsets[function], offsets[function + 1]):
+                    callee = callees[call]
+                    if alive[call] and callee != function and cycles[callee] is cycle and ranks[callee] > ranks[function]:
+                        call_ratios[callee] = call_ratios.get(callee, 0.0) + ratios[call]
+
+            # Integrate from the highest ranks down to the called member
+            partials = {}
+            for function in reversed(queue):
+                partial = entry_ratio*invalues[function]
+                for call in xrange(offsets[function], offsets[function + 1]):
+                    callee = callees[call]
+                    if not alive[call] or callee == function:
+                        continue
+                    if cycles[callee] is not cycle:
+                        partial += entry_ratio*call_outvalues[call]
+                    elif ranks[callee] > ranks[function]:
+                        call_partial = ratio(ratios[call], call_ratios[callee])*partials[callee]
+                        value = call_outvalues[call]
+                        if value != value:
+                            call_outvalues[call] = call_partial
+                        else:
+                            call_outvalues[call] = value + call_partial
+                        partial += call_partial
+                partials[function] = partial
+                outvalues[function] += partial
 
+            partial = partials[entry]
+            assert partial == max(partials.values())
+            assert not total or abs(1.0 - partial/(entry_ratio*total)) <= 0.001
 
-class XmlTokenMismatch(Exception):
 
-    def __init__(self, expected, found):
-        self.expected = expected
-        self.found = found
+class FunctionTable(object):
+    """Mapping of function ids to the FunctionView objects of a CompactProfile."""
 
-    def __str__(self):
-        return '%u:%u: %s expected, %s found' % (self.found.line, self.found.column, str(self.expected), str(self.found))
+    def __init__(self, profile):
+        self.profile = profile
 
+    def __len__(self):
+        return self.profile.function_alive.count('\x01')
 
-class XmlParser(Parser):
-    """Base XML document parser."""
+    def __contains__(self, id):
+        try:
+            index = self.profile.function_ids[id]
+        except KeyError:
+            return False
+        return bool(self.profile.function_alive[index])
 
-    def __init__(self, fp):
-        Parser.__init__(self)
-        self.tokenizer = XmlTokenizer(fp)
-        self.consume()
+    def __getitem__(self, id):
+        index = self.profile.function_ids[id]
+        if not self.profile.function_alive[index]:
+            raise KeyError(id)
+        return FunctionView(self.profile, index)
+
+    def __delitem__(self, id):
+        index = self.profile.function_ids[id]
+        if not self.profile.function_alive[index]:
+            raise KeyError(id)
+        self.profile.function_alive[index] = 0
+
+    def __iter__(self):
+        return self.iterkeys()
+
+    def iterkeys(self):
+        profile = self.profile
+        alive = profile.function_alive
+        for index in xrange(len(profile.ids)):
+            if alive[index]:
+                yield profile.ids[index]
+
+    def itervalues(self):
+        profile = self.profile
+        alive = profile.function_alive
+        for index in xrange(len(profile.ids)):
+            if alive[index]:
+                yield FunctionView(profile, index)
+
+    def iteritems(self):
+        for function in self.itervalues():
+            yield function.id, function
+
+    def keys(self):
+        return list(self.iterkeys())
+
+    def values(self):
+        return list(self.itervalues())
+
+    def items(self):
+        return list(self.iteritems())
+
+
+class CallTable(object):
+    """Mapping of callee ids to the CallView objects of a function in a CompactProfile."""
+
+    def __init__(self, profile, function):
+        profile.freeze()
+        self.profile = profile
+        self.function = function
+
+    def _calls(self):
+        profile = self.profile
+        alive = profile.call_alive
+        for call in xrange(profile.call_offsets[self.function], profile.call_offsets[self.function + 1]):
+            if alive[call]:
+                yield call
+
+    def _find(self, callee_id):
+        profile = self.profile
+        try:
+            callee = profile.function_ids[callee_id]
+        except KeyError:
+            raise KeyError(callee_id)
+        for call in self._calls():
+            if profile.call_callees[call] == callee:
+                return call
+        raise KeyError(callee_id)
+
+    def __len__(self):
+        return len(list(self._calls()))
+
+    def __contains__(self, callee_id):
+        try:
+            self._find(callee_id)
+        except KeyError:
+            return False
+        return True
+
+    def __getitem__(self, callee_id):
+        return CallView(self.profile, self._find(callee_id))
+
+    def __delitem__(self, callee_id):
+        self.profile.call_alive[self._find(callee_id)] = 0
+
+    def __iter__(self):
+        return self.iterkeys()
+
+    def iterkeys(self):
+        profile = self.profile
+        for call in self._calls():
+            yield profile.ids[profile.call_callees[call]]
+
+    def itervalues(self):
+        for call in self._calls():
+            yield CallView(self.profile, call)
+
+    def iteritems(self):
+        for call in self.itervalues():
+            yield call.callee_id, call
+
+    def keys(self):
+        return list(self.iterkeys())
+
+    def values(self):
+        return list(self.itervalues())
+
+    def items(self):
+        return list(self.iteritems())
+
+
+class _ColumnView(object):
+    """Base class for views over the event columns of a CompactProfile."""
+
+    __slots__ = ('profile', 'index')
+
+    def __init__(self, profile, index):
+        self.profile = profile
+        self.index = index
+
+    def __hash__(self):
+        return hash(self.index)
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.profile is other.profile and self.index == other.index
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def _columns(self):
+        raise NotImplementedError
+
+    def _column(self, event):
+        raise NotImplementedError
+
+    def __contains__(self, event):
+        try:
+            value = self._columns()[event][self.index]
+        except KeyError:
+            return False
+        return value == value
+
+    def __getitem__(self, event):
+        try:
+            value = self._columns()[event][self.index]
+        except KeyError:
+            raise UndefinedEvent(event)
+        if value != value:
+            raise UndefinedEvent(event)
+        return value
+
+    def __setitem__(self, event, value):
+        if value is None:
+            if event in self._columns():
+                self._columns()[event][self.index] = NAN
+        else:
+            self._column(event)[self.index] = value
+
+    @property
+    def events(self):
+        events = {}
+        for event, column in self._columns().iteritems():
+            value = column[self.index]
+            if value == value:
+                events[event] = value
+        return events
+
+
+class FunctionView(_ColumnView):
+    """Function-like view of a function stored in a CompactProfile."""
+
+    __slots__ = ()
+
+    def _columns(self):
+        return self.profile.function_events
+
+    def _column(self, event):
+        return self.profile.function_column(event)
+
+    def _get_attr(name):
+        def getter(self):
+            return getattr(self.profile, name)[self.index]
+        def setter(self, value):
+            getattr(self.profile, name)[self.index] = value
+        return property(getter, setter)
+
+    id = _get_attr('ids')
+    name = _get_attr('names')
+    module = _get_attr('modules')
+    process = _get_attr('processes')
+    called = _get_attr('called')
+    weight = _get_attr('weights')
+    cycle = _get_attr('function_cycles')
+
+    del _get_attr
+
+    @property
+    def calls(self):
+        return CallTable(self.profile, self.index)
+
+    stripped_name = Function.stripped_name.im_func
+    _parenthesis_re = Function._parenthesis_re
+    _angles_re = Function._angles_re
+    _const_re = Function._const_re
+
+    def __repr__(self):
+        return self.name
+
+
+class CallView(_ColumnView):
+    """Call-like view of a call stored in a CompactProfile."""
+
+    __slots__ = ()
+
+    def _columns(self):
+        return self.profile.call_events
+
+    def _column(self, event):
+        return self.profile.call_column(event)
+
+    @property
+    def callee_id(self):
+        return self.profile.ids[self.profile.call_callees[self.index]]
+
+    def _get_ratio(self):
+        value = self.profile.ratios[self.index]
+        if value != value:
+            return None
+        return value
+
+    def _set_ratio(self, value):
+        if value is None:
+            value = NAN
+        self.profile.ratios[self.index] = value
+
+    ratio = property(_get_ratio, _set_ratio)
+
+    def _get_weight(self):
+        value = self.profile.call_weights[self.index]
+        if value != value:
+            return None
+        return value
+
+    def _set_weight(self, value):
+        if value is None:
+            value = NAN
+        self.profile.call_weights[self.index] = value
+
+    weight = property(_get_weight, _set_weight)
+
+
+class DiffProfile(Profile):
+    """Changes between two profiles of the same program, see diff_profiles.
+
+    Functions and calls hold the events of the new profile, plus the
+    DELTA_TIME_RATIO and DELTA_TOTAL_TIME_RATIO changes since the base
+    profile.
+    """
+
+    def prune(self, node_thres, edge_thres):
+        """Prune what is below the thresholds in both profiles, and weight
+        the rest by its change: 0.5 is unchanged, 0.0 the largest speedup
+        and 1.0 the largest regression."""
+
+        for function in self.functions.itervalues():
+            function.weight = self._peak_ratio(function)
+            for call in function.calls.itervalues():
+                call.weight = self._peak_ratio(call)
+
+        self._prune_weights(node_thres, edge_thres)
+
+        scale = 0.0
+        for function in self.functions.itervalues():
+            scale = max(scale, abs(function[DELTA_TOTAL_TIME_RATIO]))
+            for call in function.calls.itervalues():
+                if DELTA_TOTAL_TIME_RATIO in call:
+                    scale = max(scale, abs(call[DELTA_TOTAL_TIME_RATIO]))
+        if not scale:
+            scale = 1.0
+
+        for function in self.functions.itervalues():
+            function.weight = 0.5 + 0.5*function[DELTA_TOTAL_TIME_RATIO]/scale
+            for call in function.calls.itervalues():
+                if DELTA_TOTAL_TIME_RATIO in call:
+                    call.weight = 0.5 + 0.5*call[DELTA_TOTAL_TIME_RATIO]/scale
+                else:
+                    call.weight = None
+
+    def renormalize(self, root_ids):
+        """Renormalize the new and the base profiles separately, then
+        compute the deltas again."""
+
+        def base_total_time_ratio(object):
+            try:
+                return object[TOTAL_TIME_RATIO] - object[DELTA_TOTAL_TIME_RATIO]
+            except UndefinedEvent:
+                return None
+
+        new_scale = self._root_scale(root_ids, _total_time_ratio)
+        base_scale = self._root_scale(root_ids, base_total_time_ratio)
+        for function in self.functions.itervalues():
+            new_factor = base_factor = 1.0
+            if new_scale is not None:
+                new_factor = new_scale.get(function.id, 0.0)
+            if base_scale is not None:
+                base_factor = base_scale.get(function.id, 0.0)
+            for object in [function] + list(function.calls.itervalues()):
+                for event, delta_event in (TOTAL_TIME_RATIO, DELTA_TOTAL_TIME_RATIO), (TIME_RATIO, DELTA_TIME_RATIO):
+                    if event in object and delta_event in object:
+                        new = object[event]
+                        base = new - object[delta_event]
+                        object[event] = new*new_factor
+                        object[delta_event] = new*new_factor - base*base_factor
+
+    def _peak_ratio(self, object):
+        """Largest total time ratio of an object in both profiles."""
+
+        try:
+            new = object[TOTAL_TIME_RATIO]
+            return max(new, new - object[DELTA_TOTAL_TIME_RATIO])
+        except UndefinedEvent:
+            return None
+
+
+def diff_profiles(base, new):
+    """Compare two profiles, matching functions by name and module.
+
+    Matching goes through a hash index, so the cost is linear in the size
+    of both profiles. Functions and calls found in only one profile count
+    as null in the other one.
+    """
+
+    profile = DiffProfile()
+    functions = {}
+    function_ids = {}
+    function_ratios = {}
+    call_ratios = {}
+    for index, source in enumerate((base, new)):
+        for function in source.functions.itervalues():
+            key = (function.name, function.module)
+            try:
+                diff = functions[key]
+            except KeyError:
+                diff = Function(len(functions), function.name)
+                diff.module = function.module
+                diff.process = function.process
+                functions[key] = diff
+                function_ratios[diff.id] = [0.0, 0.0, 0.0, 0.0]
+                profile.add_function(diff)
+            if index:
+                diff.called = function.called
+            function_ids[index, function.id] = diff.id
+            ratios = function_ratios[diff.id]
+            if TOTAL_TIME_RATIO in function:
+                ratios[index] += function[TOTAL_TIME_RATIO]
+            if TIME_RATIO in function:
+                ratios[2 + index] += function[TIME_RATIO]
+
+        for function in source.functions.itervalues():
+            caller_id = function_ids[index, function.id]
+            for call in function.calls.itervalues():
+                key = caller_id, function_ids[index, call.callee_id]
+                try:
+                    ratios = call_ratios[key]
+                except KeyError:
+                    ratios = call_ratios[key] = [None, None, None, None]
+                if TOTAL_TIME_RATIO in call:
+                    ratios[index] = (ratios[index] or 0.0) + call[TOTAL_TIME_RATIO]
+                if TIME_RATIO in call:
+                    ratios[2 + index] = (ratios[2 + index] or 0.0) + call[TIME_RATIO]
+
+    for id, (base_total, new_total, base_self, new_self) in function_ratios.iteritems():
+        diff = profile.functions[id]
+        diff[TOTAL_TIME_RATIO] = new_total
+        diff[TIME_RATIO] = new_self
+        diff[DELTA_TOTAL_TIME_RATIO] = new_total - base_total
+        diff[DELTA_TIME_RATIO] = new_self - base_self
+
+    for (caller_id, callee_id), (base_total, new_total, base_self, new_self) in call_ratios.iteritems():
+        call = Call(callee_id)
+        if base_total is not None or new_total is not None:
+            # Calls inside cycles have no total time ratio
+            call[TOTAL_TIME_RATIO] = new_total or 0.0
+            call[DELTA_TOTAL_TIME_RATIO] = (new_total or 0.0) - (base_total or 0.0)
+        if base_self is not None or new_self is not None:
+            call[TIME_RATIO] = new_self or 0.0
+            call[DELTA_TIME_RATIO] = (new_self or 0.0) - (base_self or 0.0)
+        profile.functions[caller_id].add_call(call)
+
+    profile[TOTAL_TIME_RATIO] = 1.0
+    profile[TIME_RATIO] = 1.0
+    profile.find_cycles()
+    return profile
+
+
+class Struct:
+    """Masquerade a dictionary with a structure-like behavior."""
+
+    def __init__(self, attrs = None):
+        if attrs is None:
+            attrs = {}
+        self.__dict__['_attrs'] = attrs
     
-    def consume(self):
-        self.token = self.tokenizer.next()
+    def __getattr__(self, name):
+        try:
+            return self._attrs[name]
+        except KeyError:
+            raise AttributeError(name)
 
-    def match_element_start(self, name):
-        return self.token.type == XML_ELEMENT_START and self.token.name_or_data == name
+    def __setattr__(self, name, value):
+        self._attrs[name] = value
+
+    def __str__(self):
+        return str(self._attrs)
+
+    def __repr__(self):
+        return repr(self._attrs)
     
-    def match_element_end(self, name):
-        return self.token.type == XML_ELEMENT_END and self.token.name_or_data == name
 
-    def element_start(self, name):
-        while self.token.type == XML_CHARACTER_DATA:
-            self.consume()
-        if self.token.type != XML_ELEMENT_START:
-            raise XmlTokenMismatch(XmlToken(XML_ELEMENT_START, name), self.token)
-        if self.token.name_or_data != name:
-            raise XmlTokenMismatch(XmlToken(XML_ELEMENT_START, name), self.token)
-        attrs = self.token.attrs
-        self.consume()
-        return attrs
+class ParseError(Exception):
+    """Raised when parsing to signal mismatches."""
+
+    def __init__(self, msg, line):
+        # Keep the arguments, so errors of parsing workers can be pickled
+        Exception.__init__(self, msg, line)
+        self.msg = msg
+        # TODO: store more source line information
+        self.line = line
+
+    def __str__(self):
+        return '%s: %r' % (self.msg, self.line)
+
+
+class Parser:
+    """Parser interface."""
+
+    # Whether sampling parsers keep every stack in Profile.stacks, which
+    # only the folded and flame outputs need
+    keep_stacks = False
+
+    # Part of the profile cache key, bump it when a change to the parser
+    # changes the profiles it returns
+    version = 1
+
+    def __init__(self):
+        pass
+
+    def parse(self):
+        raise NotImplementedError
+
     
-    def element_end(self, name):
-        while self.token.type == XML_CHARACTER_DATA:
-            self.consume()
-        if self.token.type != XML_ELEMENT_END:
-            raise XmlTokenMismatch(XmlToken(XML_ELEMENT_END, name), self.token)
-        if self.token.name_or_data != name:
-            raise XmlTokenMismatch(XmlToken(XML_ELEMENT_END, name), self.token)
-        self.consume()
+class LineParser(Parser):
+    """Base class for parsers that read line-based formats."""
 
-    def character_data(self, strip = True):
-        data = ''
-        while self.token.type == XML_CHARACTER_DATA:
-            data += self.token.name_or_data
-            self.consume()
-        if strip:
-            data = data.strip()
-        return data
+    def __init__(self, file):
+        Parser.__init__(self)
+        self._file = file
+        self.__line = None
+        self.__eof = False
+        self.line_no = 0
+
+    def readline(self):
+        line = self._file.readline()
+        if not line:
+            self.__line = ''
+            self.__eof = True
+        else:
+            self.line_no += 1
+        self.__line = line.rstrip('\r\n')
+
+    def lookahead(self):
+        assert self.__line is not None
+        return self.__line
+
+    def consume(self):
+        assert self.__line is not None
+        line = self.__line
+        self.readline()
+        return line
+
+    def eof(self):
+        assert self.__line is not None
+        return self.__eof
 
 
 class GprofParser(Parser):
@@ -1071,13 +2291,17 @@ class GprofParser(Parser):
 
 class CallgrindParser(LineParser):
     """Parser for valgrind's callgrind tool.
-    
+
+    Lines are classified by their first character and only the first event
+    of cost lines is converted, as that is the only one kept in the profile.
+    Functions are interned to dense indices as they are seen, and costs are
+    accumulated per function and per call, so memory usage is proportional
+    to the number of functions and calls, not to the size of the file.
+
     See also:
     - http://valgrind.org/docs/manual/cl-format.html
     """
 
-    _call_re = re.compile('^calls=\s*(\d+)\s+((\d+|\+\d+|-\d+|\*)\s+)+$')
-
     def __init__(self, infile):
         LineParser.__init__(self, infile)
 
@@ -1085,29 +2309,121 @@ class CallgrindParser(LineParser):
         self.position_ids = {}
         self.positions = {}
 
+        # Compressed position references, as (position, name) keyed by their
+        # specification and "(id)" token
+        self.position_refs = {}
+
         # Numeric positions
         self.num_positions = 1
         self.cost_positions = ['line']
-        self.last_positions = [0]
 
         # Events
         self.num_events = 0
         self.cost_events = []
 
+        # Interned functions
+        self.function_ids = {}
+        self.function_names = []
+        self.function_modules = []
+        self.function_samples = []
+        self.function_called = []
+
+        # Calls, keyed by (caller index, callee index)
+        self.call_counts = {}
+        self.call_samples = {}
+
         self.profile = Profile()
         self.profile[SAMPLES] = 0
 
+    _cost_chars = frozenset('0123456789+-*')
+
     def parse(self):
-        # read lookahead
-        self.readline()
+        positions = self.positions
+        function_ids = self.function_ids
+        function_samples = self.function_samples
+        function_called = self.function_called
+        call_counts = self.call_counts
+        call_samples = self.call_samples
+        cost_chars = self._cost_chars
+        position_refs = self.position_refs
+
+        total = self.profile[SAMPLES]
+        num_positions = self.num_positions
+        function = None
+        calls = None
+        line = None
+
+        line_no = self.line_no
+        for line in self._file:
+            line_no += 1
+
+            if line[0] in cost_chars:
+                values = line.split(None, num_positions + 1)
+                if len(values) > num_positions:
+                    samples = float(values[num_positions])
+                else:
+                    samples = 0.0
+                if function is None:
+                    function = function_ids.get(positions.get('fn', ''))
+                    if function is None:
+                        function = self.get_function()
+                if calls is None:
+                    function_samples[function] += samples
+                    total += samples
+                    # Unlike other aspects, call object (cob) is relative not to the
+                    # last call object, but to the caller's object (ob), so try to
+                    # update it when processing a functions cost line
+                    try:
+                        positions['cob'] = positions['ob']
+                    except KeyError:
+                        pass
+                else:
+                    callee = function_ids.get(positions.get('cfn', ''))
+                    if callee is None:
+                        callee = self.get_callee()
+                    function_called[callee] += calls
+                    key = function, callee
+                    call_counts[key] = call_counts.get(key, 0) + calls
+                    call_samples[key] = call_samples.get(key, 0) + samples
+                    calls = None
+                continue
 
-        self.parse_key('version')
-        self.parse_key('creator')
-        while self.parse_part():
-            pass
-        if not self.eof():
+            # Most position lines refer to compressed names, resolve them
+            # with a single lookup
+            spec, sep, token = line.partition('=')
+            entry = position_refs.get((spec, token.rstrip()))
+            if entry is not None:
+                position, name = entry
+                positions[position] = name
+                if position == 'fn' or position == 'ob':
+                    function = None
+                continue
+
+            if line.startswith('calls='):
+                calls = int(line[6:].split(None, 1)[0])
+            elif line.startswith('jump=') or line.startswith('jcnd='):
+                pass
+            elif line.startswith('#') or not line.strip():
+                pass
+            else:
+                position = self.parse_position_spec(line)
+                if position is not None:
+                    if position == 'fn' or position == 'ob':
+                        function = None
+                elif self.parse_key(line):
+                    num_positions = self.num_positions
+                else:
+                    break
+        else:
+            line = None
+        self.line_no = line_no
+
+        if line is not None:
             sys.stderr.write('warning: line %u: unexpected line\n' % self.line_no)
-            sys.stderr.write('%s\n' % self.lookahead())
+            sys.stderr.write('%s\n' % line.rstrip('\r\n'))
+
+        self.profile[SAMPLES] = total
+        self.build_profile()
 
         # compute derived data
         self.profile.validate()
@@ -1118,46 +2434,32 @@ class CallgrindParser(LineParser):
 
         return self.profile
 
-    def parse_part(self):
-        if not self.parse_header_line():
-            return False
-        while self.parse_header_line():
-            pass
-        if not self.parse_body_line():
-            return False
-        while self.parse_body_line():
-            pass
-        return True
-
-    def parse_header_line(self):
-        return \
-            self.parse_empty() or \
-            self.parse_comment() or \
-            self.parse_part_detail() or \
-            self.parse_description() or \
-            self.parse_event_specification() or \
-            self.parse_cost_line_def() or \
-            self.parse_cost_summary()
-
-    _detail_keys = set(('cmd', 'pid', 'thread', 'part'))
-
-    def parse_part_detail(self):
-        return self.parse_keys(self._detail_keys)
+    def build_profile(self):
+        functions = []
+        for index in xrange(len(self.function_names)):
+            name = self.function_names[index]
+            function = Function(name, name)
+            module = self.function_modules[index]
+            if module:
+                function.module = os.path.basename(module)
+            function[SAMPLES] = self.function_samples[index]
+            function.called = self.function_called[index]
+            self.profile.add_function(function)
+            functions.append(function)
 
-    def parse_description(self):
-        return self.parse_key('desc') is not None
+        for key, calls in self.call_counts.iteritems():
+            caller, callee = key
+            call = Call(functions[callee].id)
+            call[CALLS] = calls
+            call[SAMPLES] = self.call_samples[key]
+            functions[caller].add_call(call)
 
-    def parse_event_specification(self):
-        event = self.parse_key('event')
-        if event is None:
-            return False
-        return True
+    _header_keys = set(('version', 'creator', 'cmd', 'pid', 'thread', 'part', 'desc', 'event', 'events', 'positions', 'summary', 'totals'))
 
-    def parse_cost_line_def(self):
-        pair = self.parse_keys(('events', 'positions'))
-        if pair is None:
+    def parse_key(self, line):
+        key, sep, value = line.partition(':')
+        if not sep or key not in self._header_keys:
             return False
-        key, value = pair
         items = value.split()
         if key == 'events':
             self.num_events = len(items)
@@ -1165,105 +2467,8 @@ class CallgrindParser(LineParser):
         if key == 'positions':
             self.num_positions = len(items)
             self.cost_positions = items
-            self.last_positions = [0]*self.num_positions
-        return True
-
-    def parse_cost_summary(self):
-        pair = self.parse_keys(('summary', 'totals'))
-        if pair is None:
-            return False
-        return True
-
-    def parse_body_line(self):
-        return \
-            self.parse_empty() or \
-            self.parse_comment() or \
-            self.parse_cost_line() or \
-            self.parse_position_spec() or \
-            self.parse_association_spec()
-
-    __subpos_re = r'(0x[0-9a-fA-F]+|\d+|\+\d+|-\d+|\*)'
-    _cost_re = re.compile(r'^' + 
-        __subpos_re + r'( +' + __subpos_re + r')*' +
-        r'( +\d+)*' +
-    '$')
-
-    def parse_cost_line(self, calls=None):
-        line = self.lookahead().rstrip()
-        mo = self._cost_re.match(line)
-        if not mo:
-            return False
-
-        function = self.get_function()
-
-        if calls is None:
-            # Unlike other aspects, call object (cob) is relative not to the
-            # last call object, but to the caller's object (ob), so try to
-            # update it when processing a functions cost line
-            try:
-                self.positions['cob'] = self.positions['ob']
-            except KeyError:
-                pass
-
-        values = line.split()
-        assert len(values) <= self.num_positions + self.num_events
-
-        positions = values[0 : self.num_positions]
-        events = values[self.num_positions : ]
-        events += ['0']*(self.num_events - len(events))
-
-        for i in range(self.num_positions):
-            position = positions[i]
-            if position == '*':
-                position = self.last_positions[i]
-            elif position[0] in '-+':
-                position = self.last_positions[i] + int(position)
-            elif position.startswith('0x'):
-                position = int(position, 16)
-            else:
-                position = int(position)
-            self.last_positions[i] = position
-
-        events = map(float, events)
-
-        if calls is None:
-            function[SAMPLES] += events[0] 
-            self.profile[SAMPLES] += events[0]
-        else:
-            callee = self.get_callee()
-            callee.called += calls
-    
-            try:
-                call = function.calls[callee.id]
-            except KeyError:
-                call = Call(callee.id)
-                call[CALLS] = calls
-                call[SAMPLES] = events[0]
-                function.add_call(call)
-            else:
-                call[CALLS] += calls
-                call[SAMPLES] += events[0]
-
-        self.consume()
-        return True
-
-    def parse_association_spec(self):
-        line = self.lookahead()
-        if not line.startswith('calls='):
-            return False
-
-        _, values = line.split('=', 1)
-        values = values.strip().split()
-        calls = int(values[0])
-        call_position = values[1:]
-        self.consume()
-
-        self.parse_cost_line(calls)
-
         return True
 
-    _position_re = re.compile('^(?P<position>[cj]?(?:ob|fl|fi|fe|fn))=\s*(?:\((?P<id>\d+)\))?(?:\s*(?P<name>.+))?')
-
     _position_table_map = {
         'ob': 'ob',
         'fl': 'fl',
@@ -1292,132 +2497,1148 @@ class CallgrindParser(LineParser):
         'jfi': 'jfi',
     }
 
-    def parse_position_spec(self):
-        line = self.lookahead()
-        
-        if line.startswith('jump=') or line.startswith('jcnd='):
-            self.consume()
-            return True
+    def parse_position_spec(self, line):
+        position, sep, value = line.partition('=')
+        try:
+            table = self._position_table_map[position]
+        except KeyError:
+            return None
+
+        # Names may be compressed as "(id) name" the first time, and "(id)" afterwards
+        spec = position
+        position = self._position_map[spec]
+        value = value.strip()
+        if value.startswith('('):
+            end = value.find(')')
+            id = value[1:end]
+            if end > 1 and id.isdigit():
+                name = value[end + 1:].lstrip()
+                if name:
+                    if self.position_ids.get((table, id), name) != name:
+                        # A redefined id, forget the references to the old name
+                        self.position_refs.clear()
+                    self.position_ids[(table, id)] = name
+                else:
+                    try:
+                        name = self.position_ids[(table, id)]
+                    except KeyError:
+                        name = ''
+                    else:
+                        self.position_refs[(spec, value)] = position, name
+                value = name
+
+        self.positions[position] = value
+        return position
+
+    def make_function(self, module, filename, name):
+        # FIXME: module and filename are not being tracked reliably
+        #id = '|'.join((module, filename, name))
+        id = name
+        try:
+            index = self.function_ids[id]
+        except KeyError:
+            index = len(self.function_names)
+            self.function_ids[id] = index
+            self.function_names.append(name)
+            self.function_modules.append(module)
+            self.function_samples.append(0)
+            self.function_called.append(0)
+        return index
+
+    def get_function(self):
+        module = self.positions.get('ob', '')
+        filename = self.positions.get('fl', '') 
+        function = self.positions.get('fn', '') 
+        return self.make_function(module, filename, function)
+
+    def get_callee(self):
+        module = self.positions.get('cob', '')
+        filename = self.positions.get('cfi', '') 
+        function = self.positions.get('cfn', '') 
+        return self.make_function(module, filename, function)
+
+
+class DecompressedFile:
+    """Read-only file decompressing its input on the fly.
+
+    Decompressed chunks are buffered, so that blocks are sliced from large
+    strings. For readline and iteration every chunk is split in lines at
+    once, and lines are handed out by C iterators.
+    """
+
+    def __init__(self, chunks, fp):
+        import functools
+        self.chunks = chunks
+        self.fp = fp
+        self.buffer = ''
+        self.position = 0
+        # Iterator over the lines split from the current chunk
+        self.lines = iter(())
+        self.line_iterator = itertools.chain.from_iterable(self.split_lines())
+        self.readline = functools.partial(next, self.line_iterator, '')
+
+    def fill(self):
+        """Append the next decompressed chunk to the buffer, returning False
+        at the end of the stream."""
+
+        for chunk in self.chunks:
+            self.buffer = self.buffer[self.position:] + chunk
+            self.position = 0
+            return True
+        return False
+
+    def split_lines(self):
+        while True:
+            end = self.buffer.rfind('\n', self.position) + 1
+            if end:
+                data = self.buffer[self.position:end]
+                self.position = end
+                if '\r' in data:
+                    # splitlines would also split at lone carriage returns
+                    lines = [line + '\n' for line in data[:-1].split('\n')]
+                else:
+                    lines = data.splitlines(True)
+                self.lines = iter(lines)
+                yield self.lines
+            elif not self.fill():
+                if self.position < len(self.buffer):
+                    self.lines = iter([self.buffer[self.position:]])
+                    self.position = len(self.buffer)
+                    yield self.lines
+                return
+
+    def read(self, size=-1):
+        # Put back the lines split ahead
+        lines = list(self.lines)
+        if lines:
+            self.buffer = ''.join(lines) + self.buffer[self.position:]
+            self.position = 0
+
+        if size < 0:
+            while self.fill():
+                pass
+            size = len(self.buffer) - self.position
+        else:
+            while len(self.buffer) - self.position < size and self.fill():
+                pass
+        data = self.buffer[self.position:self.position + size]
+        self.position += len(data)
+        return data
+
+    def __iter__(self):
+        return self.line_iterator
+
+    def close(self):
+        self.fp.close()
+
+
+def decompress_chunks(fp, decompressor_factory, error, chunk_size=1 << 20):
+    """Decompress a file with zlib, bz2 or lzma style decompressor objects.
+
+    Concatenated streams, as written by pigz, pbzip2 or cat, are
+    decompressed one after the other, and zero bytes padding the end of the
+    file are skipped. Decoder errors, of the given exception class, raise
+    ParseError.
+    """
+
+    decompressor = decompressor_factory()
+    # Whether a stream has ended, and the decompressor not been fed since
+    ended = False
+    fresh = True
+    while True:
+        data = fp.read(chunk_size)
+        if not data:
+            break
+        while data:
+            if ended and fresh and not data.strip('\0'):
+                break
+            try:
+                chunk = decompressor.decompress(data)
+            except EOFError:
+                # Data past the end of a bz2 or lzma stream
+                decompressor = decompressor_factory()
+                ended = fresh = True
+                continue
+            except error, e:
+                raise ParseError('invalid compressed data', '%s: %s' % (getattr(fp, 'name', '<stream>'), e))
+            fresh = False
+            if chunk:
+                yield chunk
+            data = decompressor.unused_data
+            if data:
+                decompressor = decompressor_factory()
+                ended = fresh = True
+    if hasattr(decompressor, 'flush'):
+        chunk = decompressor.flush()
+        if chunk:
+            yield chunk
+
+
+def command_chunks(fp, args, chunk_size=1 << 20):
+    """Decompress a file through an external command, for the formats
+    without a python module."""
+
+    import subprocess
+    try:
+        # Decompressors only write a line or two of errors, read at the end
+        process = subprocess.Popen(args, stdin=fp, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except OSError:
+        raise IOError('%s is needed to read %s' % (args[0], fp.name))
+    while True:
+        chunk = process.stdout.read(chunk_size)
+        if not chunk:
+            break
+        yield chunk
+    errors = process.stderr.read()
+    if process.wait():
+        raise ParseError('%s failed to decompress' % args[0], '%s: %s' % (fp.name, errors.strip()))
+
+
+def stream_chunks(reader, error, name, chunk_size=1 << 20):
+    """Read a decompressing file object, decoder errors raising ParseError."""
+
+    while True:
+        try:
+            chunk = reader.read(chunk_size)
+        except error, e:
+            raise ParseError('invalid compressed data', '%s: %s' % (name, e))
+        if not chunk:
+            break
+        yield chunk
+
+
+def open_input(filename):
+    """Open an input file, decompressing it on the fly when its magic bytes
+    are those of gzip, bzip2, xz or zstd."""
+
+    fp = open(filename, 'rb')
+    magic = fp.read(6)
+    fp.seek(0)
+    if magic.startswith('\x1f\x8b'):
+        import zlib
+        chunks = decompress_chunks(fp, lambda: zlib.decompressobj(16 + zlib.MAX_WBITS), zlib.error)
+    elif magic.startswith('BZh'):
+        import bz2
+        # bz2 reports invalid data as IOError
+        chunks = decompress_chunks(fp, bz2.BZ2Decompressor, IOError)
+    elif magic == '\xfd7zXZ\x00':
+        try:
+            import lzma
+        except ImportError:
+            try:
+                from backports import lzma
+            except ImportError:
+                lzma = None
+        if lzma is not None:
+            chunks = decompress_chunks(fp, lzma.LZMADecompressor, lzma.LZMAError)
+        else:
+            chunks = command_chunks(fp, ['xz', '-dc'])
+    elif magic.startswith('\x28\xb5\x2f\xfd'):
+        try:
+            import zstandard
+        except ImportError:
+            chunks = command_chunks(fp, ['zstd', '-dc'])
+        else:
+            reader = zstandard.ZstdDecompressor().stream_reader(fp)
+            chunks = stream_chunks(reader, zstandard.ZstdError, filename)
+    else:
+        fp.close()
+        return open(filename, 'rt')
+    return DecompressedFile(chunks, fp)
+
+
+class FileRange:
+    """Read-only file restricted to a byte range, for the parsing workers."""
+
+    def __init__(self, filename, start, end):
+        self.fp = open(filename, 'rb')
+        self.fp.seek(start)
+        self.remaining = end - start
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.fp.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def readline(self):
+        if self.remaining <= 0:
+            return ''
+        line = self.fp.readline(self.remaining)
+        self.remaining -= len(line)
+        return line
+
+    def __iter__(self):
+        while True:
+            line = self.readline()
+            if not line:
+                break
+            yield line
+
+    def close(self):
+        self.fp.close()
+
+
+def split_shards(filename, count, separator):
+    """Split a file in up to count byte ranges, each one ending right after a
+    match of the separator regular expression, or at the end of the file."""
+
+    size = os.path.getsize(filename)
+    separator_re = re.compile(separator)
+    bounds = [0]
+    fp = open(filename, 'rb')
+    try:
+        for shard in xrange(1, count):
+            offset = max(size*shard//count, bounds[-1])
+            fp.seek(offset)
+            # Separators are short, so an overlap of a few bytes is enough
+            # to find one straddling two chunks
+            data = ''
+            while True:
+                chunk = fp.read(1 << 16)
+                if not chunk:
+                    offset = size
+                    break
+                data = data[-16:] + chunk
+                offset += len(chunk)
+                mo = separator_re.search(data)
+                if mo:
+                    offset += mo.end() - len(data)
+                    break
+            if offset >= size:
+                break
+            if offset > bounds[-1]:
+                bounds.append(offset)
+    finally:
+        fp.close()
+    bounds.append(size)
+    return [(filename, start, end) for start, end in zip(bounds[:-1], bounds[1:])]
+
+
+def shard_filename(stream, jobs):
+    """Return the name of the file to split between jobs workers, or None to
+    parse the stream serially.
+
+    Only plain files can be split, compressed files and pipes are parsed
+    with a single job, with a warning when more were asked for.
+    """
+
+    if jobs <= 1:
+        return None
+    filename = getattr(stream, 'name', None)
+    if isinstance(stream, file) and filename is not None and os.path.isfile(filename):
+        return filename
+    sys.stderr.write('warning: compressed or piped input cannot be split, parsing it with a single job\n')
+    return None
+
+
+def read_perf_shard(shard):
+    """Parse a byte range of perf script output, in a worker process.
+
+    Returns the (name, module) of the functions, and the sample count of
+    every callchain of function indices, innermost function first.
+    """
+
+    filename, start, end = shard
+    fp = FileRange(filename, start, end)
+    try:
+        parser = PerfParser(fp)
+        stacks = parser.read_stacks()
+    finally:
+        fp.close()
+    return parser.function_keys, stacks
+
+
+def read_shards(reader, shards, jobs):
+    """Parse file shards in a process pool, yielding the results in order."""
+
+    import multiprocessing
+
+    pool = multiprocessing.Pool(jobs)
+    try:
+        for result in pool.imap(reader, shards):
+            yield result
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
+class PerfParser(LineParser):
+    """Parser for linux perf callgraph output.
+
+    It expects output generated with
+
+        perf record -g
+        perf script | gprof2dot.py --format=perf
+
+    The input is read in large blocks and frames are split with string
+    methods. Every distinct frame line is parsed once, functions are
+    interned to integer indices, and identical stacks are counted once
+    before the profile is updated, so the per line cost is little more than
+    a dict lookup.
+
+    With jobs > 1, a file is split at blank lines into shards which are read
+    by worker processes, and their stack counts are merged before the
+    profile is built once.
+    """
+
+    block_size = 1 << 22
+
+    def __init__(self, infile, compact=False, jobs=1):
+        LineParser.__init__(self, infile)
+        if compact:
+            self.profile = CompactProfile()
+        else:
+            self.profile = Profile()
+        self.jobs = jobs
+
+        # Interned functions, indexed by (name, module) and by frame line
+        self.functions = []
+        self.function_keys = []
+        self.function_indices = {}
+        self.frame_indices = {}
+
+    def parse(self):
+        profile = self.profile
+        profile[SAMPLES] = 0
+
+        filename = shard_filename(self._file, self.jobs)
+        if filename is not None:
+            stacks = self.read_shards(filename)
+        else:
+            stacks = self.read_stacks()
+        self.add_stacks(stacks)
+
+        # compute derived data
+        profile.validate()
+        profile.find_cycles()
+        profile.ratio(TIME_RATIO, SAMPLES)
+        profile.call_ratios(SAMPLES2)
+        profile.integrate(TOTAL_TIME_RATIO, TIME_RATIO)
+
+        return profile
+
+    def read_stacks(self):
+        """Count the samples of every distinct callchain, as tuples of
+        function indices, innermost function first."""
+
+        stacks = {}
+        get_frame = self.frame_indices.get
+        read = self._file.read
+        block_size = self.block_size
+
+        # Events are a header line followed by frame lines, and end with a
+        # blank line
+        pending = ''
+        while True:
+            data = read(block_size)
+            eof = not data
+            if not eof:
+                if '\r' in data:
+                    data = data.replace('\r', '')
+                data = pending + data
+                end = data.rfind('\n\n')
+                if end < 0:
+                    pending = data
+                    continue
+                pending = data[end + 2:]
+                data = data[:end]
+            else:
+                data = pending
+
+            for event in data.split('\n\n'):
+                lines = event.strip('\n').split('\n')
+                callchain = tuple(map(get_frame, lines[1:]))
+                if None in callchain:
+                    # New frames, or comments
+                    callchain = self.parse_event(lines)
+                if callchain:
+                    try:
+                        stacks[callchain] += 1
+                    except KeyError:
+                        stacks[callchain] = 1
+
+            if eof:
+                break
+        return stacks
+
+    def read_shards(self, filename):
+        """Read the stacks of a file in parallel, merging the stack counts
+        of the shards in file order."""
+
+        stacks = {}
+        shards = split_shards(filename, self.jobs, r'\n\r?\n')
+        for keys, shard_stacks in read_shards(read_perf_shard, shards, self.jobs):
+            indices = [self.get_function_index(*key) for key in keys]
+            for callchain, samples in shard_stacks.iteritems():
+                callchain = tuple([indices[index] for index in callchain])
+                try:
+                    stacks[callchain] += samples
+                except KeyError:
+                    stacks[callchain] = samples
+        return stacks
+
+    def parse_event(self, lines):
+        # Skip the comments before the header line
+        start = 0
+        while start < len(lines) and lines[start].startswith('#'):
+            start += 1
+
+        callchain = []
+        for line in lines[start + 1:]:
+            try:
+                index = self.frame_indices[line]
+            except KeyError:
+                index = self.parse_frame(line)
+                if index is None:
+                    continue
+                self.frame_indices[line] = index
+            callchain.append(index)
+        return tuple(callchain)
+
+    def parse_frame(self, line):
+        """Return the index of the function of a frame line, or None for
+        comment lines."""
+
+        if line[0] == '#':
+            return None
+        fields = line.split(None, 1)
+        if len(fields) != 2 or not fields[1].endswith(')'):
+            raise ParseError('unexpected frame', line)
+        address, rest = fields
+        # The symbol and the module may have parenthesis themselves, the
+        # module is the group closed by the last one
+        depth = 0
+        for split in xrange(len(rest) - 1, -1, -1):
+            char = rest[split]
+            if char == ')':
+                depth += 1
+            elif char == '(':
+                depth -= 1
+                if not depth:
+                    break
+        if depth:
+            raise ParseError('unbalanced parenthesis', line)
+        symbol = rest[:split].strip()
+        module = rest[split + 1:-1]
+
+        return self.get_function_index(symbol or address, module)
+
+    def get_function_index(self, function_name, module):
+        """Return the interned index of a function, adding it when new."""
+
+        key = (function_name, module)
+        try:
+            return self.function_indices[key]
+        except KeyError:
+            pass
+
+        function_id = function_name + ':' + module
+        if isinstance(self.profile, CompactProfile):
+            function = self.profile.get_function_index(function_id, function_name, os.path.basename(module))
+            self.profile.add_function_value(function, SAMPLES, 0)
+        else:
+            try:
+                function = self.profile.functions[function_id]
+            except KeyError:
+                function = Function(function_id, function_name)
+                function.module = os.path.basename(module)
+                function[SAMPLES] = 0
+                self.profile.add_function(function)
+
+        index = len(self.functions)
+        self.functions.append(function)
+        self.function_keys.append(key)
+        self.function_indices[key] = index
+        return index
+
+    def add_stacks(self, stacks):
+        """Add the sampled stacks, summing the samples of every function and
+        call before touching the profile."""
+
+        profile = self.profile
+        functions = self.functions
+        compact = isinstance(profile, CompactProfile)
+        if compact:
+            ids = [profile.ids[function] for function in functions]
+        else:
+            ids = [function.id for function in functions]
+
+        total = 0
+        function_samples = [0]*len(functions)
+        call_samples = {}
+        add_stack = profile.add_stack
+        keep_stacks = self.keep_stacks
+        for callchain, samples in stacks.iteritems():
+            total += samples
+            function_samples[callchain[0]] += samples
+            for call in zip(callchain[1:], callchain):
+                try:
+                    call_samples[call] += samples
+                except KeyError:
+                    call_samples[call] = samples
+            if keep_stacks:
+                add_stack(tuple([ids[index] for index in reversed(callchain)]), samples)
+        profile[SAMPLES] += total
+
+        if compact:
+            for index, samples in enumerate(function_samples):
+                if samples:
+                    profile.add_function_value(functions[index], SAMPLES, samples)
+            for (caller, callee), samples in call_samples.iteritems():
+                call = profile.get_call_index(functions[caller], functions[callee])
+                profile.add_call_value(call, SAMPLES2, samples)
+        else:
+            for index, samples in enumerate(function_samples):
+                if samples:
+                    functions[index][SAMPLES] += samples
+            for (caller, callee), samples in call_samples.iteritems():
+                call = Call(ids[callee])
+                call[SAMPLES2] = samples
+                functions[caller].add_call(call)
+
+
+class ElfSymbols:
+    """Function symbols of an ELF file, sorted by address for bisection.
+
+    Tables are cached by file name, size and modification time, as every
+    process of a capture maps the same libraries.
+    """
+
+    cache = {}
+
+    SHT_SYMTAB = 2
+    SHT_DYNSYM = 11
+    STT_FUNC = 2
+    STT_GNU_IFUNC = 10
+    PT_LOAD = 1
+
+    def __init__(self):
+        self.addresses = []
+        self.sizes = []
+        self.names = []
+        # (file offset, file size, virtual address) of the loaded segments
+        self.segments = []
+
+    def get(cls, filename):
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            key = (filename, None, None)
+        else:
+            key = (filename, stat.st_size, stat.st_mtime)
+        try:
+            return cls.cache[key]
+        except KeyError:
+            pass
+        symbols = cls()
+        symbols.read_elf(filename)
+        cls.cache[key] = symbols
+        return symbols
+    get = classmethod(get)
+
+    def read_elf(self, filename):
+        import mmap
+        try:
+            fp = open(filename, 'rb')
+        except IOError:
+            return
+        try:
+            try:
+                data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            except (mmap.error, ValueError):
+                # Empty files, devices
+                return
+            try:
+                self.parse_elf(data)
+            except (struct.error, ValueError):
+                sys.stderr.write('warning: could not read the symbols of %s\n' % filename)
+                self.__init__()
+            finally:
+                data.close()
+        finally:
+            fp.close()
+
+    def parse_elf(self, data):
+        if data[:4] != '\x7fELF':
+            return
+        if data[5] == '\x02':
+            endian = '>'
+        else:
+            endian = '<'
+        if data[4] == '\x02':
+            header_format, program_format, section_format, symbol_format = 'HHIQQQIHHHHHH', 'IIQQQQQQ', 'IIQQQQIIQQ', 'IBBHQQ'
+        else:
+            header_format, program_format, section_format, symbol_format = 'HHIIIIIHHHHHH', 'IIIIIIII', 'IIIIIIIIII', 'IIIBBH'
+        (e_type, e_machine, e_version, e_entry, e_phoff, e_shoff, e_flags, e_ehsize,
+         e_phentsize, e_phnum, e_shentsize, e_shnum, e_shstrndx) = struct.unpack_from(endian + header_format, data, 16)
+
+        for index in xrange(e_phnum):
+            fields = struct.unpack_from(endian + program_format, data, e_phoff + index*e_phentsize)
+            if data[4] == '\x02':
+                p_type, p_flags, p_offset, p_vaddr, p_paddr, p_filesz = fields[:6]
+            else:
+                p_type, p_offset, p_vaddr, p_paddr, p_filesz = fields[:5]
+            if p_type == self.PT_LOAD:
+                self.segments.append((p_offset, p_filesz, p_vaddr))
+
+        sections = [struct.unpack_from(endian + section_format, data, e_shoff + index*e_shentsize)
+                    for index in xrange(e_shnum)]
+
+        # The full symbol table first, stripped files only have the dynamic one
+        symbols = {}
+        symbol_size = struct.calcsize(endian + symbol_format)
+        for section_type in self.SHT_SYMTAB, self.SHT_DYNSYM:
+            for section in sections:
+                sh_type, sh_offset, sh_size, sh_link = section[1], section[4], section[5], section[6]
+                if sh_type != section_type:
+                    continue
+                strings = sections[sh_link][4]
+                for offset in xrange(sh_offset, sh_offset + sh_size, symbol_size):
+                    fields = struct.unpack_from(endian + symbol_format, data, offset)
+                    if data[4] == '\x02':
+                        st_name, st_info, st_other, st_shndx, st_value, st_size = fields
+                    else:
+                        st_name, st_value, st_size, st_info, st_other, st_shndx = fields
+                    if st_info & 0xf not in (self.STT_FUNC, self.STT_GNU_IFUNC) or not st_value or not st_shndx:
+                        continue
+                    if st_value in symbols and symbols[st_value][0]:
+                        continue
+                    start = strings + st_name
+                    symbols[st_value] = (st_size, data[start:data.find('\0', start)])
+        self.set_symbols(symbols)
+
+    def read_kallsyms(self, filename='/proc/kallsyms'):
+        """Read the kernel symbols, which are hidden (null) without privileges."""
+
+        symbols = {}
+        try:
+            fp = open(filename, 'rt')
+        except IOError:
+            return
+        try:
+            for line in fp:
+                fields = line.split()
+                if len(fields) < 3 or fields[1] not in 'tTwW':
+                    continue
+                address = int(fields[0], 16)
+                if address:
+                    symbols.setdefault(address, (0, fields[2]))
+        finally:
+            fp.close()
+        self.set_symbols(symbols)
+
+    def set_symbols(self, symbols):
+        addresses = symbols.keys()
+        addresses.sort()
+        self.addresses = addresses
+        self.sizes = [symbols[address][0] for address in addresses]
+        self.names = [symbols[address][1] for address in addresses]
+
+    def address(self, offset):
+        """Return the virtual address of a file offset, or None."""
+
+        for start, size, address in self.segments:
+            if start <= offset < start + size:
+                return offset - start + address
+        return None
+
+    def lookup(self, address):
+        """Return the name of the function containing an address, or None."""
 
-        mo = self._position_re.match(line)
-        if not mo:
-            return False
+        index = bisect.bisect_right(self.addresses, address) - 1
+        if index < 0:
+            return None
+        size = self.sizes[index]
+        if size and address >= self.addresses[index] + size:
+            return None
+        return self.names[index]
 
-        position, id, name = mo.groups()
-        if id:
-            table = self._position_table_map[position]
-            if name:
-                self.position_ids[(table, id)] = name
-            else:
-                name = self.position_ids.get((table, id), '')
-        self.positions[self._position_map[position]] = name
 
-        self.consume()
-        return True
+class PerfDataParser(PerfParser):
+    """Parser for perf.data files recorded by linux perf, without the perf
+    script text round-trip.
 
-    def parse_empty(self):
-        if self.eof():
-            return False
-        line = self.lookahead()
-        if line.strip():
-            return False
-        self.consume()
-        return True
+        perf record -g
+        gprof2dot.py --format=perfdata perf.data
 
-    def parse_comment(self):
-        line = self.lookahead()
-        if not line.startswith('#'):
-            return False
-        self.consume()
-        return True
+    The file is memory-mapped, and the callchains of the SAMPLE records are
+    decoded directly. Addresses are resolved through the MMAP/MMAP2 records
+    of every process, and the symbol tables of the mapped ELF files, or
+    /proc/kallsyms for the kernel. Unresolved addresses are named
+    [unknown], like perf script does.
+
+    See also:
+    - tools/perf/Documentation/perf.data-file-format.txt in the linux sources
+    """
 
-    _key_re = re.compile(r'^(\w+):')
+    magic = 0x32454c4946524550 # "PERFILE2"
+
+    PERF_RECORD_MMAP = 1
+    PERF_RECORD_COMM = 3
+    PERF_RECORD_FORK = 7
+    PERF_RECORD_SAMPLE = 9
+    PERF_RECORD_MMAP2 = 10
+    PERF_RECORD_HEADER_ATTR = 64
+
+    PERF_RECORD_MISC_CPUMODE_MASK = 7
+    PERF_RECORD_MISC_KERNEL = 1
+    PERF_RECORD_MISC_MMAP_DATA = 1 << 13
+    PERF_RECORD_MISC_COMM_EXEC = 1 << 13
+
+    PERF_SAMPLE_IP = 1 << 0
+    PERF_SAMPLE_TID = 1 << 1
+    PERF_SAMPLE_TIME = 1 << 2
+    PERF_SAMPLE_ADDR = 1 << 3
+    PERF_SAMPLE_READ = 1 << 4
+    PERF_SAMPLE_CALLCHAIN = 1 << 5
+    PERF_SAMPLE_ID = 1 << 6
+    PERF_SAMPLE_CPU = 1 << 7
+    PERF_SAMPLE_PERIOD = 1 << 8
+    PERF_SAMPLE_STREAM_ID = 1 << 9
+    PERF_SAMPLE_IDENTIFIER = 1 << 16
+
+    PERF_FORMAT_TOTAL_TIME_ENABLED = 1 << 0
+    PERF_FORMAT_TOTAL_TIME_RUNNING = 1 << 1
+    PERF_FORMAT_ID = 1 << 2
+    PERF_FORMAT_GROUP = 1 << 3
+    PERF_FORMAT_LOST = 1 << 4
+
+    PERF_CONTEXT_KERNEL = (1 << 64) - 128
+    PERF_CONTEXT_MAX = (1 << 64) - 4095
+
+    PROT_EXEC = 4
+
+    def __init__(self, filename, compact=False):
+        PerfParser.__init__(self, None, compact)
+        self.filename = filename
+
+        # Sample formats, as (sample type, read format), by sample id
+        self.attrs = []
+        self.attr_ids = {}
+
+        # Executable mappings by process id, sorted by start address, as
+        # parallel lists of starts and (end, file offset, file name)
+        self.maps = {}
+        self.kernel_maps = ([], [])
+        self.kernel_symbols = None
+
+        # Function indices of the addresses of every process, -1 for the
+        # context markers of callchains
+        self.address_indices = {}
+
+        # Sample counts of the raw callchains read since the mappings last
+        # changed, by (process id, kernel, callchain bytes)
+        self.pending = {}
+        self.stacks = {}
+
+    def read_stacks(self):
+        import mmap
+        fp = open_input(self.filename)
+        try:
+            if isinstance(fp, DecompressedFile):
+                # Records are decoded in place, so compressed files are
+                # decompressed in memory
+                stacks = self.read_records(fp.read())
+            else:
+                try:
+                    data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+                except (mmap.error, ValueError):
+                    raise ParseError('empty or unreadable perf.data file', self.filename)
+                try:
+                    stacks = self.read_records(data)
+                finally:
+                    data.close()
+        finally:
+            fp.close()
+        self.demangle()
+        return stacks
+
+    def read_records(self, data):
+        if len(data) < 16 or struct.unpack_from('<Q', data, 0)[0] != self.magic:
+            raise ParseError('not a little endian perf.data file', self.filename)
+        header_size, attr_size = struct.unpack_from('<QQ', data, 8)
+        if header_size == 16:
+            # Piped output, the attributes are records as well
+            data_offset, data_size = 16, len(data) - 16
+        else:
+            attrs_offset, attrs_size, data_offset, data_size = struct.unpack_from('<QQQQ', data, 24)
+            for offset in xrange(attrs_offset, attrs_offset + attrs_size, attr_size):
+                ids_offset, ids_size = struct.unpack_from('<QQ', data, offset + attr_size - 16)
+                ids = struct.unpack_from('<%dQ' % (ids_size // 8), data, ids_offset)
+                self.add_attr(data, offset, ids)
+
+        pending = self.pending
+        unpack_from = struct.unpack_from
+        position = data_offset
+        end = min(data_offset + data_size, len(data))
+        while position + 8 <= end:
+            record_type, misc, size = unpack_from('<IHH', data, position)
+            if size < 8:
+                raise ParseError('invalid record size', position)
+            if record_type == self.PERF_RECORD_SAMPLE:
+                key = self.parse_sample(data, position, misc)
+                try:
+                    pending[key] += 1
+                except KeyError:
+                    pending[key] = 1
+            elif record_type == self.PERF_RECORD_MMAP:
+                if not misc & self.PERF_RECORD_MISC_MMAP_DATA:
+                    pid, tid, start, length, pgoff = unpack_from('<IIQQQ', data, position + 8)
+                    self.add_map(pid, start, length, pgoff, self.read_string(data, position + 40, position + size))
+            elif record_type == self.PERF_RECORD_MMAP2:
+                pid, tid, start, length, pgoff = unpack_from('<IIQQQ', data, position + 8)
+                prot, = unpack_from('<I', data, position + 64)
+                if prot & self.PROT_EXEC:
+                    self.add_map(pid, start, length, pgoff, self.read_string(data, position + 72, position + size))
+            elif record_type == self.PERF_RECORD_COMM:
+                pid, tid = unpack_from('<II', data, position + 8)
+                if misc & self.PERF_RECORD_MISC_COMM_EXEC and pid == tid:
+                    # The process image was replaced
+                    self.flush()
+                    self.maps.pop(pid, None)
+            elif record_type == self.PERF_RECORD_FORK:
+                pid, ppid = unpack_from('<II', data, position + 8)
+                if pid != ppid and ppid in self.maps and pid not in self.maps:
+                    starts, entries = self.maps[ppid]
+                    self.maps[pid] = (list(starts), list(entries))
+            elif record_type == self.PERF_RECORD_HEADER_ATTR:
+                attr_size, = unpack_from('<I', data, position + 12)
+                ids_offset = position + 8 + attr_size
+                ids = unpack_from('<%dQ' % ((position + size - ids_offset) // 8), data, ids_offset)
+                self.add_attr(data, position + 8, ids)
+            position += size
+        self.flush()
+        return self.stacks
+
+    def add_attr(self, data, offset, ids):
+        sample_type, read_format = struct.unpack_from('<QQ', data, offset + 24)
+        attr = (sample_type, read_format)
+        self.attrs.append(attr)
+        for id in ids:
+            self.attr_ids[id] = attr
+
+    def get_attr(self, data, position):
+        attrs = self.attrs
+        if not attrs:
+            raise ParseError('sample without event attributes', position)
+        attr = attrs[0]
+        if len(attrs) > 1 and attr[0] & self.PERF_SAMPLE_IDENTIFIER:
+            id, = struct.unpack_from('<Q', data, position + 8)
+            attr = self.attr_ids.get(id, attr)
+        elif len(attrs) > 1 and len(set(attrs)) > 1:
+            raise ParseError('events with different sample formats need PERF_SAMPLE_IDENTIFIER', position)
+        return attr
+
+    def parse_sample(self, data, position, misc):
+        """Return the process id, execution mode and raw callchain of a
+        sample."""
+
+        unpack_from = struct.unpack_from
+        sample_type, read_format = self.get_attr(data, position)
+
+        offset = position + 8
+        if sample_type & self.PERF_SAMPLE_IDENTIFIER:
+            offset += 8
+        ip = None
+        if sample_type & self.PERF_SAMPLE_IP:
+            ip, = unpack_from('<Q', data, offset)
+            offset += 8
+        pid = None
+        if sample_type & self.PERF_SAMPLE_TID:
+            pid, tid = unpack_from('<II', data, offset)
+            offset += 8
+        for flag in self.PERF_SAMPLE_TIME, self.PERF_SAMPLE_ADDR, self.PERF_SAMPLE_ID, self.PERF_SAMPLE_STREAM_ID, self.PERF_SAMPLE_CPU, self.PERF_SAMPLE_PERIOD:
+            if sample_type & flag:
+                offset += 8
+        if sample_type & self.PERF_SAMPLE_READ:
+            offset += self.read_size(data, offset, read_format)
+
+        kernel = misc & self.PERF_RECORD_MISC_CPUMODE_MASK == self.PERF_RECORD_MISC_KERNEL
+        if sample_type & self.PERF_SAMPLE_CALLCHAIN:
+            nr, = unpack_from('<Q', data, offset)
+            ips = data[offset + 8:offset + 8 + nr*8]
+        elif ip is not None:
+            ips = struct.pack('<Q', ip)
+        else:
+            ips = ''
+        return pid, kernel, ips
 
-    def parse_key(self, key):
-        pair = self.parse_keys((key,))
-        if not pair:
-            return None
-        key, value = pair
-        return value
-        line = self.lookahead()
-        mo = self._key_re.match(line)
-        if not mo:
-            return None
-        key, value = line.split(':', 1)
-        if key not in keys:
-            return None
-        value = value.strip()
-        self.consume()
-        return key, value
+    def flush(self):
+        """Resolve the pending callchains with the current mappings."""
 
-    def parse_keys(self, keys):
-        line = self.lookahead()
-        mo = self._key_re.match(line)
-        if not mo:
-            return None
-        key, value = line.split(':', 1)
-        if key not in keys:
-            return None
-        value = value.strip()
-        self.consume()
-        return key, value
+        stacks = self.stacks
+        for (pid, kernel, ips), count in self.pending.iteritems():
+            callchain = self.resolve_callchain(pid, kernel, ips)
+            if callchain:
+                try:
+                    stacks[callchain] += count
+                except KeyError:
+                    stacks[callchain] = count
+        self.pending.clear()
+        self.address_indices.clear()
+
+    def resolve_callchain(self, pid, kernel, ips):
+        """Return a raw callchain as function indices, innermost function
+        first."""
 
-    def make_function(self, module, filename, name):
-        # FIXME: module and filename are not being tracked reliably
-        #id = '|'.join((module, filename, name))
-        id = name
         try:
-            function = self.profile.functions[id]
+            indices = self.address_indices[pid]
         except KeyError:
-            function = Function(id, name)
-            if module:
-                function.module = os.path.basename(module)
-            function[SAMPLES] = 0
-            function.called = 0
-            self.profile.add_function(function)
-        return function
+            indices = self.address_indices[pid] = {}
+        addresses = struct.unpack('<%dQ' % (len(ips) // 8), ips)
+        callchain = map(indices.get, addresses)
+        if None in callchain:
+            # Kernel and user addresses do not overlap, so the mode only
+            # matters to resolve new addresses
+            for i in xrange(len(addresses)):
+                ip = addresses[i]
+                if ip >= self.PERF_CONTEXT_MAX:
+                    kernel = ip == self.PERF_CONTEXT_KERNEL
+                    indices[ip] = -1
+                elif callchain[i] is None:
+                    indices[ip] = self.resolve(pid, ip, kernel)
+            callchain = map(indices.get, addresses)
+        if -1 in callchain:
+            callchain = [index for index in callchain if index >= 0]
+        return tuple(callchain)
+
+    def read_size(self, data, offset, read_format):
+        """Size of the counter values of a sample."""
+
+        size = 8
+        for flag in self.PERF_FORMAT_TOTAL_TIME_ENABLED, self.PERF_FORMAT_TOTAL_TIME_RUNNING:
+            if read_format & flag:
+                size += 8
+        value_size = 8
+        for flag in self.PERF_FORMAT_ID, self.PERF_FORMAT_LOST:
+            if read_format & flag:
+                value_size += 8
+        if read_format & self.PERF_FORMAT_GROUP:
+            nr, = struct.unpack_from('<Q', data, offset)
+            return size + nr*value_size
+        return size + value_size - 8
+
+    def read_string(self, data, start, end):
+        null = data.find('\0', start, end)
+        if null < 0:
+            null = end
+        return data[start:null]
+
+    def add_map(self, pid, start, length, pgoff, filename):
+        self.flush()
+        if pid == 0xffffffff:
+            starts, entries = self.kernel_maps
+        else:
+            try:
+                starts, entries = self.maps[pid]
+            except KeyError:
+                starts, entries = self.maps[pid] = ([], [])
+        index = bisect.bisect_left(starts, start)
+        entry = (start + length, pgoff, filename)
+        if index < len(starts) and starts[index] == start:
+            entries[index] = entry
+        else:
+            starts.insert(index, start)
+            entries.insert(index, entry)
+
+    def find_map(self, maps, ip):
+        starts, entries = maps
+        index = bisect.bisect_right(starts, ip) - 1
+        if index >= 0 and ip < entries[index][0]:
+            return starts[index], entries[index]
+        return None
 
-    def get_function(self):
-        module = self.positions.get('ob', '')
-        filename = self.positions.get('fl', '') 
-        function = self.positions.get('fn', '') 
-        return self.make_function(module, filename, function)
+    def resolve(self, pid, ip, kernel):
+        """Return the function index of an address."""
 
-    def get_callee(self):
-        module = self.positions.get('cob', '')
-        filename = self.positions.get('cfi', '') 
-        function = self.positions.get('cfn', '') 
-        return self.make_function(module, filename, function)
+        if kernel:
+            found = self.find_map(self.kernel_maps, ip)
+        else:
+            found = self.find_map(self.maps.get(pid, ([], [])), ip)
+            if found is None:
+                found = self.find_map(self.kernel_maps, ip)
+        if found is None:
+            return self.get_function_index('[unknown]', '[unknown]')
+
+        start, (end, pgoff, filename) = found
+        if filename.startswith('[kernel.kallsyms]'):
+            if self.kernel_symbols is None:
+                self.kernel_symbols = ElfSymbols()
+                self.kernel_symbols.read_kallsyms()
+            name = self.kernel_symbols.lookup(ip)
+            module = '[kernel.kallsyms]'
+        else:
+            symbols = ElfSymbols.get(filename)
+            address = symbols.address(ip - start + pgoff)
+            name = None
+            if address is not None:
+                name = symbols.lookup(address)
+            module = filename
+        if name is None:
+            name = '[unknown]'
+        return self.get_function_index(name, module)
+
+    def demangle(self):
+        """Demangle the C++ function names with c++filt, when available."""
+
+        keys = [key for key in self.function_keys if key[0].startswith('_Z')]
+        if not keys:
+            return
+        import subprocess
+        try:
+            process = subprocess.Popen(['c++filt'], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+            output = process.communicate('\n'.join([name for name, module in keys]) + '\n')[0]
+        except OSError:
+            return
+        names = output.splitlines()
+        if process.returncode or len(names) != len(keys):
+            return
+        for (mangled, module), name in zip(keys, names):
+            self.profile.functions[mangled + ':' + module].name = name
 
 
-class PerfParser(LineParser):
-    """Parser for linux perf callgraph output.
+class CollapsedParser(LineParser):
+    """Parser for collapsed (folded) stacks.
 
-    It expects output generated with
+    Every line is a stack of function names separated by semicolons, outermost
+    caller first, followed by its sample count, as written by the
+    stackcollapse scripts of the FlameGraph tools or by FoldedWriter.
 
-        perf record -g
-        perf script | gprof2dot.py --format=perf
+    See also:
+    - http://www.brendangregg.com/flamegraphs.html
     """
 
     def __init__(self, infile):
         LineParser.__init__(self, infile)
         self.profile = Profile()
 
-    def readline(self):
-        # Override LineParser.readline to ignore comment lines
-        while True:
-            LineParser.readline(self)
-            if self.eof() or not self.lookahead().startswith('#'):
-                break
-
     def parse(self):
-        # read lookahead
-        self.readline()
-
         profile = self.profile
         profile[SAMPLES] = 0
+
+        # read lookahead
+        self.readline()
         while not self.eof():
-            self.parse_event()
+            line = self.consume().rstrip()
+            if not line or line.startswith('#'):
+                continue
+            fields = line.rsplit(None, 1)
+            if len(fields) != 2:
+                raise ParseError('expected a stack and a sample count', line)
+            stack, count = fields
+            try:
+                count = int(count)
+            except ValueError:
+                try:
+                    count = float(count)
+                except ValueError:
+                    raise ParseError('expected a stack and a sample count', line)
+            self.parse_stack(stack.split(';'), count)
 
         # compute derived data
         profile.validate()
@@ -1428,70 +3649,123 @@ class PerfParser(LineParser):
 
         return profile
 
-    def parse_event(self):
-        if self.eof():
-            return
-
-        line = self.consume()
-        assert line
-
-        callchain = self.parse_callchain()
-        if not callchain:
-            return
-
-        callee = callchain[0]
-        callee[SAMPLES] += 1
-        self.profile[SAMPLES] += 1
-
-        for caller in callchain[1:]:
+    def parse_stack(self, names, samples):
+        profile = self.profile
+        callchain = [self.get_function(name) for name in names]
+        if self.keep_stacks:
+            profile.add_stack(tuple(names), samples)
+        profile[SAMPLES] += samples
+
+        callee = callchain[-1]
+        callee[SAMPLES] += samples
+        for caller in reversed(callchain[:-1]):
             try:
                 call = caller.calls[callee.id]
             except KeyError:
                 call = Call(callee.id)
-                call[SAMPLES2] = 1
+                call[SAMPLES2] = samples
                 caller.add_call(call)
             else:
-                call[SAMPLES2] += 1
-
+                call[SAMPLES2] += samples
             callee = caller
 
-    def parse_callchain(self):
-        callchain = []
-        while self.lookahead():
-            function = self.parse_call()
-            if function is None:
-                break
-            callchain.append(function)
-        if self.lookahead() == '':
-            self.consume()
-        return callchain
+    def get_function(self, name):
+        try:
+            return self.profile.functions[name]
+        except KeyError:
+            function = Function(name, name)
+            function[SAMPLES] = 0
+            self.profile.add_function(function)
+            return function
 
-    call_re = re.compile(r'^\s+(?P<address>[0-9a-fA-F]+)\s+(?P<symbol>.*)\s+\((?P<module>[^)]*)\)$')
 
-    def parse_call(self):
-        line = self.consume()
-        mo = self.call_re.match(line)
-        assert mo
-        if not mo:
-            return None
+class SnapshotParser(LineParser):
+    """Parser for the stack trie snapshots written by debug.profile.ContinuousProfiler.
 
-        function_name = mo.group('symbol')
-        if not function_name:
-            function_name = mo.group('address')
+    Function names are listed once with "fn <index> <name>" lines, and every
+    "node <parent> <fn index> <samples>" line adds a trie node, numbered from 1
+    in order of appearance, node 0 being the implicit root.
+    """
 
-        module = mo.group('module')
+    def __init__(self, infile):
+        LineParser.__init__(self, infile)
+        self.profile = Profile()
 
-        function_id = function_name + ':' + module
+    def parse(self):
+        names = {}
+        parents = [-1]
+        node_functions = [None]
+        node_samples = [0]
+        keep_stacks = self.keep_stacks
 
-        try:
-            function = self.profile.functions[function_id]
-        except KeyError:
-            function = Function(function_id, function_name)
-            function.module = os.path.basename(module)
-            function[SAMPLES] = 0
-            self.profile.add_function(function)
+        profile = self.profile
+        profile[SAMPLES] = 0
 
-        return function
+        # read lookahead
+        self.readline()
+        while not self.eof():
+            line = self.consume()
+            if not line or line.startswith('#'):
+                continue
+            fields = line.split(' ', 3)
+            if fields[0] == 'fn':
+                name = line.split(' ', 2)[2]
+                try:
+                    function = profile.functions[name]
+                except KeyError:
+                    function = Function(name, name)
+                    function[SAMPLES] = 0
+                    profile.add_function(function)
+                names[fields[1]] = function
+            elif fields[0] == 'node':
+                parent, index, samples = fields[1:4]
+                function = names[index]
+                samples = int(samples)
+                parents.append(int(parent))
+                node_functions.append(function)
+                node_samples.append(samples)
+                if samples and keep_stacks:
+                    # Walk up to the root rather than keeping the stack of
+                    # every node
+                    stack = []
+                    node = len(parents) - 1
+                    while node:
+                        stack.append(node_functions[node].id)
+                        node = parents[node]
+                    stack.reverse()
+                    profile.add_stack(tuple(stack), samples)
+                function[SAMPLES] += samples
+                profile[SAMPLES] += samples
+            else:
+                raise ParseError('unexpected line', line)
+
+        # Every trie edge is taken by all the samples below its child node,
+        # and parents always precede their children
+        inclusive = list(node_samples)
+        for node in xrange(len(parents) - 1, 0, -1):
+            parent = parents[node]
+            inclusive[parent] += inclusive[node]
+            if parent == 0:
+                continue
+            caller = node_functions[parent]
+            callee = node_functions[node]
+            try:
+                call = caller.calls[callee.id]
+            except KeyError:
+                call = Call(callee.id)
+                call[SAMPLES2] = inclusive[node]
+                caller.add_call(call)
+            else:
+                call[SAMPLES2] += inclusive[node]
+
+        # compute derived data
+        profile.validate()
+        profile.find_cycles()
+        profile.ratio(TIME_RATIO, SAMPLES)
+        profile.call_ratios(SAMPLES2)
+        profile.integrate(TOTAL_TIME_RATIO, TIME_RATIO)
+
+        return profile
 
 
 class OprofileParser(LineParser):
@@ -1762,121 +4036,157 @@ class HProfParser(LineParser):
             self.consume()
 
 
-class SysprofParser(XmlParser):
+class SysprofParser(Parser):
+    """Parser for sysprof XML captures.
+
+    The capture is read with iterparse, and every object and node is
+    cleared once handled. Functions are built as objects are read, and
+    calls as soon as the caller of a node is known, so only the object and
+    nearest real caller of every node are kept. Nodes written before the
+    objects are held until the objects have been read.
+    """
 
     def __init__(self, stream):
-        XmlParser.__init__(self, stream)
+        Parser.__init__(self)
+        self.stream = stream
 
     def parse(self):
-        objects = {}
-        nodes = {}
-
-        self.element_start('profile')
-        while self.token.type == XML_ELEMENT_START:
-            if self.token.name_or_data == 'objects':
-                assert not objects
-                objects = self.parse_items('objects')
-            elif self.token.name_or_data == 'nodes':
-                assert not nodes
-                nodes = self.parse_items('nodes')
-            else:
-                self.parse_value(self.token.name_or_data)
-        self.element_end('profile')
-
-        return self.build_profile(objects, nodes)
-
-    def parse_items(self, name):
-        assert name[-1] == 's'
-        items = {}
-        self.element_start(name)
-        while self.token.type == XML_ELEMENT_START:
-            id, values = self.parse_item(name[:-1])
-            assert id not in items
-            items[id] = values
-        self.element_end(name)
-        return items
-
-    def parse_item(self, name):
-        attrs = self.element_start(name)
-        id = int(attrs['id'])
-        values = self.parse_values()
-        self.element_end(name)
-        return id, values
-
-    def parse_values(self):
-        values = {}
-        while self.token.type == XML_ELEMENT_START:
-            name = self.token.name_or_data
-            value = self.parse_value(name)
-            assert name not in values
-            values[name] = value
-        return values
-
-    def parse_value(self, tag):
-        self.element_start(tag)
-        value = self.character_data()
-        self.element_end(tag)
-        if value.isdigit():
-            return int(value)
-        if value.startswith('"') and value.endswith('"'):
-            return value[1:-1]
-        return value
-
-    def build_profile(self, objects, nodes):
         profile = Profile()
-        
         profile[SAMPLES] = 0
-        for id, object in objects.iteritems():
-            # Ignore fake objects (process names, modules, "Everything", "kernel", etc.)
-            if object['self'] == 0:
-                continue
 
-            function = Function(id, object['name'])
-            function[SAMPLES] = object['self']
-            profile.add_function(function)
-            profile[SAMPLES] += function[SAMPLES]
+        # Object of the nearest ancestor (or self) of every node whose object
+        # is a real function, or None
+        self.callers = {}
+        # (object, parent, samples) of the nodes whose parent was not read yet
+        self.pending = {}
+        # (id, object, parent, samples) of the nodes read before the objects
+        self.early_nodes = []
+        self.objects_read = False
+
+        context = iter(ElementTree.iterparse(self.stream, events=('start', 'end')))
+        event, root = context.next()
+        if root.tag != 'profile':
+            raise ParseError('not a sysprof profile', root.tag)
+        items = root
+        for event, element in context:
+            tag = element.tag
+            if event == 'start':
+                if tag == 'objects' or tag == 'nodes':
+                    items = element
+            elif tag == 'objects':
+                self.objects_read = True
+                for node in self.early_nodes:
+                    self.add_node(profile, *node)
+                self.early_nodes = []
+            elif tag == 'object' and items.tag == 'objects':
+                self.parse_object(profile, element)
+                items.clear()
+            elif tag == 'node' and items.tag == 'nodes':
+                self.parse_node(profile, element)
+                items.clear()
+        root.clear()
+        if self.early_nodes:
+            raise ParseError('sysprof profile without objects', 'nodes')
+
+        for id in self.pending.keys():
+            self.resolve_pending(profile, id)
+        for id, (object_id, parent_id, samples) in self.pending.iteritems():
+            if samples:
+                self.add_call(profile, object_id, parent_id, samples)
+        self.pending = {}
 
-        for id, node in nodes.iteritems():
-            # Ignore fake calls
-            if node['self'] == 0:
-                continue
+        # Compute derived events
+        profile.validate()
+        profile.find_cycles()
+        profile.ratio(TIME_RATIO, SAMPLES)
+        profile.call_ratios(SAMPLES2)
+        profile.integrate(TOTAL_TIME_RATIO, TIME_RATIO)
 
-            # Find a non-ignored parent
-            parent_id = node['parent']
-            while parent_id != 0:
-                parent = nodes[parent_id]
-                caller_id = parent['object']
-                if objects[caller_id]['self'] != 0:
-                    break
-                parent_id = parent['parent']
-            if parent_id == 0:
-                continue
+        return profile
+
+    def parse_value(self, element, tag):
+        value = (element.findtext(tag) or '').strip()
+        if value.isdigit():
+            return int(value)
+        if value.startswith('"') and value.endswith('"'):
+            return value[1:-1]
+        return value
 
-            callee_id = node['object']
+    def parse_object(self, profile, element):
+        # Ignore fake objects (process names, modules, "Everything", "kernel", etc.)
+        samples = self.parse_value(element, 'self')
+        if samples == 0:
+            return
+        function = Function(int(element.get('id')), self.parse_value(element, 'name'))
+        function[SAMPLES] = samples
+        profile.add_function(function)
+        profile[SAMPLES] += samples
+
+    def parse_node(self, profile, element):
+        node = (
+            int(element.get('id')),
+            self.parse_value(element, 'object'),
+            self.parse_value(element, 'parent'),
+            self.parse_value(element, 'self'),
+        )
+        if self.objects_read:
+            self.add_node(profile, *node)
+        else:
+            self.early_nodes.append(node)
 
-            assert objects[caller_id]['self']
-            assert objects[callee_id]['self']
+    def add_node(self, profile, id, object_id, parent_id, samples):
+        if parent_id != 0 and parent_id not in self.callers:
+            self.pending[id] = object_id, parent_id, samples
+            return
+        self.callers[id] = self.get_caller(profile, object_id, parent_id)
+        # Ignore fake calls
+        if samples:
+            self.add_call(profile, object_id, parent_id, samples)
+
+    def get_caller(self, profile, object_id, parent_id):
+        if object_id in profile.functions:
+            return object_id
+        if parent_id == 0:
+            return None
+        return self.callers[parent_id]
 
-            function = profile.functions[caller_id]
+    def resolve_pending(self, profile, id):
+        """Find the callers of a node read before its parent, and of its
+        ancestors."""
 
-            samples = node['self']
+        path = []
+        while id not in self.callers:
+            path.append(id)
             try:
-                call = function.calls[callee_id]
+                object_id, parent_id, samples = self.pending[id]
             except KeyError:
-                call = Call(callee_id)
-                call[SAMPLES2] = samples
-                function.add_call(call)
-            else:
-                call[SAMPLES2] += samples
+                raise ParseError('unknown parent node', id)
+            if parent_id == 0:
+                break
+            id = parent_id
+        for id in reversed(path):
+            object_id, parent_id, samples = self.pending[id]
+            self.callers[id] = self.get_caller(profile, object_id, parent_id)
+
+    def add_call(self, profile, callee_id, parent_id, samples):
+        # Find a non-ignored parent
+        if parent_id == 0:
+            return
+        caller_id = self.callers[parent_id]
+        if caller_id is None:
+            return
 
-        # Compute derived events
-        profile.validate()
-        profile.find_cycles()
-        profile.ratio(TIME_RATIO, SAMPLES)
-        profile.call_ratios(SAMPLES2)
-        profile.integrate(TOTAL_TIME_RATIO, TIME_RATIO)
+        assert callee_id in profile.functions
 
-        return profile
+        function = profile.functions[caller_id]
+        try:
+            call = function.calls[callee_id]
+        except KeyError:
+            call = Call(callee_id)
+            call[SAMPLES2] = samples
+            function.add_call(call)
+        else:
+            call[SAMPLES2] += samples
 
 
 class SharkParser(LineParser):
@@ -1974,18 +4284,76 @@ class SharkParser(LineParser):
         return profile
 
 
+def read_xperf_shard(shard):
+    """Parse a byte range of an XPerf CSV file, in a worker process.
+
+    Returns the samples and count of every process stack, see
+    XPerfParser.read_rows.
+    """
+
+    filename, start, end = shard
+    fp = FileRange(filename, start, end)
+    try:
+        parser = XPerfParser(fp)
+        if start > 0:
+            # Only the first shard has the header row
+            header = open(filename, 'rb')
+            try:
+                parser.stream = itertools.chain([header.readline()], fp)
+            finally:
+                header.close()
+        return parser.read_rows()
+    finally:
+        fp.close()
+
+
 class XPerfParser(Parser):
     """Parser for CSVs generted by XPerf, from Microsoft Windows Performance Tools.
+
+    Rows are summed by process and stack first, and the profile is built
+    from these totals. With jobs > 1, a file is split into shards of rows
+    which are read by worker processes.
     """
 
-    def __init__(self, stream):
+    def __init__(self, stream, jobs=1):
         Parser.__init__(self)
         self.stream = stream
+        self.jobs = jobs
         self.profile = Profile()
         self.profile[SAMPLES] = 0
         self.column = {}
 
-    def parse(self):
+    def parse(self):
+        filename = shard_filename(self.stream, self.jobs)
+        if filename is not None:
+            stacks = {}
+            shards = split_shards(filename, self.jobs, r'\n')
+            for shard_stacks in read_shards(read_xperf_shard, shards, self.jobs):
+                for key, (samples, count) in shard_stacks.iteritems():
+                    try:
+                        totals = stacks[key]
+                    except KeyError:
+                        stacks[key] = [samples, count]
+                    else:
+                        totals[0] += samples
+                        totals[1] += count
+        else:
+            stacks = self.read_rows()
+        self.add_stacks(stacks)
+
+        # compute derived data
+        self.profile.validate()
+        self.profile.find_cycles()
+        self.profile.ratio(TIME_RATIO, SAMPLES)
+        self.profile.call_ratios(SAMPLES2)
+        self.profile.integrate(TOTAL_TIME_RATIO, TIME_RATIO)
+
+        return self.profile
+
+    def read_rows(self):
+        """Return the [samples, count] totals of the rows, keyed by process and
+        by stack of symbols, outermost caller first."""
+
         import csv
         reader = csv.reader(
             self.stream, 
@@ -1997,19 +4365,12 @@ class XPerfParser(Parser):
             lineterminator = '\r\n',
             quoting = csv.QUOTE_NONE)
         it = iter(reader)
-        row = reader.next()
+        row = it.next()
         self.parse_header(row)
+        stacks = {}
         for row in it:
-            self.parse_row(row)
-                
-        # compute derived data
-        self.profile.validate()
-        self.profile.find_cycles()
-        self.profile.ratio(TIME_RATIO, SAMPLES)
-        self.profile.call_ratios(SAMPLES2)
-        self.profile.integrate(TOTAL_TIME_RATIO, TIME_RATIO)
-
-        return self.profile
+            self.parse_row(row, stacks)
+        return stacks
 
     def parse_header(self, row):
         for column in range(len(row)):
@@ -2017,7 +4378,7 @@ class XPerfParser(Parser):
             assert name not in self.column
             self.column[name] = column
 
-    def parse_row(self, row):
+    def parse_row(self, row, stacks):
         fields = {}
         for name, column in self.column.iteritems():
             value = row[column]
@@ -2035,29 +4396,47 @@ class XPerfParser(Parser):
         weight = fields['Weight']
         count = fields['Count']
 
-        function = self.get_function(process, symbol)
-        function[SAMPLES] += weight * count
-        self.profile[SAMPLES] += weight * count
-
         stack = fields['Stack']
-        if stack != '?':
+        if stack == '?':
+            symbols = (symbol,)
+        else:
             stack = stack.split('/')
             assert stack[0] == '[Root]'
             if stack[-1] != symbol:
                 # XXX: some cases the sampled function does not appear in the stack
                 stack.append(symbol)
-            caller = None
-            for symbol in stack[1:]:
-                callee = self.get_function(process, symbol)
-                if caller is not None:
-                    try:
-                        call = caller.calls[callee.id]
-                    except KeyError:
-                        call = Call(callee.id)
-                        call[SAMPLES2] = count
-                        caller.add_call(call)
-                    else:
-                        call[SAMPLES2] += count
+            symbols = tuple(stack[1:])
+
+        key = (process, symbols)
+        try:
+            totals = stacks[key]
+        except KeyError:
+            stacks[key] = [weight * count, count]
+        else:
+            totals[0] += weight * count
+            totals[1] += count
+
+    def add_stacks(self, stacks):
+        profile = self.profile
+        for (process, symbols), (samples, count) in stacks.iteritems():
+            functions = [self.get_function(process, symbol) for symbol in symbols]
+
+            # The sampled function is the innermost one
+            functions[-1][SAMPLES] += samples
+            profile[SAMPLES] += samples
+            if self.keep_stacks:
+                profile.add_stack(tuple([function.id for function in functions]), samples)
+
+            caller = functions[0]
+            for callee in functions[1:]:
+                try:
+                    call = caller.calls[callee.id]
+                except KeyError:
+                    call = Call(callee.id)
+                    call[SAMPLES2] = count
+                    caller.add_call(call)
+                else:
+                    call[SAMPLES2] += count
                 caller = callee
 
     def get_function(self, process, symbol):
@@ -2141,6 +4520,8 @@ class SleepyParser(Parser):
             callstack = fields[1:]
 
             callstack = [self.symbols[symbol_id] for symbol_id in callstack]
+            if self.keep_stacks:
+                self.profile.add_stack(tuple([function.id for function in reversed(callstack)]), samples)
 
             callee = callstack[0]
 
@@ -2176,110 +4557,79 @@ class SleepyParser(Parser):
         return profile
 
 
-class AQtimeTable:
-
-    def __init__(self, name, fields):
-        self.name = name
-
-        self.fields = fields
-        self.field_column = {}
-        for column in range(len(fields)):
-            self.field_column[fields[column]] = column
-        self.rows = []
-
-    def __len__(self):
-        return len(self.rows)
-
-    def __iter__(self):
-        for values, children in self.rows:
-            fields = {}
-            for name, value in zip(self.fields, values):
-                fields[name] = value
-            children = dict([(child.name, child) for child in children])
-            yield fields, children
-        raise StopIteration
-
-    def add_row(self, values, children=()):
-        self.rows.append((values, children))
-
+class AQtimeParser(Parser):
+    """Parser for AQtime XML results.
 
-class AQtimeParser(XmlParser):
+    The results are read with iterparse. Every routine is built with its
+    calls as soon as its row ends, and the row is cleared.
+    """
 
     def __init__(self, stream):
-        XmlParser.__init__(self, stream)
+        Parser.__init__(self)
+        self.stream = stream
         self.tables = {}
 
     def parse(self):
-        self.element_start('AQtime_Results')
-        self.parse_headers()
-        results = self.parse_results()
-        self.element_end('AQtime_Results')
-        return self.build_profile(results) 
-
-    def parse_headers(self):
-        self.element_start('HEADERS')
-        while self.token.type == XML_ELEMENT_START:
-            self.parse_table_header()
-        self.element_end('HEADERS')
-
-    def parse_table_header(self):
-        attrs = self.element_start('TABLE_HEADER')
-        name = attrs['NAME']
-        id = int(attrs['ID'])
+        profile = Profile()
+        profile[TIME] = 0.0
+
+        # Tables of the DATA elements being read, outermost first
+        tables = []
+        datas = []
+        calls = []
+        context = iter(ElementTree.iterparse(self.stream, events=('start', 'end')))
+        event, root = context.next()
+        if root.tag != 'AQtime_Results':
+            raise ParseError('not AQtime results', root.tag)
+        for event, element in context:
+            tag = element.tag
+            if event == 'start':
+                if tag == 'DATA':
+                    tables.append(self.tables[int(element.get('TABLE_ID'))])
+                    datas.append(element)
+            elif tag == 'ROW':
+                table_name, field_types, field_names = tables[-1]
+                fields = self.parse_row(element, field_types, field_names)
+                if len(tables) == 1:
+                    assert table_name == 'Routines'
+                    function = self.build_function(fields)
+                    for call in calls:
+                        function.add_call(call)
+                    calls = []
+                    profile.add_function(function)
+                    profile[TIME] = profile[TIME] + function[TIME]
+                    datas[-1].clear()
+                elif len(tables) == 2 and table_name == 'Children':
+                    calls.append(self.build_call(fields))
+            elif tag == 'DATA':
+                tables.pop()
+                datas.pop()
+            elif tag == 'TABLE_HEADER':
+                self.parse_table_header(element)
+        root.clear()
+
+        profile[TOTAL_TIME] = profile[TIME]
+        profile.ratio(TOTAL_TIME_RATIO, TOTAL_TIME)
+        return profile
+
+    def parse_table_header(self, element):
+        name = element.get('NAME')
+        id = int(element.get('ID'))
         field_types = []
         field_names = []
-        while self.token.type == XML_ELEMENT_START:
-            field_type, field_name = self.parse_table_field()
-            field_types.append(field_type)
-            field_names.append(field_name)
-        self.element_end('TABLE_HEADER')
+        for field in element.findall('TABLE_FIELD'):
+            field_types.append(field.get('TYPE'))
+            field_names.append((field.text or '').strip())
         self.tables[id] = name, field_types, field_names
 
-    def parse_table_field(self):
-        attrs = self.element_start('TABLE_FIELD')
-        type = attrs['TYPE']
-        name = self.character_data()
-        self.element_end('TABLE_FIELD')
-        return type, name
-
-    def parse_results(self):
-        self.element_start('RESULTS')
-        table = self.parse_data()
-        self.element_end('RESULTS')
-        return table
-
-    def parse_data(self):
-        rows = []
-        attrs = self.element_start('DATA')
-        table_id = int(attrs['TABLE_ID'])
-        table_name, field_types, field_names = self.tables[table_id]
-        table = AQtimeTable(table_name, field_names)
-        while self.token.type == XML_ELEMENT_START:
-            row, children = self.parse_row(field_types)
-            table.add_row(row, children)
-        self.element_end('DATA')
-        return table
-
-    def parse_row(self, field_types):
-        row = [None]*len(field_types)
-        children = []
-        self.element_start('ROW')
-        while self.token.type == XML_ELEMENT_START:
-            if self.token.name_or_data == 'FIELD':
-                field_id, field_value = self.parse_field(field_types)
-                row[field_id] = field_value
-            elif self.token.name_or_data == 'CHILDREN':
-                children = self.parse_children()
-            else:
-                raise XmlTokenMismatch("<FIELD ...> or <CHILDREN ...>", self.token)
-        self.element_end('ROW')
-        return row, children
-
-    def parse_field(self, field_types):
-        attrs = self.element_start('FIELD')
-        id = int(attrs['ID'])
-        type = field_types[id]
-        value = self.character_data()
+    def parse_row(self, element, field_types, field_names):
+        fields = dict.fromkeys(field_names)
+        for field in element.findall('FIELD'):
+            id = int(field.get('ID'))
+            fields[field_names[id]] = self.parse_field(field_types[id], (field.text or '').strip())
+        return fields
+
+    def parse_field(self, type, value):
         if type == 'Integer':
             value = int(value)
         elif type == 'Float':
@@ -2290,35 +4640,8 @@ class AQtimeParser(XmlParser):
             pass
         else:
             assert False
-        self.element_end('FIELD')
-        return id, value
+        return value
 
-    def parse_children(self):
-        children = []
-        self.element_start('CHILDREN')
-        while self.token.type == XML_ELEMENT_START:
-            table = self.parse_data()
-            assert table.name not in children
-            children.append(table)
-        self.element_end('CHILDREN')
-        return children
-
-    def build_profile(self, results):
-        assert results.name == 'Routines'
-        profile = Profile()
-        profile[TIME] = 0.0
-        for fields, tables in results:
-            function = self.build_function(fields)
-            children = tables['Children']
-            for fields, _ in children:
-                call = self.build_call(fields)
-                function.add_call(call)
-            profile.add_function(function)
-            profile[TIME] = profile[TIME] + function[TIME]
-        profile[TOTAL_TIME] = profile[TIME]
-        profile.ratio(TOTAL_TIME_RATIO, TOTAL_TIME)
-        return profile
-    
     def build_function(self, fields):
         function = Function(self.build_id(fields), self.build_name(fields))
         function[TIME] = fields['Time']
@@ -2343,16 +4666,101 @@ class AQtimeParser(XmlParser):
         return fields['Routine Name']
 
 
-class PstatsParser:
-    """Parser python profiling statistics saved with te pstats module."""
+class PstatsData:
+    """Raw pstats dictionary, in the form pstats.Stats knows how to load."""
 
-    def __init__(self, *filename):
-        import pstats
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+
+def load_pstats(filenames):
+    """Load and merge a batch of pstats files, returning the raw dictionary."""
+
+    import pstats
+    stats = None
+    for filename in filenames:
         try:
-            self.stats = pstats.Stats(*filename)
+            data = pstats.Stats(filename)
         except ValueError:
             import hotshot.stats
-            self.stats = hotshot.stats.load(filename[0])
+            data = hotshot.stats.load(filename)
+        if stats is None:
+            stats = data
+        else:
+            stats.add(data)
+    return stats.stats
+
+
+def merge_pstats(dicts):
+    """Merge raw pstats dictionaries, returning the merged dictionary."""
+
+    import pstats
+    stats = pstats.Stats(PstatsData(dicts[0]))
+    for data in dicts[1:]:
+        stats.add(PstatsData(data))
+    return stats.stats
+
+
+def parallel_pstats(filenames, jobs):
+    """Load many pstats files in a process pool.
+
+    The files are split in batches which the workers load, and the partial
+    results are then merged pairwise until a single one is left, so no
+    process ever merges more than two dictionaries at a time.
+    """
+
+    import multiprocessing
+    import pstats
+
+    batch_size = max(1, (len(filenames) + jobs*4 - 1) // (jobs*4))
+    batches = [filenames[i:i + batch_size] for i in xrange(0, len(filenames), batch_size)]
+
+    pool = multiprocessing.Pool(jobs)
+    try:
+        dicts = pool.map(load_pstats, batches)
+        while len(dicts) > 1:
+            pairs = [dicts[i:i + 2] for i in xrange(0, len(dicts) - 1, 2)]
+            merged = pool.map(merge_pstats, pairs)
+            if len(dicts) % 2:
+                merged.append(dicts[-1])
+            dicts = merged
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+    return pstats.Stats(PstatsData(dicts[0]))
+
+
+class PstatsParser:
+    """Parser python profiling statistics saved with te pstats module."""
+
+    # See Parser.version
+    version = 1
+
+    def __init__(self, *filename, **options):
+        import pstats
+        jobs = options.get('jobs', 1)
+        if len(filename) == 1 and isinstance(filename[0], pstats.Stats):
+            # Statistics already loaded in memory
+            self.stats = filename[0]
+        elif len(filename) > 1:
+            # pstats.Stats.add recurses once per file, so merge them here
+            if jobs > 1:
+                self.stats = parallel_pstats(list(filename), jobs)
+            else:
+                self.stats = pstats.Stats(PstatsData(load_pstats(filename)))
+        else:
+            try:
+                self.stats = pstats.Stats(*filename)
+            except ValueError:
+                import hotshot.stats
+                self.stats = hotshot.stats.load(filename[0])
         self.profile = Profile()
         self.function_ids = {}
 
@@ -2416,6 +4824,184 @@ class PstatsParser:
         return self.profile
 
 
+class ProfileCache:
+    """On-disk cache of parsed profiles, keyed by the path, size and
+    modification time of the input files, or optionally by their content.
+
+    Profiles are stored after integration with the marshal module, so
+    loading them back skips parsing altogether.
+    """
+
+    version = 3
+
+    # Events are singletons compared by identity, so they are stored by the
+    # name of their module constant
+    events = dict([(name, value) for name, value in globals().items() if isinstance(value, Event)])
+
+    def __init__(self, directory=None):
+        if directory is None:
+            directory = os.path.join(os.path.expanduser('~'), '.cache', 'gprof2dot')
+        self.directory = directory
+
+    def key(self, format, filenames, content=False, stacks=False, parser_version=0):
+        """Hash the input files together with everything affecting their parsing.
+
+        Files are identified by their path, size and modification time,
+        which only needs a stat, or by their whole content when content is
+        true, which survives copies and touches but reads every byte.
+        Profiles parsed with and without their stacks are cached apart, and
+        parser_version invalidates the profiles of an older parser.
+        """
+
+        digest = hashlib.sha1()
+        digest.update('%s\0%s\0%d\0%d\0%d\0%d\0' % (format, __version__, self.version, parser_version, content, stacks))
+        for filename in filenames:
+            if not content:
+                stat = os.stat(filename)
+                digest.update('%s\0%d\0%r\0' % (os.path.abspath(filename), stat.st_size, stat.st_mtime))
+                continue
+            fp = open(filename, 'rb')
+            try:
+                digest.update('%d\0' % os.fstat(fp.fileno()).st_size)
+                while True:
+                    data = fp.read(1 << 20)
+                    if not data:
+                        break
+                    digest.update(data)
+            finally:
+                fp.close()
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.profile')
+
+    def load(self, key):
+        """Return the cached profile for key, or None."""
+
+        try:
+            fp = open(self.path(key), 'rb')
+        except IOError:
+            return None
+
+        # Nothing created here can be garbage, so spare the collector from
+        # rescanning the ever growing heap
+        enabled = gc.isenabled()
+        gc.disable()
+        try:
+            try:
+                version, data = marshal.load(fp)
+            except (EOFError, ValueError, TypeError):
+                return None
+            if version != self.version:
+                return None
+            try:
+                return self.unpack(data)
+            except KeyError:
+                # An event since removed
+                return None
+        finally:
+            fp.close()
+            if enabled:
+                gc.enable()
+
+    def save(self, key, profile):
+        try:
+            data = marshal.dumps((self.version, self.pack(profile)))
+        except ValueError, e:
+            # Unknown event or function ids marshal cannot store
+            sys.stderr.write('warning: could not cache the profile: %s\n' % e)
+            return
+        path = self.path(key)
+        temp = '%s.%d' % (path, os.getpid())
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            fp = open(temp, 'wb')
+            try:
+                fp.write(data)
+            finally:
+                fp.close()
+            os.rename(temp, path)
+        except (IOError, OSError), e:
+            sys.stderr.write('warning: could not write profile cache %s: %s\n' % (path, e))
+
+    def pack(self, profile):
+        names = {}
+        for name, event in self.events.iteritems():
+            names[event] = name
+
+        def pack_events(obj):
+            try:
+                return tuple([(names[event], value) for event, value in obj.events.iteritems()])
+            except KeyError, e:
+                raise ValueError('event %s cannot be cached' % e.args[0].name)
+
+        cycles = {}
+        for cycle in profile.cycles:
+            cycles[cycle] = len(cycles)
+
+        functions = []
+        for function in profile.functions.itervalues():
+            calls = []
+            for call in function.calls.itervalues():
+                calls.append((call.callee_id, call.ratio, call.weight, pack_events(call)))
+            if function.cycle is None:
+                cycle = None
+            else:
+                cycle = cycles[function.cycle]
+            functions.append((
+                function.id, function.name, function.module, function.process,
+                function.called, function.weight, cycle,
+                pack_events(function), tuple(calls)))
+
+        if profile.stacks is None:
+            stacks = None
+        else:
+            stacks = tuple(profile.stacks.iteritems())
+
+        return (
+            pack_events(profile),
+            tuple([pack_events(cycle) for cycle in profile.cycles]),
+            tuple(functions),
+            stacks)
+
+    def unpack(self, data):
+        events = self.events
+
+        def unpack_events(obj, values):
+            obj.events = dict([(events[name], value) for name, value in values])
+
+        profile_events, cycle_events, functions, stacks = data
+
+        profile = Profile()
+        unpack_events(profile, profile_events)
+        if stacks is not None:
+            profile.stacks = dict(stacks)
+        for values in cycle_events:
+            cycle = Cycle()
+            unpack_events(cycle, values)
+            profile.add_cycle(cycle)
+
+        for id, name, module, process, called, weight, cycle, values, calls in functions:
+            function = Function(id, name)
+            function.module = module
+            function.process = process
+            function.called = called
+            function.weight = weight
+            unpack_events(function, values)
+            for callee_id, ratio, call_weight, call_values in calls:
+                call = Call(callee_id)
+                call.ratio = ratio
+                call.weight = call_weight
+                unpack_events(call, call_values)
+                function.calls[callee_id] = call
+            if cycle is not None:
+                profile.cycles[cycle].add_function(function)
+            profile.add_function(function)
+
+        return profile
+
+
 class Theme:
 
     def __init__(self, 
@@ -2561,6 +5147,46 @@ BW_COLORMAP = Theme(
 )
 
 
+class DiffTheme(Theme):
+    """Diverging color map for profile changes, a weight of 0.5 is no change."""
+
+    def __init__(self, midcolor = (0.0, 0.0, 0.6), **kwargs):
+        Theme.__init__(self, **kwargs)
+        self.midcolor = midcolor
+
+    def edge_penwidth(self, weight):
+        return Theme.edge_penwidth(self, self.change(weight))
+
+    def fontsize(self, weight):
+        return Theme.fontsize(self, self.change(weight))
+
+    def change(self, weight):
+        return min(abs(weight - 0.5)*2.0, 1.0)
+
+    def color(self, weight):
+        weight = min(max(weight, 0.0), 1.0)
+        if weight < 0.5:
+            endcolor = self.mincolor
+        else:
+            endcolor = self.maxcolor
+
+        # Keep the hue of the end color, the middle color is unsaturated
+        h, smax, lmax = endcolor
+        hmid, smid, lmid = self.midcolor
+        change = self.change(weight)
+        s = smid + change*(smax - smid)
+        l = lmid + change*(lmax - lmid)
+
+        return self.hsl_to_rgb(h, s, l)
+
+
+DIFF_COLORMAP = DiffTheme(
+    mincolor = (1.0/3.0, 0.80, 0.30), # dark green
+    maxcolor = (0.0, 1.0, 0.5), # satured red
+    gamma = 1.0
+)
+
+
 class DotWriter:
     """Writer for the DOT language.
 
@@ -2571,6 +5197,7 @@ class DotWriter:
 
     strip = False
     wrap = False
+    graphLabel = None
 
     def __init__(self, fp):
         self.fp = fp
@@ -2619,7 +5246,7 @@ class DotWriter:
                 function_name = self.wrap_function_name(function_name)
             labels.append(function_name)
 
-            for event in TOTAL_TIME_RATIO, TIME_RATIO:
+            for event in TOTAL_TIME_RATIO, TIME_RATIO, DELTA_TOTAL_TIME_RATIO, DELTA_TIME_RATIO, TOTAL_BYTES, BYTES, ALLOCS:
                 if event in function.events:
                     label = event.format(function[event])
                     labels.append(label)
@@ -2643,7 +5270,7 @@ class DotWriter:
                 callee = profile.functions[call.callee_id]
 
                 labels = []
-                for event in TOTAL_TIME_RATIO, CALLS:
+                for event in TOTAL_TIME_RATIO, DELTA_TOTAL_TIME_RATIO, TOTAL_BYTES, CALLS:
                     if event in call.events:
                         label = event.format(call[event])
                         labels.append(label)
@@ -2745,6 +5372,165 @@ class DotWriter:
         self.fp.write(s)
 
 
+class FoldedWriter:
+    """Writer for collapsed (folded) stacks, the input of the FlameGraph tools.
+
+    Profiles without sampled stacks get stacks estimated from the call ratios,
+    in millionths of the total.
+    """
+
+    def __init__(self, fp):
+        self.fp = fp
+
+    def graph(self, profile, theme):
+        stacks = profile.stacks
+        if stacks is None:
+            stacks = profile.estimate_stacks()
+
+        # Functions of different modules may share a name, and filtered
+        # stacks may collapse together, so merge the lines by name
+        functions = profile.functions
+        values = {}
+        for stack, value in stacks.iteritems():
+            # Functions may have been filtered out
+            names = [functions[function_id].name.replace(';', ':')
+                     for function_id in stack if function_id in functions]
+            if names:
+                line = ';'.join(names)
+                values[line] = values.get(line, 0) + value
+        for line in sorted(values):
+            self.write('%s %s\n' % (line, samples(values[line])))
+
+    def write(self, s):
+        if isinstance(s, unicode):
+            s = s.encode('utf-8')
+        self.fp.write(s)
+
+
+class FlameGraphWriter:
+    """Writer for flame graph SVG images, laid out without dot.
+
+    Every stack is a column of frames, the outermost caller at the bottom,
+    and the width of a frame is its share of the samples. Frames of the
+    same function under the same parent are merged, sorted by name.
+
+    See also:
+    - http://www.brendangregg.com/flamegraphs.html
+    """
+
+    title = None
+    width = 1200
+    frame_height = 16
+    font_size = 12
+    font_width = 0.59
+    min_width = 0.1
+    xpad = 10
+    ypad_top = 34
+    ypad_bottom = 10
+
+    def __init__(self, fp):
+        self.fp = fp
+
+    def graph(self, profile, theme):
+        stacks = profile.stacks
+        if stacks is None:
+            stacks = profile.estimate_stacks()
+
+        # Merge the stacks into a tree of [value, children, function id]
+        functions = profile.functions
+        root = [0, {}, None]
+        for stack, value in stacks.iteritems():
+            root[0] += value
+            node = root
+            for function_id in stack:
+                if function_id not in functions:
+                    continue
+                try:
+                    node = node[1][function_id]
+                except KeyError:
+                    child = [0, {}, function_id]
+                    node[1][function_id] = child
+                    node = child
+                node[0] += value
+
+        total = root[0]
+        if not total:
+            total = 1
+        scale = float(self.width - 2*self.xpad)/total
+
+        # Lay out the frames, without recursion as stacks can be deep
+        frames = []
+        depth = 0
+        work = [(root, self.xpad, 0)]
+        while work:
+            node, x, level = work.pop()
+            width = node[0]*scale
+            if width < self.min_width:
+                continue
+            frames.append((x, level, width, node))
+            depth = max(depth, level)
+            children = node[1].values()
+            children.sort(key=lambda child: functions[child[2]].name)
+            for child in children:
+                work.append((child, x, level + 1))
+                x += child[0]*scale
+
+        height = self.ypad_top + (depth + 1)*self.frame_height + self.ypad_bottom
+        fontname = theme.graph_fontname()
+
+        self.write('<?xml version="1.0" standalone="no"?>\n')
+        self.write('<svg version="1.1" width="%d" height="%d" viewBox="0 0 %d %d" xmlns="http://www.w3.org/2000/svg">\n' % (self.width, height, self.width, height))
+        self.write('<rect x="0" y="0" width="%d" height="%d" fill="#f8f8f8"/>\n' % (self.width, height))
+        self.write('<text x="%d" y="24" font-family="%s" font-size="%d" text-anchor="middle">%s</text>\n' % (
+            self.width/2, self.escape(fontname), self.font_size + 5, self.escape(self.title or 'Flame Graph')))
+        for x, level, width, node in frames:
+            if node[2] is None:
+                name = 'all'
+                module = None
+            else:
+                function = functions[node[2]]
+                name = function.name
+                module = function.module
+            y = height - self.ypad_bottom - (level + 1)*self.frame_height
+            if module:
+                tooltip = '%s (%s)' % (name, module)
+            else:
+                tooltip = name
+            tooltip = '%s: %s samples, %s' % (tooltip, samples(node[0]), percentage(float(node[0])/total))
+            self.write('<g><title>%s</title>' % self.escape(tooltip))
+            self.write('<rect x="%.1f" y="%d" width="%.1f" height="%d" fill="%s" rx="2" ry="2"/>' % (
+                x, y, width, self.frame_height - 1, self.color(name)))
+            chars = int(width/(self.font_size*self.font_width))
+            if chars >= 3:
+                if len(name) > chars:
+                    name = name[:chars - 2] + '..'
+                self.write('<text x="%.1f" y="%.1f" font-family="%s" font-size="%d">%s</text>' % (
+                    x + 3, y + self.frame_height - 4.5, self.escape(fontname), self.font_size, self.escape(name)))
+            self.write('</g>\n')
+        self.write('</svg>\n')
+
+    def color(self, name):
+        """Warm color, stable for a given function name."""
+
+        digest = hashlib.md5(name.encode('utf-8')).digest()
+        r = 205 + ord(digest[0]) % 51
+        g = ord(digest[1]) % 231
+        b = ord(digest[2]) % 56
+        return '#%02x%02x%02x' % (r, g, b)
+
+    def escape(self, s):
+        s = s.replace('&', '&amp;')
+        s = s.replace('<', '&lt;')
+        s = s.replace('>', '&gt;')
+        s = s.replace('"', '&quot;')
+        return s
+
+    def write(self, s):
+        if isinstance(s, unicode):
+            s = s.encode('utf-8')
+        self.fp.write(s)
+
+
 class Main:
     """Main program."""
 
@@ -2755,6 +5541,23 @@ class Main:
             "bw": BW_COLORMAP,
     }
 
+    parsers = {
+            "prof": GprofParser,
+            "callgrind": CallgrindParser,
+            "perf": PerfParser,
+            "perfdata": PerfDataParser,
+            "oprofile": OprofileParser,
+            "hprof": HProfParser,
+            "sysprof": SysprofParser,
+            "pstats": PstatsParser,
+            "shark": SharkParser,
+            "sleepy": SleepyParser,
+            "aqtime": AQtimeParser,
+            "xperf": XPerfParser,
+            "snapshot": SnapshotParser,
+            "collapsed": CollapsedParser,
+    }
+
     def main(self):
         """Main program."""
 
@@ -2775,14 +5578,67 @@ class Main:
             help="eliminate edges below this threshold [default: %default]")
         parser.add_option(
             '-f', '--format',
-            type="choice", choices=('prof', 'callgrind', 'perf', 'oprofile', 'hprof', 'sysprof', 'pstats', 'shark', 'sleepy', 'aqtime', 'xperf'),
+            type="choice", choices=('prof', 'callgrind', 'perf', 'perfdata', 'oprofile', 'hprof', 'sysprof', 'pstats', 'shark', 'sleepy', 'aqtime', 'xperf', 'snapshot', 'collapsed'),
             dest="format", default="prof",
-            help="profile format: prof, callgrind, oprofile, hprof, sysprof, shark, sleepy, aqtime, pstats, or xperf [default: %default]")
+            help="profile format: prof, callgrind, perf, perfdata, oprofile, hprof, sysprof, shark, sleepy, aqtime, pstats, xperf, snapshot, or collapsed [default: %default]")
+        parser.add_option(
+            '--output-format',
+            type="choice", choices=('dot', 'folded', 'flame'),
+            dest="output_format", default="dot",
+            help="output format: dot graph, folded stacks or flame graph SVG [default: %default]")
+        parser.add_option(
+            '--compact',
+            action="store_true",
+            dest="compact", default=False,
+            help="store the profile in flat arrays instead of objects to reduce memory usage (perf and perfdata only)")
+        parser.add_option(
+            '-j', '--jobs', metavar='N',
+            type="int", dest="jobs", default=1,
+            help="number of worker processes used to parse the input files (pstats, perf and xperf only, perf and xperf inputs must be uncompressed files, not stdin) [default: %default]")
+        parser.add_option(
+            '--dump-pstats', metavar='FILE',
+            type="string", dest="dump_pstats",
+            help="save the merged statistics to a single pstats file (pstats only)")
+        parser.add_option(
+            '--root', metavar='REGEX',
+            type="string", dest="root",
+            help="only keep the functions matching REGEX and the functions they call, with ratios relative to them")
+        parser.add_option(
+            '--leaf', metavar='REGEX',
+            type="string", dest="leaf",
+            help="only keep the functions matching REGEX and the functions calling them")
+        parser.add_option(
+            '--top-paths', metavar='K',
+            type="int", dest="top_paths",
+            help="only keep the K heaviest call paths, which bounds the graph size and layout time")
+        parser.add_option(
+            '--diff',
+            action="store_true",
+            dest="diff", default=False,
+            help="compare two profiles given as base and new files, coloring regressions red and speedups green, overrides --colormap")
+        parser.add_option(
+            '--base', metavar='FILE',
+            action="append", dest="base", default=[],
+            help="base profile file for --diff, the input files being the new profile; may be repeated to merge several pstats files, implies --diff")
+        parser.add_option(
+            '--cache',
+            action="store_true",
+            dest="cache", default=False,
+            help="cache the parsed profile, so later runs on the same input files skip parsing")
+        parser.add_option(
+            '--cache-dir', metavar='DIR',
+            type="string", dest="cache_dir",
+            help="profile cache directory, implies --cache [default: ~/.cache/gprof2dot]")
+        parser.add_option(
+            '--cache-content',
+            action="store_true",
+            dest="cache_content", default=False,
+            help="key the profile cache on the content of the input files instead of their path, size and modification time, implies --cache")
         parser.add_option(
             '-c', '--colormap',
             type="choice", choices=('color', 'pink', 'gray', 'bw'),
-            dest="theme", default="color",
-            help="color map: color, pink, gray, or bw [default: %default]")
+            dest="theme", default=None,
+            help="color map: color, pink, gray, or bw [default: color]")
         parser.add_option(
             '-s', '--strip',
             action="store_true",
@@ -2805,11 +5661,32 @@ class Main:
             default=None)
         (self.options, self.args) = parser.parse_args(sys.argv[1:])
 
-        if len(self.args) > 1 and self.options.format != 'pstats':
+        if self.options.base:
+            self.options.diff = True
+            base_args, new_args = self.options.base, self.args
+            if not new_args:
+                parser.error('--base needs the new profile files as arguments')
+        elif self.options.diff:
+            if len(self.args) != 2:
+                parser.error('--diff needs a base and a new profile, use --base to give several files per profile')
+            base_args, new_args = self.args[:1], self.args[1:]
+        if self.options.diff:
+            if self.options.format != 'pstats' and (len(base_args) > 1 or len(new_args) > 1):
+                parser.error('only pstats input can merge several files per profile')
+            if self.options.theme is not None:
+                sys.stderr.write('warning: --diff uses its own colormap, ignoring --colormap %s\n' % self.options.theme)
+        elif len(self.args) > 1 and self.options.format != 'pstats':
             parser.error('incorrect number of arguments')
 
+        if self.options.jobs < 1:
+            parser.error('--jobs must be at least 1')
+        if self.options.jobs > 1 and self.options.format not in ('pstats', 'perf', 'xperf'):
+            parser.error('--jobs is only supported for pstats, perf and xperf input')
+        if self.options.dump_pstats and self.options.format != 'pstats':
+            parser.error('--dump-pstats is only supported for pstats input')
+
         try:
-            self.theme = self.themes[self.options.theme]
+            self.theme = self.themes[self.options.theme or 'color']
         except KeyError:
             parser.error('invalid colormap \'%s\'' % self.options.theme)
         
@@ -2817,87 +5694,182 @@ class Main:
         if self.options.theme_skew:
             self.theme.skew = self.options.theme_skew
 
+        if self.options.diff:
+            base = self.load(parser, base_args)
+            new = self.load(parser, new_args)
+            self.profile = diff_profiles(base, new)
+            self.theme = DIFF_COLORMAP
+        else:
+            self.profile = self.load(parser, self.args)
+
+        if self.options.root or self.options.leaf:
+            self.focus(parser)
+        
+        if self.options.output is None:
+            self.output = sys.stdout
+        else:
+            self.output = open(self.options.output, 'wt')
+
+        self.write_graph()
+
+    def keep_stacks(self):
+        """Whether the output needs the sampled stacks."""
+
+        return self.options.output_format in ('folded', 'flame')
+
+    def load(self, optparser, args):
+        """Parse the input files, through the profile cache when enabled."""
+
+        if self.options.cache or self.options.cache_dir or self.options.cache_content:
+            if not args:
+                optparser.error('the profile cache needs input files')
+            cache = ProfileCache(self.options.cache_dir)
+            key = cache.key(self.options.format, args, self.options.cache_content, self.keep_stacks(),
+                            self.parsers[self.options.format].version)
+            if self.options.dump_pstats:
+                # The raw statistics are not cached, so parse them again
+                profile = None
+            else:
+                profile = cache.load(key)
+            if profile is None:
+                profile = self.parse(optparser, args)
+                cache.save(key, profile)
+            return profile
+        return self.parse(optparser, args)
+
+    def parse(self, optparser, args):
+        """Parse the input files with the parser for the selected format."""
+
         if self.options.format == 'prof':
-            if not self.args:
+            if not args:
                 fp = sys.stdin
             else:
-                fp = open(self.args[0], 'rt')
+                fp = open_input(args[0])
             parser = GprofParser(fp)
         elif self.options.format == 'callgrind':
-            if not self.args:
+            if not args:
                 fp = sys.stdin
             else:
-                fp = open(self.args[0], 'rt')
+                fp = open_input(args[0])
             parser = CallgrindParser(fp)
         elif self.options.format == 'perf':
-            if not self.args:
+            if not args:
                 fp = sys.stdin
             else:
-                fp = open(self.args[0], 'rt')
-            parser = PerfParser(fp)
+                fp = open_input(args[0])
+            parser = PerfParser(fp, compact=self.options.compact, jobs=self.options.jobs)
+        elif self.options.format == 'perfdata':
+            if len(args) != 1:
+                optparser.error('exactly one file must be specified for perfdata input')
+            parser = PerfDataParser(args[0], compact=self.options.compact)
         elif self.options.format == 'oprofile':
-            if not self.args:
+            if not args:
                 fp = sys.stdin
             else:
-                fp = open(self.args[0], 'rt')
+                fp = open_input(args[0])
             parser = OprofileParser(fp)
         elif self.options.format == 'sysprof':
-            if not self.args:
+            if not args:
                 fp = sys.stdin
             else:
-                fp = open(self.args[0], 'rt')
+                fp = open_input(args[0])
             parser = SysprofParser(fp)
         elif self.options.format == 'hprof':
-            if not self.args:
+            if not args:
                 fp = sys.stdin
             else:
-                fp = open(self.args[0], 'rt')
+                fp = open_input(args[0])
             parser = HProfParser(fp)        
         elif self.options.format == 'pstats':
-            if not self.args:
-                parser.error('at least a file must be specified for pstats input')
-            parser = PstatsParser(*self.args)
+            if not args:
+                optparser.error('at least a file must be specified for pstats input')
+            parser = PstatsParser(*args, jobs=self.options.jobs)
+            if self.options.dump_pstats:
+                parser.stats.dump_stats(self.options.dump_pstats)
         elif self.options.format == 'xperf':
-            if not self.args:
+            if not args:
                 fp = sys.stdin
             else:
-                fp = open(self.args[0], 'rt')
-            parser = XPerfParser(fp)
+                fp = open_input(args[0])
+            parser = XPerfParser(fp, jobs=self.options.jobs)
         elif self.options.format == 'shark':
-            if not self.args:
+            if not args:
                 fp = sys.stdin
             else:
-                fp = open(self.args[0], 'rt')
+                fp = open_input(args[0])
             parser = SharkParser(fp)
         elif self.options.format == 'sleepy':
-            if len(self.args) != 1:
-                parser.error('exactly one file must be specified for sleepy input')
-            parser = SleepyParser(self.args[0])
+            if len(args) != 1:
+                optparser.error('exactly one file must be specified for sleepy input')
+            parser = SleepyParser(args[0])
         elif self.options.format == 'aqtime':
-            if not self.args:
+            if not args:
                 fp = sys.stdin
             else:
-                fp = open(self.args[0], 'rt')
+                fp = open_input(args[0])
             parser = AQtimeParser(fp)
+        elif self.options.format == 'snapshot':
+            if not args:
+                fp = sys.stdin
+            else:
+                fp = open_input(args[0])
+            parser = SnapshotParser(fp)
+        elif self.options.format == 'collapsed':
+            if not args:
+                fp = sys.stdin
+            else:
+                fp = open_input(args[0])
+            parser = CollapsedParser(fp)
         else:
-            parser.error('invalid format \'%s\'' % self.options.format)
+            optparser.error('invalid format \'%s\'' % self.options.format)
 
-        self.profile = parser.parse()
-        
-        if self.options.output is None:
-            self.output = sys.stdout
-        else:
-            self.output = open(self.options.output, 'wt')
+        parser.keep_stacks = self.keep_stacks()
+        return parser.parse()
 
-        self.write_graph()
+    def focus(self, optparser):
+        """Keep the subgraph under the --root functions and above the --leaf ones."""
+
+        profile = self.profile
+        function_ids = None
+        root_ids = None
+        if self.options.root:
+            root_ids = profile.find_functions(self.options.root)
+            if not root_ids:
+                optparser.error('no function matches --root \'%s\'' % self.options.root)
+            function_ids = profile.descendants(root_ids)
+        if self.options.leaf:
+            leaf_ids = profile.find_functions(self.options.leaf)
+            if not leaf_ids:
+                optparser.error('no function matches --leaf \'%s\'' % self.options.leaf)
+            ancestor_ids = profile.ancestors(leaf_ids)
+            if function_ids is None:
+                function_ids = ancestor_ids
+            else:
+                function_ids &= ancestor_ids
+
+        if root_ids is not None:
+            profile.renormalize([root_id for root_id in root_ids if root_id in function_ids])
+        profile.keep_functions(function_ids)
 
     def write_graph(self):
+        if self.options.output_format == 'folded':
+            writer = FoldedWriter(self.output)
+            writer.graph(self.profile, self.theme)
+            return
+        if self.options.output_format == 'flame':
+            writer = FlameGraphWriter(self.output)
+            writer.title = self.options.graphLabel
+            writer.graph(self.profile, self.theme)
+            return
+
         dot = DotWriter(self.output)
         dot.strip = self.options.strip
         dot.wrap = self.options.wrap
         dot.graphLabel = self.options.graphLabel
 
         profile = self.profile
+        if self.options.top_paths:
+            profile.keep_paths(profile.top_paths(self.options.top_paths))
         profile.prune(self.options.node_thres/100.0, self.options.edge_thres/100.0)
 
         dot.graph(profile, self.theme)
@@ -9,12 +9,21 @@ Copyright (c) 2012 Moonbot Studios. All rights reserved.
 Set of profiling tools to assist in optimizing python scripts
 """
 import os
+import re
+import json
+import collections
+import math
 import sys
 import time
 import subprocess
+import threading
+import Queue
 import gprof2dot
 import inspect
+import timeit
 import cProfile
+import pstats
+from cStringIO import StringIO
 
 import mbotenv
 import envtools
@@ -34,48 +43,126 @@ DOT_EXEC = dict(
 __all__ = [
     'dotMap',
     'cacheGrind',
+    'sampleMap',
+    'memMap',
     'timeIt',
+    'traceIt',
+    'span',
+    'startTracing',
+    'stopTracing',
+    'flushDotMaps',
+    'flushAccumulatedProfiles',
+    'printTimings',
+    'exportTimings',
+    'mergeTimings',
+    'startContinuousProfiler',
+    'stopContinuousProfiler',
+    'startChildProfile',
+    'childEnviron',
 ]
 
 ''' ---- Decorators ---- '''
 
 
 def dotMap(*dot_args, **dot_kwargs):
+    accumulate = _popAccumulateOptions(dot_kwargs)
     def decorator(func):
+        if accumulate:
+            return _accumulateWrapper(func, accumulate, _emitDotMap, dot_kwargs)
         def wrapper(*args, **kwargs):
-            def resultWrapper():
-                global _profile_result
-                _profile_result = func(*args, **kwargs)
-            return createDotMap("resultWrapper()", *dot_args, **dot_kwargs)
+            return createDotMap((func, args, kwargs), *dot_args, **dot_kwargs)
         return wrapper
     return decorator
 
 
 def cacheGrind(*dot_args, **dot_kwargs):
+    accumulate = _popAccumulateOptions(dot_kwargs)
     def decorator(func):
+        if accumulate:
+            return _accumulateWrapper(func, accumulate, _emitCacheGrind, dot_kwargs)
         def wrapper(*args, **kwargs):
-            def resultWrapper():
-                global _profile_result
-                _profile_result = func(*args, **kwargs)
-            return createCacheGrind("resultWrapper()", *dot_args, **dot_kwargs)
+            return createCacheGrind((func, args, kwargs), *dot_args, **dot_kwargs)
         return wrapper
     return decorator
 
 
-def timeIt(*time_args, **time_kwargs):
+def sampleMap(*dot_args, **dot_kwargs):
     def decorator(func):
         def wrapper(*args, **kwargs):
-            return timeFunc((func, args, kwargs), *time_args, **time_kwargs)
+            return createSampledDotMap((func, args, kwargs), *dot_args, **dot_kwargs)
+        return wrapper
+    return decorator
+
+
+def memMap(*dot_args, **dot_kwargs):
+    # Fail when decorating rather than silently on every call
+    _importTracemalloc()
+    def decorator(func):
+        def wrapper(*args, **kwargs):
+            return createMemoryMap((func, args, kwargs), *dot_args, **dot_kwargs)
+        return wrapper
+    return decorator
+
+
+def timeIt(threshold=None, echo=False, name=None):
+    '''
+    Record the duration of every call in a TimingHistogram
+    Nothing is printed per call unless echo is set (then only calls over
+    threshold are), see printTimings for the report, printed at exit too.
+    For generators the time spent producing each item is recorded as well,
+    under "<name>:yield". While a SpanTracer runs, calls are also recorded
+    as spans, see startTracing.
+    '''
+    def decorator(func):
+        timingName = name or _getFuncName(func)
+        histogram = getTiming(timingName)
+        def wrapper(*args, **kwargs):
+            tracer = _tracer
+            if tracer is None:
+                return timeFunc((func, args, kwargs), threshold, echo, histogram)
+            tracer.enter(timingName)
+            try:
+                return timeFunc((func, args, kwargs), threshold, echo, histogram)
+            finally:
+                tracer.exit()
         if inspect.isgeneratorfunction(func):
+            yieldHistogram = getTiming(timingName + ':yield')
             def wrapper(*args, **kwargs):
                 totalTime = 0
-                yieldTime = time.time()
+                yieldTime = _timer()
                 startTime = yieldTime
-                for genResult in func(*args, **kwargs):
-                    totalTime += time.time() - yieldTime
+                for genResult in _traceGenerator(func(*args, **kwargs), timingName):
+                    itemTime = _timer() - yieldTime
+                    yieldHistogram.record(itemTime)
+                    totalTime += itemTime
                     yield genResult
-                    yieldTime = time.time()
-                print "DEBUG_TIMEIT_GEN: {0}() {1:f}s generator {2:f}s total".format(func.__name__, totalTime, time.time() - startTime)
+                    yieldTime = _timer()
+                totalTime += _timer() - yieldTime
+                histogram.record(totalTime)
+                if echo and (threshold is None or totalTime > threshold):
+                    print "DEBUG_TIMEIT_GEN: {0}() {1:f}s generator {2:f}s total".format(func.__name__, totalTime, _timer() - startTime)
+        return wrapper
+    return decorator
+
+def traceIt(name=None):
+    '''
+    Record every call as a span of the running SpanTracer, see startTracing
+    Does nothing while no tracer runs
+    '''
+    def decorator(func):
+        spanName = name or _getFuncName(func)
+        def wrapper(*args, **kwargs):
+            tracer = _tracer
+            if tracer is None:
+                return func(*args, **kwargs)
+            tracer.enter(spanName)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                tracer.exit()
+        if inspect.isgeneratorfunction(func):
+            def wrapper(*args, **kwargs):
+                return _traceGenerator(func(*args, **kwargs), spanName)
         return wrapper
     return decorator
 
@@ -114,17 +201,430 @@ def getTempFile(name):
     return tmpFile
 
 
-def timeFunc(func, threshold=None):
-    import time
-    st = time.time()
-    result = func[0](*func[1], **func[2])
-    totalTime = time.time() - st
-    if threshold is None or totalTime > threshold:
-        print "DEBUG_TIMEIT: {0}() {1:f} seconds".format(func[0].__name__, totalTime)
-    return result
+def timeFunc(func, threshold=None, echo=True, histogram=None):
+    '''
+    Time a (func, args, kwargs) call, printing it if echo is set and it
+    took longer than threshold, and recording it in histogram if given
+    '''
+    st = _timer()
+    try:
+        return func[0](*func[1], **func[2])
+    finally:
+        totalTime = _timer() - st
+        if histogram is not None:
+            histogram.record(totalTime)
+        if echo and (threshold is None or totalTime > threshold):
+            print "DEBUG_TIMEIT: {0}() {1:f} seconds".format(func[0].__name__, totalTime)
+
+
+# time.perf_counter only exists from python 3.3, default_timer is the most
+# precise clock available before that
+_timer = getattr(time, 'perf_counter', timeit.default_timer)
+
+
+class TimingHistogram(object):
+    '''
+    Streaming histogram of durations, in seconds
+    Values are counted in logarithmic buckets each `precision` wider than
+    the previous one (like HDR histograms), so percentiles are known within
+    that relative error whatever the range, in a few kilobytes at most.
+    '''
+
+    minValue = 1e-7
+    precision = 0.01
+
+    def __init__(self, name=None):
+        self.name = name
+        self._scale = 1.0 / math.log1p(self.precision)
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.buckets = {}
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def record(self, value):
+        if value > self.minValue:
+            index = int(math.log(value / self.minValue) * self._scale) + 1
+        else:
+            index = 0
+        self._lock.acquire()
+        try:
+            self.buckets[index] = self.buckets.get(index, 0) + 1
+            self.count += 1
+            self.total += value
+            if self.min is None or value < self.min:
+                self.min = value
+            if self.max is None or value > self.max:
+                self.max = value
+        finally:
+            self._lock.release()
+
+    def percentile(self, percent):
+        ''' Return the value below which percent of the recorded values fall '''
+        if not self.count:
+            return None
+        rank = percent / 100.0 * self.count
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= rank:
+                break
+        value = self.minValue * (1.0 + self.precision) ** index
+        return max(self.min, min(value, self.max))
+
+    def mean(self):
+        if not self.count:
+            return None
+        return self.total / self.count
+
+    def merge(self, other):
+        ''' Add the values of another histogram with the same buckets '''
+        if (other.minValue, other.precision) != (self.minValue, self.precision):
+            raise ValueError("Can not merge timing histograms with different buckets")
+        self._lock.acquire()
+        try:
+            for index, count in other.buckets.iteritems():
+                self.buckets[index] = self.buckets.get(index, 0) + count
+            self.count += other.count
+            self.total += other.total
+            if other.min is not None and (self.min is None or other.min < self.min):
+                self.min = other.min
+            if other.max is not None and (self.max is None or other.max > self.max):
+                self.max = other.max
+        finally:
+            self._lock.release()
+
+    def toDict(self):
+        return dict(
+            minValue=self.minValue,
+            precision=self.precision,
+            count=self.count,
+            total=self.total,
+            min=self.min,
+            max=self.max,
+            # json only has string keys
+            buckets=dict((str(index), count) for index, count in self.buckets.iteritems()),
+        )
+
+    @classmethod
+    def fromDict(cls, data, name=None):
+        histogram = cls(name)
+        histogram.minValue = data['minValue']
+        histogram.precision = data['precision']
+        histogram._scale = 1.0 / math.log1p(histogram.precision)
+        histogram.buckets = dict((int(index), count) for index, count in data['buckets'].iteritems())
+        histogram.count = data['count']
+        histogram.total = data['total']
+        histogram.min = data['min']
+        histogram.max = data['max']
+        return histogram
+
+
+_timings = {}
+_timingsLock = threading.Lock()
+
+
+def getTiming(name):
+    ''' Return the TimingHistogram of a name, created by the first call '''
+    _timingsLock.acquire()
+    try:
+        try:
+            return _timings[name]
+        except KeyError:
+            if not _timings:
+                import atexit
+                atexit.register(_reportTimingsAtExit)
+            histogram = TimingHistogram(name)
+            _timings[name] = histogram
+            return histogram
+    finally:
+        _timingsLock.release()
+
+
+def timingReport():
+    ''' Return a table of the timings recorded so far '''
+    lines = ["{0:<40} {1:>9} {2:>11} {3:>11} {4:>11} {5:>11} {6:>11} {7:>11}".format(
+        'DEBUG_TIMEIT', 'calls', 'total', 'mean', 'p50', 'p95', 'p99', 'max')]
+    histograms = sorted(_timings.values(), key=lambda histogram: -histogram.total)
+    for histogram in histograms:
+        if not histogram.count:
+            continue
+        lines.append("{0:<40} {1:>9d} {2:>11.6f} {3:>11.6f} {4:>11.6f} {5:>11.6f} {6:>11.6f} {7:>11.6f}".format(
+            histogram.name, histogram.count, histogram.total, histogram.mean(),
+            histogram.percentile(50), histogram.percentile(95), histogram.percentile(99), histogram.max))
+    return "\n".join(lines)
+
+
+def printTimings():
+    ''' Print the timings recorded so far '''
+    print timingReport()
+
+
+def exportTimings(path=None):
+    '''
+    Return the timings recorded so far as a json string, and write it to
+    path if given. mergeTimings loads it back, in this or another process.
+    '''
+    data = json.dumps(dict((name, histogram.toDict()) for name, histogram in _timings.items() if histogram.count))
+    if path:
+        fp = open(_cleanPath(path), 'wt')
+        try:
+            fp.write(data)
+        finally:
+            fp.close()
+    return data
+
+
+def mergeTimings(data):
+    ''' Add timings exported by exportTimings, given as a json string or a file path '''
+    if not data.lstrip().startswith('{'):
+        fp = open(_cleanPath(data), 'rt')
+        try:
+            data = fp.read()
+        finally:
+            fp.close()
+    for name, values in json.loads(data).iteritems():
+        getTiming(name).merge(TimingHistogram.fromDict(values, name))
+
+
+def resetTimings():
+    for histogram in _timings.values():
+        histogram.reset()
+
+
+def _reportTimingsAtExit():
+    if not any(histogram.count for histogram in _timings.values()):
+        return
+    outputDir = os.environ.get('DEBUG_TIMEIT_DIR')
+    if outputDir:
+        if not os.path.isdir(outputDir):
+            os.makedirs(outputDir)
+        exportTimings(os.path.join(outputDir, "timings_{0}.json".format(os.getpid())))
+    printTimings()
+
+
+class SpanTracer(object):
+    '''
+    Records nested spans of wall time, per thread
+    Every thread keeps the stack of its open spans. Closed spans go to a ring
+    buffer of the last `maxSpans` ones, for exportChromeTrace, and are summed
+    by (parent, name) for the whole run, for getProfile, so memory stays
+    bounded however long the job runs.
+    '''
+
+    def __init__(self, maxSpans=100000):
+        # (name, thread id, start, duration) of the most recent spans
+        self.spans = collections.deque(maxlen=maxSpans)
+        self.startTime = _timer()
+        self._local = threading.local()
+        # One {(parent, name): [calls, total, self, total outside recursion]} per thread
+        self._totals = []
+        self._lock = threading.Lock()
+
+    def _threadState(self):
+        local = self._local
+        local.stack = []
+        local.totals = {}
+        local.threadId = _currentThreadId()
+        self._lock.acquire()
+        try:
+            self._totals.append(local.totals)
+        finally:
+            self._lock.release()
+        return local
+
+    def enter(self, name):
+        try:
+            stack = self._local.stack
+        except AttributeError:
+            stack = self._threadState().stack
+        stack.append([name, _timer(), 0.0])
+
+    def exit(self):
+        end = _timer()
+        local = self._local
+        stack = local.stack
+        name, start, childTime = stack.pop()
+        duration = end - start
+        parent = None
+        recursive = False
+        if stack:
+            stack[-1][2] += duration
+            parent = stack[-1][0]
+            for frame in stack:
+                if frame[0] == name:
+                    recursive = True
+                    break
+        self.spans.append((name, local.threadId, start, duration))
+        key = (parent, name)
+        try:
+            totals = local.totals[key]
+        except KeyError:
+            totals = local.totals[key] = [0, 0.0, 0.0, 0.0]
+        totals[0] += 1
+        totals[1] += duration
+        totals[2] += duration - childTime
+        if not recursive:
+            totals[3] += duration
+
+    def getTotals(self):
+        ''' Return the span totals of every thread, summed by (parent, name) '''
+        self._lock.acquire()
+        try:
+            threadTotals = list(self._totals)
+        finally:
+            self._lock.release()
+        totals = {}
+        for threadTotal in threadTotals:
+            for key, values in threadTotal.items():
+                try:
+                    total = totals[key]
+                except KeyError:
+                    total = totals[key] = [0, 0.0, 0.0, 0.0]
+                for i in xrange(4):
+                    total[i] += values[i]
+        return totals
+
+    def exportChromeTrace(self, path=None):
+        '''
+        Return the spans of the ring buffer in the chrome trace event format
+        (chrome://tracing, Perfetto), written to path if given
+        '''
+        pid = os.getpid()
+        events = []
+        for name, threadId, start, duration in list(self.spans):
+            events.append(dict(
+                name=name,
+                ph='X',
+                ts=(start - self.startTime) * 1e6,
+                dur=duration * 1e6,
+                pid=pid,
+                tid=threadId,
+            ))
+        data = json.dumps(dict(traceEvents=events, displayTimeUnit='ms'))
+        if path:
+            fp = open(_cleanPath(path), 'wt')
+            try:
+                fp.write(data)
+            finally:
+                fp.close()
+        return data
+
+    def getProfile(self):
+        '''
+        Convert the span totals into a gprof2dot profile, the same way
+        gprof2dot.PstatsParser handles pstats files
+        '''
+        profile = gprof2dot.Profile()
+        profile[gprof2dot.TIME] = 0.0
+        profile[gprof2dot.TOTAL_TIME] = 0.0
+
+        def getFunction(name):
+            try:
+                return profile.functions[name]
+            except KeyError:
+                function = gprof2dot.Function(name, name)
+                function.called = 0
+                function[gprof2dot.TIME] = 0.0
+                function[gprof2dot.TOTAL_TIME] = 0.0
+                profile.add_function(function)
+                return function
+
+        for (parent, name), (calls, total, selfTime, outerTotal) in self.getTotals().iteritems():
+            callee = getFunction(name)
+            callee.called += calls
+            callee[gprof2dot.TIME] += selfTime
+            callee[gprof2dot.TOTAL_TIME] += outerTotal
+            profile[gprof2dot.TIME] += selfTime
+            if parent is None:
+                profile[gprof2dot.TOTAL_TIME] += total
+                continue
+            call = gprof2dot.Call(callee.id)
+            call[gprof2dot.CALLS] = calls
+            call[gprof2dot.TOTAL_TIME] = outerTotal
+            getFunction(parent).add_call(call)
+
+        # compute derived data
+        profile.validate()
+        profile.ratio(gprof2dot.TIME_RATIO, gprof2dot.TIME)
+        profile.ratio(gprof2dot.TOTAL_TIME_RATIO, gprof2dot.TOTAL_TIME)
+        return profile
+
+
+_tracer = None
+
+
+def startTracing(maxSpans=100000, outputTrace=None):
+    '''
+    Start recording the spans of span, traceIt and timeIt in a SpanTracer
+    If outputTrace is given the chrome trace is written there at exit
+    '''
+    global _tracer
+    if _tracer is None:
+        _tracer = SpanTracer(maxSpans)
+        if outputTrace:
+            import atexit
+            atexit.register(_tracer.exportChromeTrace, outputTrace)
+    return _tracer
+
+
+def stopTracing():
+    ''' Stop recording spans, returns the SpanTracer for export '''
+    global _tracer
+    tracer = _tracer
+    _tracer = None
+    return tracer
+
+
+class span(object):
+    '''
+    Context manager recording its block as a span of the running SpanTracer
+        Ex:
+            with debug.span('loadScene'):
+                ...
+    '''
+
+    __slots__ = ('name', 'tracer')
+
+    def __init__(self, name):
+        self.name = name
+        self.tracer = None
+
+    def __enter__(self):
+        self.tracer = _tracer
+        if self.tracer is not None:
+            self.tracer.enter(self.name)
+        return self
 
+    def __exit__(self, excType, excValue, traceback):
+        if self.tracer is not None:
+            self.tracer.exit()
+            self.tracer = None
 
-def createDotMap(cmd, outputImage=None, openImage=True, outputProfile=None, dotExec=None, showStack=False, _frameDepth=1, msg='', **kwargs):
+
+def _traceGenerator(generator, name):
+    ''' Record the production of every item of a generator as a span '''
+    while True:
+        tracer = _tracer
+        if tracer is not None:
+            tracer.enter(name)
+        try:
+            item = generator.next()
+        finally:
+            if tracer is not None:
+                tracer.exit()
+        yield item
+
+
+def _getFuncName(func):
+    return "{0}.{1}".format(func.__module__, func.__name__)
+
+
+def createDotMap(cmd, outputImage=None, openImage=True, outputProfile=None, outputDot=None, dotExec=None, showStack=False, background=False, threads=True, children=False, _frameDepth=1, msg='', **kwargs):
     '''
     Profile the execution of a command and create a dot map using gprof2dot
     Command should be exactly what the normal code would be in string form
@@ -132,55 +632,165 @@ def createDotMap(cmd, outputImage=None, openImage=True, outputProfile=None, dotE
             doSomething(with, this)
             =
             crateDotMap("doSomething(with, this)", "test.png")
-    You can pass TMP fo
+    The profile never leaves memory, only the image is written (to outputImage
+    or a temp file) and only when it is given or opened. Pass outputProfile or
+    outputDot to also save the pstats profile or the dot source.
+    With background=True the graph is rendered by the DotMapQueue workers and
+    this returns as soon as the command has run, see flushDotMaps.
+    The command can also be a (func, args, kwargs) tuple, see createProfileStats
+    for threads and children.
     '''
-    # Setup Paths
-    outputImagePath = _cleanPath(outputImage)
-    if dotExec is None:
-        dotExec = _getDotExecPath()
+    result, stats, totalTime = createProfileStats(cmd, frameDepth=_frameDepth, threads=threads, children=children)
     if outputProfile:
-        outputProfilePath = _cleanPath(outputProfile)
+        stats.dump_stats(_cleanPath(outputProfile))
+    label = _getDotMapLabel(cmd, totalTime, msg, showStack)
+
+    outputImagePath = None
+    if outputImage or openImage:
+        outputImagePath = _cleanPath(outputImage)
+
+    if background:
+        getDotMapQueue().put(stats, label, outputImagePath, openImage, outputDot, dotExec)
     else:
-        outputProfilePath = "{0}.profile".format(os.path.splitext(outputImagePath)[0])
+        _renderDotMapFile(stats, label, outputImagePath, openImage, outputDot, dotExec)
+
+    return result
 
-    # Create the profile
-    kwargs = {
-        'outputFile': outputProfilePath,
-        'cmd': cmd,
-        'frameDepth': _frameDepth,
-    }
-    result, totalTime = createProfile(**kwargs)
 
-    # Create the gprof configuration
-    gProfOutputPath = "{0}.gprofdot".format(os.path.splitext(outputImagePath)[0])
+def createDotMapImage(cmd, imageFormat='png', outputProfile=None, outputDot=None, dotExec=None, showStack=False, threads=True, children=False, _frameDepth=1, msg=''):
+    '''
+    Profile the execution of a command and render its dot map in memory
+    Returns command result, and the image data (None if dot failed)
+    '''
+    result, stats, totalTime = createProfileStats(cmd, frameDepth=_frameDepth, threads=threads, children=children)
+    if outputProfile:
+        stats.dump_stats(_cleanPath(outputProfile))
+    label = _getDotMapLabel(cmd, totalTime, msg, showStack)
+    image = renderDotMap(getGraphProfile(stats), label, imageFormat=imageFormat, dotExec=dotExec, outputDot=outputDot)
+    return result, image
+
+
+def _getDotMapLabel(cmd, totalTime, msg, showStack):
     if showStack:
         import traceback
-        label = "\"{0}\"".format("\n".join(traceback.format_stack()))
-    else:
-        label = "{0} | Total Time: {1} | {2}".format(cmd, totalTime, msg)
-    _createGProfConfig(gProfOutputPath, outputProfilePath, cmd, label)
+        return "\"{0}\"".format("\n".join(traceback.format_stack()))
+    return "{0} | Total Time: {1} | {2}".format(_getCmdName(cmd), totalTime, msg)
 
-    # Create the dot graph
-    _createDotMap(dotExec, outputImagePath, gProfOutputPath)
 
+def _getCmdName(cmd):
+    ''' Return the string form of a command, or a (func, args, kwargs) tuple '''
+    if isinstance(cmd, basestring):
+        return cmd
+    return "{0}()".format(cmd[0].__name__)
+
+
+def _renderDotMapFile(stats, label, outputImagePath, openImage, outputDot, dotExec):
+    '''
+    Render pstats statistics, or a gprof2dot profile, and write the image
+    if a path is given
+    '''
+    if not isinstance(stats, gprof2dot.Profile):
+        stats = getGraphProfile(stats)
+    image = renderDotMap(stats, label, dotExec=dotExec, outputDot=outputDot)
+    if image is None or outputImagePath is None:
+        return
+    fp = open(outputImagePath, 'wb')
+    try:
+        fp.write(image)
+    finally:
+        fp.close()
+    LOG.info("Dot Graph available at: {0}".format(outputImagePath))
     if openImage:
-        time.sleep(.1)  # Wait for the image to be closed
         envtools.open_file(outputImagePath)
 
-    # # Cleanup
-    # try:
-    #     # os.remove(gProfOutputPath)
-    #     # LOG.debug("Removed: {0}".format(gProfOutputPath))
-    #     if not saveOutputProfile:
-    #         os.remove(outputProfilePath)
-    #         # LOG.debug("Removed: {0}".format(outputProfilePath))
-    # except Exception, e:
-    #     LOG.warning("Warning unable to remove profile. {0}".format(e))
 
-    return result
+class DotMapQueue(object):
+    '''
+    Pool of background threads rendering dot maps
+    Profiles are converted by the worker threads while dot renders in its own
+    processes, so several graphs are produced at once. The queue is bounded:
+    when the workers fall behind, queuing blocks the caller until one of them
+    frees a slot, so pending profiles can not pile up in memory.
+    '''
+
+    def __init__(self, workers=2, maxSize=16):
+        self.queue = Queue.Queue(maxSize)
+        self.threads = []
+        for i in xrange(workers):
+            thread = threading.Thread(target=self._run, name='DotMapQueue-{0}'.format(i))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def put(self, stats, label, outputImagePath=None, openImage=False, outputDot=None, dotExec=None):
+        ''' Queue pstats statistics for rendering, blocks while the queue is full '''
+        self.queue.put((stats, label, outputImagePath, openImage, outputDot, dotExec))
+
+    def _run(self):
+        while True:
+            task = self.queue.get()
+            try:
+                if task is None:
+                    return
+                _renderDotMapFile(*task)
+            except Exception:
+                LOG.exception("Dot map rendering failed")
+            finally:
+                self.queue.task_done()
+
+    def flush(self):
+        ''' Block until every queued dot map has been rendered '''
+        self.queue.join()
 
+    def stop(self):
+        ''' Render the pending dot maps and stop the workers '''
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
 
-def createCacheGrind(cmd, outputProfile=None, _frameDepth=1, **kwargs):
+
+_dotMapQueue = None
+_dotMapQueueLock = threading.Lock()
+
+
+def getDotMapQueue(workers=2, maxSize=16):
+    '''
+    Return the DotMapQueue used by createDotMap(background=True)
+    It is created by the first call, pending dot maps are rendered at exit
+    '''
+    global _dotMapQueue
+    _dotMapQueueLock.acquire()
+    try:
+        if _dotMapQueue is None:
+            import atexit
+            _dotMapQueue = DotMapQueue(workers, maxSize)
+            atexit.register(stopDotMapQueue)
+        return _dotMapQueue
+    finally:
+        _dotMapQueueLock.release()
+
+
+def flushDotMaps():
+    ''' Wait for every dot map queued with background=True to be rendered '''
+    if _dotMapQueue is not None:
+        _dotMapQueue.flush()
+
+
+def stopDotMapQueue():
+    ''' Render the pending dot maps and stop the background workers '''
+    global _dotMapQueue
+    _dotMapQueueLock.acquire()
+    try:
+        if _dotMapQueue is not None:
+            _dotMapQueue.stop()
+            _dotMapQueue = None
+    finally:
+        _dotMapQueueLock.release()
+
+
+def createCacheGrind(cmd, outputProfile=None, threads=True, children=False, _frameDepth=1, **kwargs):
     '''
     Profile the execution of a command and create a dot map using gprof2dot
     Command should be exactly what the normal code would be in string form
@@ -203,6 +813,8 @@ def createCacheGrind(cmd, outputProfile=None, _frameDepth=1, **kwargs):
         'outputFile': outputProfilePath,
         'cmd': cmd,
         'frameDepth': _frameDepth,
+        'threads': threads,
+        'children': children,
     }
     result, totalTime = createProfile(**kwargs)
 
@@ -215,6 +827,217 @@ def createCacheGrind(cmd, outputProfile=None, _frameDepth=1, **kwargs):
     return result
 
 
+class ProfileAccumulator(object):
+    '''
+    cProfile.Profile statistics shared by every call of a function (or key)
+    Every thread calling gets its own profiler (a profiler can only follow
+    one thread), only enabled around the calls, and the statistics of all of
+    them gathered so far are merged and emitted every `everyCalls` calls,
+    every `everySeconds` seconds and at exit. cProfile keeps one entry per
+    function and caller, so memory does not grow with the number of calls,
+    and the profilers of finished threads are folded together when emitting.
+    '''
+
+    def __init__(self, key, emit, everyCalls=None, everySeconds=None):
+        self.key = key
+        # Called with the pstats.Stats, key, calls, totalTime and whether this is the last emit
+        self.emit = emit
+        self.everyCalls = everyCalls
+        self.everySeconds = everySeconds
+        self.calls = 0
+        self.totalTime = 0.0
+        self._lock = threading.Lock()
+        # The profiler and call depth of the calling thread
+        self._local = threading.local()
+        # (thread, cProfile.Profile) of every thread that called
+        self._threadProfiles = []
+        # Statistics of the threads which have finished
+        self._finishedStats = None
+        self._emittedCalls = 0
+        self._emitTime = time.time()
+
+    def call(self, func, args, kwargs):
+        local = self._local
+        profile = getattr(local, 'profile', None)
+        if profile is None:
+            profile = cProfile.Profile()
+            local.profile = profile
+            local.depth = 0
+            self._lock.acquire()
+            try:
+                self._threadProfiles.append((threading.current_thread(), profile))
+            finally:
+                self._lock.release()
+        local.depth += 1
+        if local.depth == 1:
+            startTime = time.time()
+            profile.enable()
+
+        try:
+            return func(*args, **kwargs)
+        finally:
+            local.depth -= 1
+            if not local.depth:
+                profile.disable()
+                due = False
+                self._lock.acquire()
+                try:
+                    self.calls += 1
+                    self.totalTime += time.time() - startTime
+                    if self.everyCalls and self.calls - self._emittedCalls >= self.everyCalls:
+                        due = True
+                    if self.everySeconds and time.time() - self._emitTime >= self.everySeconds:
+                        due = True
+                finally:
+                    self._lock.release()
+                if due:
+                    self.flush()
+
+    def flush(self, final=False):
+        ''' Emit the statistics of every call profiled so far, in every thread '''
+        self._lock.acquire()
+        try:
+            if self.calls == self._emittedCalls:
+                return
+            dicts = []
+            finished = []
+            for threadProfile in list(self._threadProfiles):
+                thread, profile = threadProfile
+                # Calls still running in other threads are included so far
+                profile.snapshot_stats()
+                stats, profile.stats = profile.stats, {}
+                if not thread.is_alive():
+                    self._threadProfiles.remove(threadProfile)
+                    if stats:
+                        finished.append(stats)
+                elif stats:
+                    dicts.append(stats)
+            if finished:
+                if self._finishedStats:
+                    finished.append(self._finishedStats)
+                self._finishedStats = gprof2dot.merge_pstats(finished)
+            if self._finishedStats:
+                # merge_pstats adds to the first dictionary, keep this one last
+                dicts.append(dict(self._finishedStats))
+            calls = self.calls
+            totalTime = self.totalTime
+            self._emittedCalls = calls
+            self._emitTime = time.time()
+        finally:
+            self._lock.release()
+        if not dicts:
+            return
+        try:
+            stats = pstats.Stats(gprof2dot.PstatsData(gprof2dot.merge_pstats(dicts)))
+            self.emit(stats, self.key, calls, totalTime, final)
+        except Exception:
+            LOG.exception("Unable to emit the accumulated profile of {0}".format(self.key))
+
+
+_accumulators = {}
+_accumulatorsLock = threading.Lock()
+
+
+def getProfileAccumulator(key, emit, everyCalls=None, everySeconds=None):
+    '''
+    Return the ProfileAccumulator of a key, created by the first call
+    Accumulated profiles are emitted one last time at exit
+    '''
+    _accumulatorsLock.acquire()
+    try:
+        if not _accumulators:
+            import atexit
+            atexit.register(_flushAccumulatedProfilesAtExit)
+        try:
+            return _accumulators[key]
+        except KeyError:
+            accumulator = ProfileAccumulator(key, emit, everyCalls, everySeconds)
+            _accumulators[key] = accumulator
+            return accumulator
+    finally:
+        _accumulatorsLock.release()
+
+
+def flushAccumulatedProfiles():
+    ''' Emit the statistics accumulated by every accumulate mode decorator '''
+    for accumulator in _accumulators.values():
+        accumulator.flush()
+
+
+def _flushAccumulatedProfilesAtExit():
+    for accumulator in _accumulators.values():
+        accumulator.flush(final=True)
+    # Background renders queued by the last emits must complete before exit
+    stopDotMapQueue()
+
+
+def _popAccumulateOptions(kwargs):
+    '''
+    Remove the accumulate mode options from decorator kwargs
+    Returns them as a dict, None if the decorator does not accumulate
+    '''
+    options = dict(
+        accumulate=kwargs.pop('accumulate', False),
+        key=kwargs.pop('key', None),
+        everyCalls=kwargs.pop('everyCalls', None),
+        everySeconds=kwargs.pop('everySeconds', None),
+    )
+    if not (options['accumulate'] or options['key']):
+        return None
+    return options
+
+
+def _accumulateWrapper(func, options, emit, emitKwargs):
+    key = options['key']
+    if key is None:
+        key = _getFuncName(func)
+
+    def emitProfile(stats, key, calls, totalTime, final):
+        emit(stats, key, calls, totalTime, final, **emitKwargs)
+
+    def wrapper(*args, **kwargs):
+        accumulator = getProfileAccumulator(key, emitProfile, options['everyCalls'], options['everySeconds'])
+        return accumulator.call(func, args, kwargs)
+    return wrapper
+
+
+def _getAccumulatedPath(key, ext):
+    return getTempFile("profileGraph_{0}{1}".format(re.sub(r'[^\w.-]', '_', key), ext))
+
+
+def _emitDotMap(stats, key, calls, totalTime, final, outputImage=None, openImage=True, outputProfile=None, outputDot=None, dotExec=None, background=False, msg='', **kwargs):
+    '''
+    Render accumulated statistics, the image is overwritten by every emit
+    and only opened by the last one
+    '''
+    if outputProfile:
+        stats.dump_stats(_cleanPath(outputProfile))
+    label = "{0} | Calls: {1} | Total Time: {2} | {3}".format(key, calls, totalTime, msg)
+    if outputImage is None:
+        outputImage = _getAccumulatedPath(key, '.png')
+    outputImagePath = _cleanPath(outputImage)
+    openImage = openImage and final
+    if background and not final:
+        getDotMapQueue().put(stats, label, outputImagePath, openImage, outputDot, dotExec)
+    else:
+        _renderDotMapFile(stats, label, outputImagePath, openImage, outputDot, dotExec)
+
+
+def _emitCacheGrind(stats, key, calls, totalTime, final, outputProfile=None, **kwargs):
+    '''
+    Convert accumulated statistics for qcachegrind, the files are overwritten
+    by every emit and qcachegrind is only launched by the last one
+    '''
+    if outputProfile is None:
+        outputProfile = _getAccumulatedPath(key, '.profile')
+    outputProfilePath = "{0}.profile".format(os.path.splitext(_cleanPath(outputProfile))[0])
+    calltreePath = os.path.splitext(outputProfilePath)[0] + '.calltree'
+    stats.dump_stats(outputProfilePath)
+    _createPyCallGraph(outputProfilePath, calltreePath)
+    if final:
+        _launchQCacheGrind(calltreePath)
+
+
 PYPROF2CALLTREEEXEC = 'pyprof2calltree'
 def _createPyCallGraph(profilePath, outputCallTreeFilePath):
     cmd = "{0} -i \"{1}\" -o \"{2}\"".format(PYPROF2CALLTREEEXEC, profilePath, outputCallTreeFilePath)
@@ -242,7 +1065,7 @@ def _launchQCacheGrind(calltreePath):
     return p
 
 
-def createProfile(cmd, outputFile, global_dict=None, local_dict=None, frameDepth=0):
+def createProfile(cmd, outputFile, global_dict=None, local_dict=None, frameDepth=0, threads=True, children=False):
     '''
     Profile the execution of a command and save it to a file
     Returns command result, and totalTime
@@ -251,13 +1074,900 @@ def createProfile(cmd, outputFile, global_dict=None, local_dict=None, frameDepth
         call_frame = sys._getframe(frameDepth).f_back
         local_dict = call_frame.f_locals
         global_dict = call_frame.f_globals
-    outputFile = _cleanPath(outputFile)
+    result, stats, totalTime = createProfileStats(cmd, global_dict, local_dict, threads=threads, children=children)
+    stats.dump_stats(_cleanPath(outputFile))
+    return result, totalTime
+
+
+def createProfileStats(cmd, global_dict=None, local_dict=None, frameDepth=0, threads=True, children=False):
+    '''
+    Profile the execution of a command in memory
+    The command is either an expression string evaluated in the caller's
+    namespace, or a (func, args, kwargs) tuple.
+    threads also profiles the threads started during the command, and
+    children the python processes it starts (multiprocessing workers, and
+    subprocesses launched through production.processing.launch_subprocess or
+    with env=childEnviron()), as long as they exit before it returns.
+    Returns command result, the merged pstats.Stats and totalTime
+    '''
+    if isinstance(cmd, basestring):
+        if local_dict is None and global_dict is None:
+            call_frame = sys._getframe(frameDepth).f_back
+            local_dict = call_frame.f_locals
+            global_dict = call_frame.f_globals
+        func, args, kwargs = eval, (compile(cmd, '<string>', 'eval'), global_dict, local_dict), {}
+    else:
+        func, args, kwargs = cmd
+
+    profiler = ThreadProfiler(threads)
+    childProfiles = None
+    if children:
+        childProfiles = ChildProfiles()
+        childProfiles.start()
     startTime = time.time()
+    try:
+        result = profiler.runcall(func, *args, **kwargs)
+    finally:
+        totalTime = time.time() - startTime
+        childFiles = []
+        if childProfiles is not None:
+            childFiles = childProfiles.stop()
+
+    try:
+        stats = profiler.getStats(childFiles)
+    finally:
+        if childProfiles is not None:
+            childProfiles.cleanup()
+    return result, stats, totalTime
+
+
+# Per thread state: the ThreadProfiler following the thread, and the
+# ChildProfiles collecting the processes it forks
+_threadOwner = threading.local()
+
+
+class _SharedPatch(object):
+    '''
+    Replace an attribute of a class or module while anybody needs it
+    The replacement is global to the process, acquire installs it for the
+    first user and release puts the original back after the last one.
+    '''
+
+    def __init__(self, owner, name, replacement):
+        self.owner = owner
+        self.name = name
+        self.replacement = replacement
+        self.original = None
+        self._users = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        self._lock.acquire()
+        try:
+            if not self._users:
+                self.original = vars(self.owner)[self.name]
+                setattr(self.owner, self.name, self.replacement)
+            self._users += 1
+        finally:
+            self._lock.release()
+
+    def release(self):
+        self._lock.acquire()
+        try:
+            self._users -= 1
+            if not self._users:
+                setattr(self.owner, self.name, self.original)
+        finally:
+            self._lock.release()
+
+
+class ThreadProfiler(object):
+    '''
+    cProfile a thread and the threads it starts
+    The thread calling start is profiled directly, threads it starts through
+    the threading module while the profiler runs get their own
+    cProfile.Profile (a profiler can only follow one thread), and getStats
+    merges them all. Threads belong to the profiler of the thread starting
+    them, so concurrent profilers never see each other's threads.
+    To see them start, threading.Thread.start is replaced for the whole
+    process while any profiler follows threads: threads started elsewhere
+    (other libraries included) go through the replacement too, which starts
+    them unchanged.
+    '''
 
-    cProfile.runctx(cmd, global_dict, local_dict, outputFile)
+    def __init__(self, threads=True):
+        self.threads = threads
+        self.profile = cProfile.Profile()
+        self.threadProfiles = []
+        self.threadStats = []
+        self.running = False
+        self._lock = threading.Lock()
+        self._previous = None
+
+    def start(self):
+        if self.threads:
+            _threadStartPatch.acquire()
+        self._previous = getattr(_threadOwner, 'profiler', None)
+        _threadOwner.profiler = self
+        self.running = True
+        self.profile.enable()
+
+    def stop(self):
+        ''' Stop profiling and collect the threads, still running or not '''
+        try:
+            self.profile.disable()
+            _threadOwner.profiler = self._previous
+            self._lock.acquire()
+            try:
+                self.running = False
+                threadProfiles, self.threadProfiles = self.threadProfiles, []
+            finally:
+                self._lock.release()
+            for prof in threadProfiles:
+                # Threads outliving the call disable their profiler as they end,
+                # only what they did until now is kept
+                prof.snapshot_stats()
+                if prof.stats:
+                    self.threadStats.append(prof.stats)
+                prof.stats = {}
+        finally:
+            if self.threads:
+                _threadStartPatch.release()
+
+    def runcall(self, func, *args, **kwargs):
+        self.start()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.stop()
+
+    def addThread(self):
+        ''' Return the profile of a new thread, None once stopped '''
+        self._lock.acquire()
+        try:
+            if not self.running:
+                return None
+            prof = cProfile.Profile()
+            self.threadProfiles.append(prof)
+            return prof
+        finally:
+            self._lock.release()
+
+    def getStats(self, profileFiles=()):
+        ''' Return a pstats.Stats merging every thread, and the given pstats files '''
+        self.profile.snapshot_stats()
+        dicts = [self.profile.stats] + self.threadStats
+        self.profile.stats = {}
+        if profileFiles:
+            dicts.append(gprof2dot.load_pstats(profileFiles))
+        return pstats.Stats(gprof2dot.PstatsData(gprof2dot.merge_pstats([stats for stats in dicts if stats])))
+
+
+def _startProfiledThread(thread):
+    ''' Replaces threading.Thread.start while a ThreadProfiler runs '''
+    profiler = getattr(_threadOwner, 'profiler', None)
+    if profiler is not None and profiler.threads:
+        thread.run = _ProfiledRun(profiler, thread.run)
+    return _threadStartPatch.original(thread)
+
+
+_threadStartPatch = _SharedPatch(threading.Thread, 'start', _startProfiledThread)
+
+
+class _ProfiledRun(object):
+    ''' Thread.run of a thread started by a profiled thread '''
+
+    def __init__(self, profiler, run):
+        self.profiler = profiler
+        self.run = run
+
+    def __call__(self):
+        prof = self.profiler.addThread()
+        if prof is None:
+            return self.run()
+        _threadOwner.profiler = self.profiler
+        prof.enable()
+        try:
+            return self.run()
+        finally:
+            prof.disable()
+
+
+CHILD_PROFILE_ENV = 'DEBUG_PROFILE_CHILDREN_DIR'
+
+# Imported by the python children through PYTHONPATH, it profiles the whole
+# child with cProfile alone, without importing debug, then chains to the
+# sitecustomize this shadows
+_SITECUSTOMIZE = '''
+import os, sys
+
+def _startChildProfile(outputDir):
+    import atexit, cProfile
+    profile = cProfile.Profile()
+    def write():
+        profile.disable()
+        path = os.path.join(outputDir, 'child_%d.profile' % os.getpid())
+        try:
+            profile.dump_stats(path + '.tmp')
+            os.rename(path + '.tmp', path)
+        except (IOError, OSError):
+            pass
+    atexit.register(write)
+    profile.enable()
+
+if os.environ.get('{0}'):
+    _startChildProfile(os.environ['{0}'])
+try:
+    import imp
+    _dir = os.path.dirname(os.path.abspath(__file__))
+    _path = [p for p in sys.path if os.path.abspath(p or '.') != _dir]
+    imp.load_module('_sitecustomize', *imp.find_module('sitecustomize', _path))
+except ImportError:
+    pass
+'''.format(CHILD_PROFILE_ENV)
+
+
+class ChildProfiles(object):
+    '''
+    Collect the profiles of the python processes started during a call
+    While started, multiprocessing workers forked by the calling thread
+    profile themselves with startChildProfile, and python processes launched
+    through production.processing.launch_subprocess, or with the environment
+    of childEnviron, profile themselves through a sitecustomize hook. Both
+    write their stats to a temp directory at exit.
+    launch_subprocess is replaced for the whole process while any
+    ChildProfiles runs, to add the hook to the env it is given. Processes
+    forked or launched by other threads (the thread of a multiprocessing.Pool
+    replacing its workers, for one) go to the last ChildProfiles started in
+    the process, there is no telling which call they belong to.
+    Nothing is changed in the environment of this process.
+    '''
 
-    result = global_dict['_profile_result']
-    return result, (time.time() - startTime)
+    def __init__(self):
+        import tempfile
+        self.outputDir = tempfile.mkdtemp(prefix='childProfiles_', dir=getTempFile(''))
+        self.siteDir = os.path.join(self.outputDir, 'site')
+        self._previous = None
+
+    def start(self):
+        _registerAfterFork()
+        os.mkdir(self.siteDir)
+        fp = open(os.path.join(self.siteDir, 'sitecustomize.py'), 'wt')
+        try:
+            fp.write(_SITECUSTOMIZE)
+        finally:
+            fp.close()
+        self._previous = getattr(_threadOwner, 'childProfiles', None)
+        _threadOwner.childProfiles = self
+        _runningChildProfiles.append(self)
+        _launchSubprocessPatch.acquire()
+
+    def stop(self):
+        ''' Return the child profiles written so far '''
+        try:
+            _threadOwner.childProfiles = self._previous
+            _runningChildProfiles.remove(self)
+        finally:
+            _launchSubprocessPatch.release()
+        return [os.path.join(self.outputDir, name) for name in sorted(os.listdir(self.outputDir)) if name.endswith('.profile')]
+
+    def cleanup(self):
+        import shutil
+        shutil.rmtree(self.outputDir, ignore_errors=True)
+
+    def environ(self, env=None):
+        ''' Return a copy of env (os.environ by default) profiling the python children '''
+        env = dict(os.environ if env is None else env)
+        env[CHILD_PROFILE_ENV] = self.outputDir
+        env['PYTHONPATH'] = os.pathsep.join(filter(None, [self.siteDir, env.get('PYTHONPATH')]))
+        return env
+
+
+# Every ChildProfiles started in the process, for the threads it did not start
+_runningChildProfiles = []
+
+
+def _currentChildProfiles():
+    ''' The ChildProfiles of the calling thread, else the last one started '''
+    childProfiles = getattr(_threadOwner, 'childProfiles', None)
+    if childProfiles is None:
+        try:
+            childProfiles = _runningChildProfiles[-1]
+        except IndexError:
+            pass
+    return childProfiles
+
+
+def childEnviron(env=None):
+    '''
+    Return the environment to launch a python subprocess with so that a
+    profile using children=True includes it, for launchers other than
+    production.processing.launch_subprocess
+        Ex:
+            subprocess.call(["python", "worker.py"], env=childEnviron())
+    Outside of such a profile a plain copy of env (os.environ by default)
+    is returned.
+    '''
+    childProfiles = _currentChildProfiles()
+    if childProfiles is None:
+        return dict(os.environ if env is None else env)
+    return childProfiles.environ(env)
+
+
+def _launchProfiledSubprocess(*args, **kwargs):
+    ''' Replaces production.processing.launch_subprocess while a ChildProfiles runs '''
+    childProfiles = _currentChildProfiles()
+    if childProfiles is not None:
+        kwargs['env'] = childProfiles.environ(kwargs.get('env'))
+    return _launchSubprocessPatch.original(*args, **kwargs)
+
+
+_launchSubprocessPatch = _SharedPatch(production.processing, 'launch_subprocess', _launchProfiledSubprocess)
+
+
+_childProfile = None
+_afterForkRegistered = False
+_afterForkLock = threading.Lock()
+
+
+def startChildProfile(outputDir):
+    '''
+    Profile this whole process for a parent using children=True
+    Started in the multiprocessing workers the parent forks, the stats are
+    written to outputDir at exit for the parent to merge
+    '''
+    global _childProfile
+    if _childProfile is not None and _childProfile[0] == os.getpid():
+        return
+    # Forked children inherit the profiler of the parent thread
+    sys.setprofile(None)
+    profiler = ThreadProfiler()
+    _childProfile = (os.getpid(), profiler, outputDir)
+    profiler.start()
+
+    import atexit
+    atexit.register(_writeChildProfile)
+    if 'multiprocessing' in sys.modules:
+        # multiprocessing workers leave through os._exit, skipping atexit
+        import multiprocessing.util
+        multiprocessing.util.Finalize(None, _writeChildProfile, exitpriority=0)
+
+
+def _writeChildProfile():
+    global _childProfile
+    if _childProfile is None or _childProfile[0] != os.getpid():
+        return
+    pid, profiler, outputDir = _childProfile
+    _childProfile = None
+    profiler.stop()
+    path = os.path.join(outputDir, "child_{0}.profile".format(pid))
+    try:
+        profiler.getStats().dump_stats(path + '.tmp')
+        os.rename(path + '.tmp', path)
+    except (IOError, OSError), e:
+        LOG.warning("Unable to write child profile {0}: {1}".format(path, e))
+
+
+def _profileForkedChild(obj):
+    # The forking thread carries on in the child, along with its locals
+    childProfiles = _currentChildProfiles()
+    if childProfiles is not None:
+        startChildProfile(childProfiles.outputDir)
+
+
+def _registerAfterFork():
+    ''' Have multiprocessing start the profile of the workers it forks '''
+    global _afterForkRegistered
+    _afterForkLock.acquire()
+    try:
+        if not _afterForkRegistered:
+            import multiprocessing.util
+            multiprocessing.util.register_after_fork(_profileForkedChild, _profileForkedChild)
+            _afterForkRegistered = True
+    finally:
+        _afterForkLock.release()
+
+
+def getGraphProfile(stats):
+    '''
+    Convert a pstats.Stats (or cProfile.Profile) to a gprof2dot profile
+    without going through a pstats file
+    '''
+    return gprof2dot.PstatsParser(stats).parse()
+
+
+def createSampledDotMap(cmd, interval=0.005, outputImage=None, openImage=True, dotExec=None, _frameDepth=1, msg='', **kwargs):
+    '''
+    Sample the execution of a command and create a dot map using gprof2dot
+    Unlike createDotMap the command is not instrumented, the call stack is
+    periodically sampled instead, so hot code runs at full speed.
+        Ex:
+            createSampledDotMap("doSomething(with, this)", interval=0.001)
+    The command can also be a (func, args, kwargs) tuple, other keyword
+    arguments are passed on to createSampledProfile.
+    '''
+    # Sample the command
+    result, profile, totalTime = createSampledProfile(cmd, interval, frameDepth=_frameDepth, **kwargs)
+
+    # Create the dot graph
+    label = "{0} | Total Time: {1} | Samples: {2} | {3}".format(_getCmdName(cmd), totalTime, profile[gprof2dot.SAMPLES], msg)
+    _renderDotMapFile(profile, label, _cleanPath(outputImage), openImage, None, dotExec)
+
+    return result
+
+
+def createSampledProfile(cmd, interval=0.005, global_dict=None, local_dict=None, frameDepth=0):
+    '''
+    Sample the execution of a command with a StackSampler
+    The command is either an expression string evaluated in the caller's
+    namespace, or a (func, args, kwargs) tuple.
+    Returns command result, the gprof2dot profile and totalTime
+    '''
+    if isinstance(cmd, basestring):
+        if local_dict is None and global_dict is None:
+            call_frame = sys._getframe(frameDepth).f_back
+            local_dict = call_frame.f_locals
+            global_dict = call_frame.f_globals
+        func, args, kwargs = eval, (compile(cmd, '<string>', 'eval'), global_dict, local_dict), {}
+    else:
+        func, args, kwargs = cmd
+
+    sampler = StackSampler(interval=interval, threadIds=[_currentThreadId()])
+    sampler.rootFrame = sys._getframe()
+    startTime = time.time()
+    sampler.start()
+    try:
+        result = func(*args, **kwargs)
+    finally:
+        sampler.stop()
+    totalTime = time.time() - startTime
+
+    return result, sampler.buildProfile(), totalTime
+
+
+class StackSampler(object):
+    '''
+    Statistical profiler that walks the stacks of running threads from a
+    background timer thread every `interval` seconds.
+    Nothing is instrumented so the overhead only depends on the sampling
+    rate, not on the number of calls made by the sampled code.
+    '''
+
+    def __init__(self, interval=0.005, threadIds=None):
+        self.interval = interval
+        # Ids of the threads to sample, None samples every thread
+        self.threadIds = threadIds
+        # Frame where the stack walk stops (excluded), None walks the whole stack
+        self.rootFrame = None
+        # Stacks of code objects (leaf first) and their sample counts
+        self.stacks = {}
+        self.sampleCount = 0
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        if self._running:
+            return
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name='StackSampler')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        if not self._running:
+            return
+        self._running = False
+        if self._thread is not threading.current_thread():
+            self._thread.join()
+        self._thread = None
+
+    def _run(self):
+        ownId = _currentThreadId()
+        while True:
+            time.sleep(self.interval)
+            if not self._running:
+                break
+            self.sample(ownId)
+
+    def sample(self, ownId=None):
+        ''' Record the current stack of every sampled thread '''
+        threadIds = self.threadIds
+        rootFrame = self.rootFrame
+        stacks = self.stacks
+        for threadId, frame in sys._current_frames().iteritems():
+            if threadId == ownId:
+                continue
+            if threadIds is not None and threadId not in threadIds:
+                continue
+            stack = []
+            while frame is not None and frame is not rootFrame:
+                stack.append(frame.f_code)
+                frame = frame.f_back
+            if not stack:
+                continue
+            stack = tuple(stack)
+            stacks[stack] = stacks.get(stack, 0) + 1
+            self.sampleCount += 1
+
+    def buildProfile(self):
+        '''
+        Convert the recorded stacks into a gprof2dot profile,
+        the same way gprof2dot.PerfParser handles perf callchains
+        '''
+        profile = gprof2dot.Profile()
+        profile[gprof2dot.SAMPLES] = 0
+        functions = {}
+        for stack, count in self.stacks.iteritems():
+            callee = _getSampledFunction(profile, functions, stack[0])
+            callee[gprof2dot.SAMPLES] += count
+            profile[gprof2dot.SAMPLES] += count
+            for code in stack[1:]:
+                caller = _getSampledFunction(profile, functions, code)
+                try:
+                    call = caller.calls[callee.id]
+                except KeyError:
+                    call = gprof2dot.Call(callee.id)
+                    call[gprof2dot.SAMPLES2] = count
+                    caller.add_call(call)
+                else:
+                    call[gprof2dot.SAMPLES2] += count
+                callee = caller
+
+        # compute derived data
+        profile.validate()
+        profile.find_cycles()
+        profile.ratio(gprof2dot.TIME_RATIO, gprof2dot.SAMPLES)
+        profile.call_ratios(gprof2dot.SAMPLES2)
+        profile.integrate(gprof2dot.TOTAL_TIME_RATIO, gprof2dot.TIME_RATIO)
+        return profile
+
+
+def _getSampledFunction(profile, functions, code):
+    ''' Return the profile function of a code object, named like pstats functions '''
+    try:
+        return functions[code]
+    except KeyError:
+        pass
+    name = _getCodeName(code)
+    try:
+        function = profile.functions[name]
+    except KeyError:
+        function = gprof2dot.Function(name, name)
+        function[gprof2dot.SAMPLES] = 0
+        profile.add_function(function)
+    functions[code] = function
+    return function
+
+
+def createMemoryMap(cmd, outputImage=None, openImage=True, dotExec=None, nframes=25, _frameDepth=1, msg='', **kwargs):
+    '''
+    Trace the memory allocations of a command and create a dot map using gprof2dot
+    Nodes are weighted by the bytes allocated by the command and still
+    alive when it returns, so leaks and caches stand out.
+        Ex:
+            createMemoryMap("loadAssets(scene)")
+    '''
+    result, profile, peak = createMemoryProfile(cmd, nframes=nframes, frameDepth=_frameDepth)
+    label = "{0} | Retained: {1} | Peak: {2} | {3}".format(_getCmdName(cmd), gprof2dot.size(profile[gprof2dot.BYTES]), gprof2dot.size(peak), msg)
+    _renderDotMapFile(profile, label, _cleanPath(outputImage), openImage, None, dotExec)
+
+    return result
+
+
+def createMemoryProfile(cmd, nframes=25, global_dict=None, local_dict=None, frameDepth=0):
+    '''
+    Trace the memory allocations of a command with tracemalloc
+    The command is either an expression string evaluated in the caller's
+    namespace, or a (func, args, kwargs) tuple. Only `nframes` frames of
+    every allocation are kept.
+    Returns command result, the gprof2dot profile of the bytes still
+    allocated at the end and the peak traced memory
+    '''
+    if isinstance(cmd, basestring):
+        if local_dict is None and global_dict is None:
+            call_frame = sys._getframe(frameDepth).f_back
+            local_dict = call_frame.f_locals
+            global_dict = call_frame.f_globals
+        func, args, kwargs = eval, (compile(cmd, '<string>', 'eval'), global_dict, local_dict), {}
+    else:
+        func, args, kwargs = cmd
+
+    tracemalloc = _importTracemalloc()
+    wasTracing = tracemalloc.is_tracing()
+    if not wasTracing:
+        tracemalloc.start(nframes)
+    try:
+        tracemalloc.clear_traces()
+        before = tracemalloc.take_snapshot()
+        result = func(*args, **kwargs)
+        after = tracemalloc.take_snapshot()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        if not wasTracing:
+            tracemalloc.stop()
+
+    # Drop the allocations of tracemalloc itself
+    filters = [tracemalloc.Filter(False, tracemalloc.__file__)]
+    stats = after.filter_traces(filters).compare_to(before.filter_traces(filters), 'traceback')
+    return result, _buildMemoryProfile(stats), peak
+
+
+def _importTracemalloc():
+    '''
+    Return the tracemalloc module, python 2 only has it when patched with
+    pytracemalloc (http://pytracemalloc.readthedocs.io)
+    '''
+    try:
+        import tracemalloc
+    except ImportError:
+        raise ImportError("Memory profiling needs tracemalloc, install a python patched with pytracemalloc")
+    return tracemalloc
+
+
+def _buildMemoryProfile(stats):
+    '''
+    Convert tracemalloc statistics into a gprof2dot profile, the same way
+    StackSampler.buildProfile handles sampled stacks, with the retained bytes
+    as samples. TOTAL_BYTES holds the bytes retained below each function and
+    call, and TOTAL_TIME_RATIO their share of the total, used for pruning and
+    coloring.
+    '''
+    profile = gprof2dot.Profile()
+    profile[gprof2dot.BYTES] = 0
+    profile[gprof2dot.ALLOCS] = 0
+    functions = {}
+    for stat in stats:
+        if stat.size_diff <= 0:
+            continue
+        # pytracemalloc lists the most recent frame first
+        frames = list(stat.traceback)
+        callee = _getMemoryFunction(profile, functions, frames[0])
+        callee[gprof2dot.BYTES] += stat.size_diff
+        callee[gprof2dot.ALLOCS] += max(stat.count_diff, 0)
+        profile[gprof2dot.BYTES] += stat.size_diff
+        profile[gprof2dot.ALLOCS] += max(stat.count_diff, 0)
+        for frame in frames[1:]:
+            caller = _getMemoryFunction(profile, functions, frame)
+            try:
+                call = caller.calls[callee.id]
+            except KeyError:
+                call = gprof2dot.Call(callee.id)
+                call[gprof2dot.BYTES] = stat.size_diff
+                caller.add_call(call)
+            else:
+                call[gprof2dot.BYTES] += stat.size_diff
+            callee = caller
+
+    # compute derived data
+    profile.validate()
+    profile.find_cycles()
+    profile.call_ratios(gprof2dot.BYTES)
+    profile.integrate(gprof2dot.TOTAL_BYTES, gprof2dot.BYTES)
+    profile.ratio(gprof2dot.TOTAL_TIME_RATIO, gprof2dot.TOTAL_BYTES)
+    return profile
+
+
+def _getMemoryFunction(profile, functions, frame):
+    ''' Return the profile function of the function around a traceback frame '''
+    key = (frame.filename, frame.lineno)
+    try:
+        return functions[key]
+    except KeyError:
+        pass
+    name = _getLineFunctionName(frame.filename, frame.lineno)
+    try:
+        function = profile.functions[name]
+    except KeyError:
+        function = gprof2dot.Function(name, name)
+        function[gprof2dot.BYTES] = 0
+        function[gprof2dot.ALLOCS] = 0
+        profile.add_function(function)
+    functions[key] = function
+    return function
+
+
+_sourceFunctions = {}
+
+
+def _getLineFunctionName(filename, lineno):
+    '''
+    Return the name of the function containing a source line, formatted like
+    pstats functions, tracemalloc frames only know the file and line
+    '''
+    try:
+        definitions = _sourceFunctions[filename]
+    except KeyError:
+        definitions = _sourceFunctions[filename] = _getSourceFunctions(filename)
+    name = None
+    for firstLine, lastLine, defName in definitions:
+        # Nested definitions come after their parent, the innermost wins
+        if firstLine <= lineno <= lastLine:
+            name = (firstLine, defName)
+    module = os.path.splitext(os.path.basename(filename))[0]
+    if name is None:
+        return "{0}:{1}".format(module, lineno)
+    return "{0}:{1}:{2}".format(module, name[0], name[1])
+
+
+def _getSourceFunctions(filename):
+    ''' Return the (first line, last line, name) of every function of a source file '''
+    import ast
+    try:
+        fp = open(filename, 'rU')
+        try:
+            tree = ast.parse(fp.read(), filename)
+        finally:
+            fp.close()
+    except (IOError, SyntaxError, TypeError):
+        return []
+    definitions = []
+    for node in ast.walk(tree):
+        if isinstance(node, ast.FunctionDef):
+            lastLine = max(getattr(child, 'lineno', node.lineno) for child in ast.walk(node))
+            definitions.append((node.lineno, lastLine, node.name))
+    definitions.sort()
+    return definitions
+
+
+class ContinuousProfiler(StackSampler):
+    '''
+    Always-on sampler meant to run for the whole life of a process.
+    Stacks are aggregated into a trie of at most `maxNodes` code objects,
+    the stacks which do not fit are counted on a single truncated node. It is
+    written as a gprof2dot snapshot (gprof2dot -f snapshot) and reset
+    every `flushInterval` seconds, so memory does not grow with uptime.
+    '''
+
+    def __init__(self, outputDir=None, rate=100.0, flushInterval=3600.0, maxNodes=100000):
+        StackSampler.__init__(self, interval=1.0 / rate)
+        if outputDir is None:
+            outputDir = getTempFile('continuousProfiles')
+        self.outputDir = outputDir
+        self.flushInterval = flushInterval
+        self.maxNodes = maxNodes
+        self._lock = threading.Lock()
+        self._resetTrie()
+
+    def _resetTrie(self):
+        # Node 0 is the root, every node stores the code object of its frame,
+        # its parent node, the samples where it was the leaf and its children
+        self._nodeCodes = [None]
+        self._nodeParents = [-1]
+        self._nodeSamples = [0]
+        self._nodeChildren = [{}]
+        self._startTime = time.time()
+        self.sampleCount = 0
+
+    def _childNode(self, node, code):
+        children = self._nodeChildren[node]
+        try:
+            return children[code]
+        except KeyError:
+            pass
+        if len(self._nodeCodes) >= self.maxNodes - 1:
+            # Trie is full, the last slot is kept for a single truncated
+            # node below the root which gathers the stacks that do not fit,
+            # so the trie never exceeds maxNodes and the total samples stay correct
+            node = 0
+            code = None
+            children = self._nodeChildren[node]
+            try:
+                return children[code]
+            except KeyError:
+                pass
+        child = len(self._nodeCodes)
+        self._nodeCodes.append(code)
+        self._nodeParents.append(node)
+        self._nodeSamples.append(0)
+        self._nodeChildren.append({})
+        children[code] = child
+        return child
+
+    def sample(self, ownId=None):
+        ''' Add the current stack of every thread to the trie '''
+        frames = sys._current_frames()
+        self._lock.acquire()
+        try:
+            for threadId, frame in frames.iteritems():
+                if threadId == ownId:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(frame.f_code)
+                    frame = frame.f_back
+                node = 0
+                for code in reversed(stack):
+                    node = self._childNode(node, code)
+                    if self._nodeCodes[node] is None:
+                        break
+                self._nodeSamples[node] += 1
+                self.sampleCount += 1
+        finally:
+            self._lock.release()
+        if time.time() - self._startTime >= self.flushInterval:
+            self.flush()
+
+    def flush(self):
+        ''' Write the trie collected so far as a snapshot and start a new one '''
+        self._lock.acquire()
+        try:
+            codes = self._nodeCodes
+            parents = self._nodeParents
+            samples = self._nodeSamples
+            startTime = self._startTime
+            sampleCount = self.sampleCount
+            self._resetTrie()
+        finally:
+            self._lock.release()
+        if not sampleCount:
+            return None
+
+        if not os.path.isdir(self.outputDir):
+            os.makedirs(self.outputDir)
+        name = "profile_{0}_{1}.snapshot".format(os.getpid(), time.strftime('%Y%m%d-%H%M%S', time.localtime(startTime)))
+        path = os.path.join(self.outputDir, name)
+
+        names = {}
+        fp = open(path, 'wt')
+        try:
+            fp.write("# gprof2dot snapshot\n")
+            fp.write("# pid={0} start={1:f} end={2:f} interval={3:f}\n".format(os.getpid(), startTime, time.time(), self.interval))
+            for node in xrange(1, len(codes)):
+                code = codes[node]
+                try:
+                    nameIndex = names[code]
+                except KeyError:
+                    nameIndex = len(names)
+                    names[code] = nameIndex
+                    fp.write("fn {0} {1}\n".format(nameIndex, _getCodeName(code)))
+                fp.write("node {0} {1} {2}\n".format(parents[node], nameIndex, samples[node]))
+        finally:
+            fp.close()
+        LOG.debug("Continuous profile snapshot written to: {0}".format(path))
+        return path
+
+    def stop(self):
+        StackSampler.stop(self)
+        self.flush()
+
+
+_continuousProfiler = None
+
+
+def startContinuousProfiler(outputDir=None, rate=100.0, flushInterval=3600.0, maxNodes=100000):
+    '''
+    Start sampling every thread of the process in the background
+    A snapshot is written to outputDir every flushInterval seconds and at exit
+    '''
+    global _continuousProfiler
+    if _continuousProfiler is None:
+        import atexit
+        _continuousProfiler = ContinuousProfiler(outputDir, rate, flushInterval, maxNodes)
+        _continuousProfiler.start()
+        atexit.register(stopContinuousProfiler)
+    return _continuousProfiler
+
+
+def stopContinuousProfiler():
+    ''' Stop the continuous profiler and write its last snapshot '''
+    global _continuousProfiler
+    if _continuousProfiler is not None:
+        _continuousProfiler.stop()
+        _continuousProfiler = None
+
+
+def _getCodeName(code):
+    ''' Return the name of a code object, formatted like pstats functions '''
+    if code is None:
+        return '[truncated]'
+    module = os.path.splitext(os.path.basename(code.co_filename))[0]
+    return "{0}:{1}:{2}".format(module, code.co_firstlineno, code.co_name)
+
+
+def _currentThreadId():
+    ''' Return the id of the current thread as used by sys._current_frames '''
+    import thread
+    return thread.get_ident()
 
 
 def test_createDotMap():
@@ -281,30 +1991,40 @@ def _cleanPath(path):
     return path
 
 
-def _createGProfConfig(outputPath, outputProfile, cmd, label):
-    ''' Create the dot graph configuration file from gprof2dot '''
-    gprofCmd = [
-        "",
-        "-f", "pstats", outputProfile,
-        "-o", outputPath,
-        "-l", label,
-    ]
-    sys.argv = gprofCmd
-    gProf = gprof2dot.Main()
-    gProf.main()
-    gProf.output.close()
+def renderDotMap(profile, label=None, imageFormat='png', dotExec=None, outputDot=None, nodeThres=0.5, edgeThres=0.1, theme=None):
+    '''
+    Render a gprof2dot profile with graphviz
+    The dot source is piped to a single dot process and the image data is
+    returned, None if dot failed. outputDot optionally saves the dot source.
+    '''
+    if dotExec is None:
+        dotExec = _getDotExecPath()
+    if theme is None:
+        theme = gprof2dot.TEMPERATURE_COLORMAP
+    profile.prune(nodeThres / 100.0, edgeThres / 100.0)
 
+    source = StringIO()
+    dot = gprof2dot.DotWriter(source)
+    dot.graphLabel = label
+    dot.graph(profile, theme)
+    source = source.getvalue()
+    if outputDot:
+        fp = open(_cleanPath(outputDot), 'wt')
+        try:
+            fp.write(source)
+        finally:
+            fp.close()
 
-def _createDotMap(dotExec, outputImagePath, gProfOutputPath):
-    ''' Use graphviz to create the dot graph '''
-    cmd = "{0} -v -Tpng \"{1}\" -o \"{2}\"".format(dotExec, gProfOutputPath, outputImagePath)
-    kwargs = {}
-    if envtools.get_os() in ('mac', 'linux', 'cygwin'):
-        kwargs['shell'] = True
+    cmd = [dotExec, "-T{0}".format(imageFormat)]
     LOG.debug("Dot Command: {0}".format(cmd))
-    p = production.processing.launch_subprocess(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    p.wait()
-    LOG.debug("Dot Command Results: {0}".format(p.communicate()))
-    LOG.info("Dot Graph available at: {0}".format(outputImagePath))
+    try:
+        p = production.processing.launch_subprocess(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except (OSError, IOError), e:
+        LOG.error("Unable to launch dot ({0}): {1}".format(dotExec, e))
+        return None
+    image, errors = p.communicate(source)
     LOG.debug("dot return code: {0}".format(p.returncode))
-    return p.returncode
+    if p.returncode:
+        LOG.error("Dot Command failed: {0}".format(errors))
+        return None
+    return image
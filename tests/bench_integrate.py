@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+"""Benchmark the derived event computations of CompactProfile against Profile.
+
+Usage: bench_integrate.py [functions] [calls]
+
+Both profiles are built from the same random call graph, the time of every
+step is printed, and the results are checked to match within 1e-9.
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from test_compact import buildProfile, maxDifference
+from gprof2dot import CompactProfile, Profile, SAMPLES, SAMPLES2, TIME_RATIO, TOTAL_TIME_RATIO
+
+
+STEPS = (
+    ('find_cycles', lambda profile: profile.find_cycles()),
+    ('ratio', lambda profile: profile.ratio(TIME_RATIO, SAMPLES)),
+    ('call_ratios', lambda profile: profile.call_ratios(SAMPLES2)),
+    ('integrate', lambda profile: profile.integrate(TOTAL_TIME_RATIO, TIME_RATIO)),
+)
+
+
+def timeSteps(profile):
+    profile.validate()
+    timings = []
+    for name, step in STEPS:
+        start = time.time()
+        step(profile)
+        timings.append(time.time() - start)
+    return timings
+
+
+def main():
+    numFunctions = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    numCalls = int(sys.argv[2]) if len(sys.argv) > 2 else numFunctions*5
+    profile = buildProfile(Profile(), numFunctions, numCalls)
+    compact = buildProfile(CompactProfile(), numFunctions, numCalls)
+    timings = timeSteps(profile)
+    compactTimings = timeSteps(compact)
+
+    print '%d functions, %d calls, %d cycles' % (numFunctions, numCalls, len(profile.cycles))
+    print '%-12s %10s %10s %8s' % ('step', 'objects', 'compact', 'speedup')
+    for (name, step), seconds, compactSeconds in zip(STEPS, timings, compactTimings):
+        print '%-12s %9.3fs %9.3fs %7.1fx' % (name, seconds, compactSeconds, seconds/max(compactSeconds, 1e-6))
+    difference = maxDifference(profile, compact)
+    print 'max abs difference %.3g' % difference
+    if difference > 1e-9:
+        sys.exit('results differ')
+
+
+if __name__ == '__main__':
+    main()
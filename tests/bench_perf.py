@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+"""Benchmark the throughput of PerfParser on perf script output.
+
+Usage: bench_perf.py [events | perf script file]
+
+Without a file, random callchains are generated. The block reader alone
+and the whole parse are timed, and the samples of a generated input are
+checked against the line by line parser.
+"""
+
+import os
+import sys
+import time
+from cStringIO import StringIO
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from test_perf import perfScript, profileSamples, referenceSamples
+from gprof2dot import PerfParser, SAMPLES
+
+
+def main():
+    argument = sys.argv[1] if len(sys.argv) > 1 else '200000'
+    if os.path.isfile(argument):
+        text = open(argument, 'rb').read()
+    else:
+        text = perfScript(int(argument), 2000)
+    megabytes = len(text)/1e6
+
+    parser = PerfParser(StringIO(text))
+    start = time.time()
+    stacks = parser.read_stacks()
+    readSeconds = time.time() - start
+
+    start = time.time()
+    profile = PerfParser(StringIO(text)).parse()
+    parseSeconds = time.time() - start
+
+    print '%.1f MB, %d samples, %d distinct stacks, %d functions' % (megabytes, profile[SAMPLES], len(stacks), len(profile.functions))
+    print '%-12s %9.3fs %8.1f MB/s' % ('read_stacks', readSeconds, megabytes/readSeconds)
+    print '%-12s %9.3fs %8.1f MB/s' % ('parse', parseSeconds, megabytes/parseSeconds)
+    if not os.path.isfile(argument):
+        start = time.time()
+        expected = referenceSamples(text)
+        referenceSeconds = time.time() - start
+        print '%-12s %9.3fs %8.1f MB/s' % ('line by line', referenceSeconds, megabytes/referenceSeconds)
+        if profileSamples(profile) != expected:
+            sys.exit('results differ')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+"""Check that cached profiles load back with all their events, and what
+invalidates the cache keys."""
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from cStringIO import StringIO
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from gprof2dot import (CollapsedParser, Event, Function, Main, Profile, ProfileCache, diff_profiles, add,
+    BYTES, DELTA_TIME_RATIO, DELTA_TOTAL_TIME_RATIO, TOTAL_BYTES, TOTAL_TIME_RATIO)
+
+
+def parseCollapsed(text):
+    parser = CollapsedParser(StringIO(text))
+    parser.keep_stacks = True
+    return parser.parse()
+
+
+def profileEvents(profile):
+    '''Every event value of a profile, by function and call name.'''
+    events = {'': profile.events}
+    for function in profile.functions.itervalues():
+        events[function.name] = function.events
+        for call in function.calls.itervalues():
+            events[function.name, profile.functions[call.callee_id].name] = call.events
+    return events
+
+
+class ProfileCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = ProfileCache(self.directory)
+        self.stderr = sys.stderr
+        sys.stderr = StringIO()
+
+    def tearDown(self):
+        sys.stderr = self.stderr
+        shutil.rmtree(self.directory)
+
+    def roundTrip(self, profile):
+        self.cache.save('key', profile)
+        self.assertEqual(sys.stderr.getvalue(), '')
+        return self.cache.load('key')
+
+    def testSampledProfile(self):
+        profile = parseCollapsed('main;a;b 3\nmain;b 1\n')
+        cached = self.roundTrip(profile)
+        self.assertEqual(profileEvents(cached), profileEvents(profile))
+        self.assertEqual(cached.stacks, profile.stacks)
+
+    def testDiffProfile(self):
+        base = parseCollapsed('main;a 3\nmain;b 1\n')
+        new = parseCollapsed('main;a 1\nmain;b 3\n')
+        profile = diff_profiles(base, new)
+        cached = self.roundTrip(profile)
+        self.assertEqual(profileEvents(cached), profileEvents(profile))
+        functions = dict((function.name, function) for function in cached.functions.itervalues())
+        self.assertEqual(functions['b'][DELTA_TIME_RATIO], 0.5)
+        self.assertEqual(functions['a'][DELTA_TOTAL_TIME_RATIO], -0.5)
+
+    def testMemoryProfile(self):
+        profile = Profile()
+        function = Function('f', 'f')
+        function[BYTES] = 10
+        function[TOTAL_BYTES] = 10
+        function[TOTAL_TIME_RATIO] = 1.0
+        profile.add_function(function)
+        profile[BYTES] = 10
+        cached = self.roundTrip(profile)
+        self.assertEqual(profileEvents(cached), profileEvents(profile))
+
+    def testUnknownEvent(self):
+        profile = parseCollapsed('main 1\n')
+        profile.functions['main'][Event('Custom', 0, add)] = 1
+        self.cache.save('key', profile)
+        self.assertTrue('could not cache' in sys.stderr.getvalue())
+        self.assertTrue(self.cache.load('key') is None)
+
+    def testKeys(self):
+        filename = os.path.join(self.directory, 'stacks.folded')
+        fp = open(filename, 'wt')
+        fp.write('main 1\n')
+        fp.close()
+        key = self.cache.key('collapsed', [filename])
+        self.assertEqual(self.cache.key('collapsed', [filename]), key)
+        self.assertNotEqual(self.cache.key('collapsed', [filename], parser_version=2), key)
+        self.assertNotEqual(self.cache.key('collapsed', [filename], stacks=True), key)
+        self.assertNotEqual(self.cache.key('perf', [filename]), key)
+        contentKey = self.cache.key('collapsed', [filename], content=True)
+        os.utime(filename, (0, 0))
+        self.assertNotEqual(self.cache.key('collapsed', [filename]), key)
+        self.assertEqual(self.cache.key('collapsed', [filename], content=True), contentKey)
+
+    def testEveryFormatHasAParserVersion(self):
+        for parser in Main.parsers.itervalues():
+            self.assertTrue(parser.version >= 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+"""Check the callgrind parser on a small file using name compression,
+relative positions and inlined file changes, against the statistics the
+original line by line parser computed for it."""
+
+import os
+import sys
+import unittest
+from cStringIO import StringIO
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from gprof2dot import CallgrindParser, CALLS, SAMPLES
+
+
+CALLGRIND = '''\
+version: 1
+creator: callgrind-3.7
+pid: 123
+cmd: ./a.out
+part: 1
+
+positions: line instr
+events: Ir Dr
+
+ob=(1) /usr/bin/app
+fl=(1) /src/main.c
+fn=(1) main
+10 0x400100 100 4
++2 * 20 1
+* +4 5
+cfl=(2) /src/util.c
+cfn=(2) compute(int, int)
+calls=1 0x400200
++1 +8 300 12
+cfn=(3) helper
+calls=2 20
+* * 40
+fi=(2)
+-1 -4 7
+# back in main.c
+fe=(1)
++3 * 3
+
+fn=(2)
+20 0x400200 250 10
+cob=(2) /lib/libm.so
+cfl=(3) /src/math.c
+cfn=(4) sqrt
+calls=5 -10
++2 +4 50 2
+jump=1 +2
+* * 1
+
+ob=(2)
+fl=(3)
+fn=(4)
+0 0x7000 50 2
+
+ob=(1)
+fl=(2)
+fn=(3)
+5 0x400300 40
+cfn=(2)
+calls=1 20
+6 0x400310 10 1
+fn=(2)
+21 * 1 0
+
+totals: 1000
+'''
+
+# Self samples, call count, and (callee, calls, samples) of every function
+EXPECTED = {
+    'main': (135.0, 0, [('compute(int, int)', 1, 300.0), ('helper', 2, 40.0)]),
+    'compute(int, int)': (252.0, 2, [('sqrt', 5, 50.0)]),
+    'helper': (40.0, 2, [('compute(int, int)', 1, 10.0)]),
+    'sqrt': (50.0, 5, []),
+}
+
+
+def parse(text):
+    parser = CallgrindParser(StringIO(text))
+    return parser, parser.parse()
+
+
+def functionStatistics(profile):
+    statistics = {}
+    for function in profile.functions.itervalues():
+        calls = sorted([(call.callee_id, call[CALLS], call[SAMPLES]) for call in function.calls.itervalues()])
+        statistics[function.name] = (function[SAMPLES], function.called, calls)
+    return statistics
+
+
+class CallgrindParserTest(unittest.TestCase):
+
+    def testMatchesLineParser(self):
+        parser, profile = parse(CALLGRIND)
+        self.assertEqual(functionStatistics(profile), EXPECTED)
+        self.assertEqual(profile[SAMPLES], 477.0)
+        modules = dict((function.name, function.module) for function in profile.functions.itervalues())
+        self.assertEqual(modules['sqrt'], 'libm.so')
+        self.assertEqual(modules['main'], 'app')
+
+    def testCarriageReturns(self):
+        parser, profile = parse(CALLGRIND.replace('\n', '\r\n'))
+        self.assertEqual(functionStatistics(profile), EXPECTED)
+
+    def testReferencesBounded(self):
+        # Repeating the cost lines does not grow the reference cache
+        lines = CALLGRIND.split('\n')
+        events = lines.index('ob=(1) /usr/bin/app')
+        totals = lines.index('totals: 1000')
+        repeat = ['ob=(1)', 'fl=(1)', 'fn=(1)'] + lines[events + 3:totals]
+        once = parse('\n'.join(lines[:totals] + repeat + lines[totals:]))[0]
+        parser, profile = parse('\n'.join(lines[:totals] + repeat*50 + lines[totals:]))
+        self.assertEqual(len(parser.position_refs), len(once.position_refs))
+        self.assertEqual(profile.functions['main'][SAMPLES], 135.0*51)
+
+    def testRedefinedId(self):
+        text = 'events: Ir\nfn=(1) first\n1 5\nfn=(1)\n1 5\nfn=(1) second\n1 2\nfn=(1)\n1 2\n'
+        parser, profile = parse(text)
+        self.assertEqual(profile.functions['first'][SAMPLES], 10.0)
+        self.assertEqual(profile.functions['second'][SAMPLES], 4.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+"""Check that CompactProfile computes the same derived events as Profile."""
+
+import os
+import random
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from gprof2dot import Call, CompactProfile, Function, Profile, SAMPLES, SAMPLES2, TIME_RATIO, TOTAL_TIME_RATIO
+
+
+def buildProfile(profile, numFunctions=200, numCalls=800, seed=0):
+    '''Fill a profile with a random call graph. Functions are grouped by
+    four, most calls go to later groups, and a few stay in their group,
+    making small cycles.'''
+    rand = random.Random(seed)
+    functions = [Function(index, 'func_%d' % index) for index in xrange(numFunctions)]
+    for function in functions:
+        function[SAMPLES] = rand.randint(0, 100)
+    for i in xrange(numCalls):
+        callerId = rand.randrange(numFunctions - 4)
+        caller = functions[callerId]
+        group = callerId - callerId % 4
+        if rand.random() < 0.1:
+            calleeId = group + rand.randrange(4)
+        else:
+            calleeId = rand.randrange(group + 4, min(numFunctions, group + 200))
+        if calleeId in caller.calls:
+            caller.calls[calleeId][SAMPLES2] += 1
+        else:
+            call = Call(calleeId)
+            call[SAMPLES2] = rand.randint(1, 50)
+            caller.add_call(call)
+    profile[SAMPLES] = sum([function[SAMPLES] for function in functions])
+    for function in functions:
+        profile.add_function(function)
+    return profile
+
+
+def integrate(profile):
+    profile.validate()
+    profile.find_cycles()
+    profile.ratio(TIME_RATIO, SAMPLES)
+    profile.call_ratios(SAMPLES2)
+    profile.integrate(TOTAL_TIME_RATIO, TIME_RATIO)
+    return profile
+
+
+def maxDifference(profile, compact):
+    '''Largest absolute difference between the ratios of two profiles.'''
+    worst = 0.0
+    for function in profile.functions.itervalues():
+        other = compact.functions[function.id]
+        worst = max(worst, abs(function[TOTAL_TIME_RATIO] - other[TOTAL_TIME_RATIO]))
+        for call in function.calls.itervalues():
+            otherCall = other.calls[call.callee_id]
+            assert (TOTAL_TIME_RATIO in call) == (TOTAL_TIME_RATIO in otherCall)
+            if TOTAL_TIME_RATIO in call:
+                worst = max(worst, abs(call[TOTAL_TIME_RATIO] - otherCall[TOTAL_TIME_RATIO]))
+            if call.ratio is not None:
+                worst = max(worst, abs(call.ratio - otherCall.ratio))
+    return worst
+
+
+class CompactProfileTest(unittest.TestCase):
+
+    def testIntegrateMatchesProfile(self):
+        for seed in xrange(5):
+            profile = integrate(buildProfile(Profile(), 400, 3000, seed))
+            compact = integrate(buildProfile(CompactProfile(), 400, 3000, seed))
+            self.assertTrue(profile.cycles)
+            self.assertEqual(len(profile.cycles), len(compact.cycles))
+            self.assertEqual(len(profile.functions), len(compact.functions))
+            self.assertTrue(maxDifference(profile, compact) < 1e-9)
+
+    def testCycleMembers(self):
+        profile = integrate(buildProfile(Profile(), 400, 3000, 1))
+        compact = integrate(buildProfile(CompactProfile(), 400, 3000, 1))
+        members = sorted([sorted([function.id for function in cycle.functions]) for cycle in profile.cycles])
+        compactMembers = sorted([sorted([function.id for function in cycle.functions]) for cycle in compact.cycles])
+        self.assertEqual(members, compactMembers)
+
+    def testRenormalize(self):
+        for seed in xrange(5):
+            profile = integrate(buildProfile(Profile(), 400, 3000, seed))
+            compact = integrate(buildProfile(CompactProfile(), 400, 3000, seed))
+            # Roots inside a cycle share the whole cycle, pick one outside
+            functions = [function for function in profile.functions.itervalues() if function.cycle is None]
+            rootId = max(functions, key=lambda function: len(function.calls)).id
+            for graph in profile, compact:
+                functionIds = graph.descendants([rootId])
+                graph.renormalize([rootId])
+                graph.keep_functions(functionIds)
+            self.assertTrue(abs(profile.functions[rootId][TOTAL_TIME_RATIO] - 1.0) < 1e-9)
+            for function in profile.functions.itervalues():
+                self.assertTrue(function[TOTAL_TIME_RATIO] <= 1.0 + 1e-9)
+                self.assertTrue(function[TIME_RATIO] <= function[TOTAL_TIME_RATIO] + 1e-9)
+            # The self time under the root adds up to the root total time
+            selfTotal = sum([function[TIME_RATIO] for function in profile.functions.itervalues()])
+            self.assertTrue(abs(selfTotal - 1.0) < 1e-6)
+            self.assertTrue(maxDifference(profile, compact) < 1e-9)
+
+    def testTopPaths(self):
+        for seed in xrange(5):
+            profile = integrate(buildProfile(Profile(), 400, 3000, seed))
+            compact = integrate(buildProfile(CompactProfile(), 400, 3000, seed))
+            paths = profile.top_paths(20)
+            self.assertEqual(len(paths), 20)
+            self.assertEqual([path for weight, path in paths], [path for weight, path in compact.top_paths(20)])
+            for weight, path in paths:
+                for callerId, calleeId in zip(path[:-1], path[1:]):
+                    self.assertTrue(calleeId in profile.functions[callerId].calls)
+
+
+if __name__ == '__main__':
+    unittest.main()
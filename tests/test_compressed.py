@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+"""Check that open_input recognizes compressed inputs by their magic bytes
+and decompresses them, through the xz and zstd commands when python lacks
+their modules."""
+
+import bz2
+import gzip
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+from cStringIO import StringIO
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from gprof2dot import DecompressedFile, ParseError, open_input
+
+
+TEXT = ''.join(['main;func_%d;leaf %d\n' % (index, index) for index in xrange(5000)])
+
+
+def gzipped(text):
+    fp = StringIO()
+    archive = gzip.GzipFile(fileobj=fp, mode='wb')
+    archive.write(text)
+    archive.close()
+    return fp.getvalue()
+
+
+def compressed(args, text):
+    '''Compress text with a command, None when it is not installed.'''
+    try:
+        process = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    except OSError:
+        return None
+    return process.communicate(text)[0]
+
+
+class OpenInputTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempDir = tempfile.mkdtemp()
+        self.modules = {}
+
+    def tearDown(self):
+        for name, module in self.modules.iteritems():
+            if module is None:
+                del sys.modules[name]
+            else:
+                sys.modules[name] = module
+        shutil.rmtree(self.tempDir)
+
+    def hideModules(self, *names):
+        ''' Make the python decompressors fail to import '''
+        for name in names:
+            self.modules[name] = sys.modules.get(name)
+            sys.modules[name] = None
+
+    def write(self, data):
+        filename = os.path.join(self.tempDir, 'input')
+        fp = open(filename, 'wb')
+        fp.write(data)
+        fp.close()
+        return filename
+
+    def read(self, data):
+        fp = open_input(self.write(data))
+        try:
+            return fp.read()
+        finally:
+            fp.close()
+
+    def readLines(self, data):
+        fp = open_input(self.write(data))
+        try:
+            return ''.join(fp)
+        finally:
+            fp.close()
+
+    def testPlainText(self):
+        fp = open_input(self.write(TEXT))
+        self.assertFalse(isinstance(fp, DecompressedFile))
+        self.assertEqual(fp.read(), TEXT)
+        fp.close()
+
+    def testGzip(self):
+        self.assertEqual(self.read(gzipped(TEXT)), TEXT)
+        self.assertEqual(self.readLines(gzipped(TEXT)), TEXT)
+
+    def testGzipMembers(self):
+        half = len(TEXT)//2
+        self.assertEqual(self.read(gzipped(TEXT[:half]) + gzipped(TEXT[half:])), TEXT)
+
+    def testGzipPadding(self):
+        self.assertEqual(self.read(gzipped(TEXT) + '\0'*1000), TEXT)
+
+    def testGzipGarbage(self):
+        self.assertRaises(ParseError, self.read, gzipped(TEXT) + 'garbage')
+        self.assertRaises(ParseError, self.read, gzipped(TEXT)[:10] + 'garbage')
+
+    def testBzip2(self):
+        half = len(TEXT)//2
+        self.assertEqual(self.readLines(bz2.compress(TEXT)), TEXT)
+        self.assertEqual(self.read(bz2.compress(TEXT[:half]) + bz2.compress(TEXT[half:])), TEXT)
+        self.assertRaises(ParseError, self.read, bz2.compress(TEXT) + 'garbage')
+
+    def testXzCommand(self):
+        data = compressed(['xz', '-c'], TEXT)
+        if data is None:
+            self.skipTest('needs xz')
+        self.hideModules('lzma', 'backports')
+        self.assertEqual(self.readLines(data), TEXT)
+        self.assertRaises(ParseError, self.read, data[:-20] + 'garbage')
+
+    def testZstdCommand(self):
+        data = compressed(['zstd', '-c'], TEXT)
+        if data is None:
+            self.skipTest('needs zstd')
+        self.hideModules('zstandard')
+        self.assertEqual(self.readLines(data), TEXT)
+        self.assertRaises(ParseError, self.read, data[:-20] + 'garbage')
+
+
+if __name__ == '__main__':
+    unittest.main()
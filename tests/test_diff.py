@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+"""Check how diff_profiles matches the functions and calls of two profiles,
+and the deltas and weights it gives them."""
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+from cStringIO import StringIO
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+GPROF2DOT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'gprof2dot.py')
+
+from gprof2dot import (CollapsedParser, Function, Profile, diff_profiles,
+    DELTA_TIME_RATIO, DELTA_TOTAL_TIME_RATIO, TIME_RATIO, TOTAL_TIME_RATIO)
+
+
+BASE = '''\
+main;a 3
+main;b 1
+main;gone 4
+'''
+
+NEW = '''\
+main;a 1
+main;b 3
+main;added 4
+'''
+
+
+def parseCollapsed(text):
+    return CollapsedParser(StringIO(text)).parse()
+
+
+def functionsByName(profile):
+    return dict((function.name, function) for function in profile.functions.itervalues())
+
+
+def moduleProfile(ratios):
+    '''Profile of callers-less functions, from (name, module, total ratio).'''
+    profile = Profile()
+    for index, (name, module, ratio) in enumerate(ratios):
+        function = Function(index, name)
+        function.module = module
+        function[TOTAL_TIME_RATIO] = ratio
+        function[TIME_RATIO] = ratio
+        profile.add_function(function)
+    return profile
+
+
+class DiffProfilesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.diff = diff_profiles(parseCollapsed(BASE), parseCollapsed(NEW))
+        self.functions = functionsByName(self.diff)
+
+    def testFunctionDeltas(self):
+        self.assertEqual(sorted(self.functions), ['a', 'added', 'b', 'gone', 'main'])
+        self.assertEqual(self.functions['main'][TOTAL_TIME_RATIO], 1.0)
+        self.assertEqual(self.functions['main'][DELTA_TOTAL_TIME_RATIO], 0.0)
+        self.assertAlmostEqual(self.functions['a'][TOTAL_TIME_RATIO], 0.125)
+        self.assertAlmostEqual(self.functions['a'][DELTA_TOTAL_TIME_RATIO], -0.25)
+        self.assertAlmostEqual(self.functions['b'][DELTA_TIME_RATIO], 0.25)
+
+    def testOneSidedFunctions(self):
+        # Functions of only one profile count as null in the other one
+        gone = self.functions['gone']
+        self.assertEqual(gone[TOTAL_TIME_RATIO], 0.0)
+        self.assertAlmostEqual(gone[DELTA_TOTAL_TIME_RATIO], -0.5)
+        added = self.functions['added']
+        self.assertAlmostEqual(added[TOTAL_TIME_RATIO], 0.5)
+        self.assertAlmostEqual(added[DELTA_TOTAL_TIME_RATIO], 0.5)
+
+    def testCallDeltas(self):
+        calls = dict((self.diff.functions[call.callee_id].name, call) for call in self.functions['main'].calls.itervalues())
+        self.assertEqual(sorted(calls), ['a', 'added', 'b', 'gone'])
+        self.assertAlmostEqual(calls['a'][DELTA_TOTAL_TIME_RATIO], -0.25)
+        self.assertEqual(calls['gone'][TOTAL_TIME_RATIO], 0.0)
+        self.assertAlmostEqual(calls['gone'][DELTA_TOTAL_TIME_RATIO], -0.5)
+        self.assertAlmostEqual(calls['added'][DELTA_TOTAL_TIME_RATIO], 0.5)
+
+    def testMatchByNameAndModule(self):
+        base = moduleProfile([('f', 'liba', 0.6), ('f', 'libb', 0.4)])
+        # Ids differ between the profiles, only name and module match
+        new = moduleProfile([('g', 'liba', 0.1), ('f', 'libb', 0.3), ('f', 'liba', 0.6)])
+        diff = diff_profiles(base, new)
+        functions = dict(((function.name, function.module), function) for function in diff.functions.itervalues())
+        self.assertEqual(sorted(functions), [('f', 'liba'), ('f', 'libb'), ('g', 'liba')])
+        self.assertAlmostEqual(functions['f', 'liba'][DELTA_TOTAL_TIME_RATIO], 0.0)
+        self.assertAlmostEqual(functions['f', 'libb'][DELTA_TOTAL_TIME_RATIO], -0.1)
+        self.assertAlmostEqual(functions['g', 'liba'][DELTA_TOTAL_TIME_RATIO], 0.1)
+
+    def testIdenticalProfiles(self):
+        diff = diff_profiles(parseCollapsed(BASE), parseCollapsed(BASE))
+        for function in diff.functions.itervalues():
+            self.assertEqual(function[DELTA_TOTAL_TIME_RATIO], 0.0)
+            self.assertEqual(function[DELTA_TIME_RATIO], 0.0)
+
+    def testPruneWeights(self):
+        self.diff.prune(0.0, 0.0)
+        # 0.5 is unchanged, 0.0 the largest speedup and 1.0 the largest regression
+        self.assertAlmostEqual(self.functions['main'].weight, 0.5)
+        self.assertAlmostEqual(self.functions['gone'].weight, 0.0)
+        self.assertAlmostEqual(self.functions['added'].weight, 1.0)
+        self.assertAlmostEqual(self.functions['a'].weight, 0.25)
+
+    def testCommandLine(self):
+        tempDir = tempfile.mkdtemp()
+        try:
+            paths = []
+            for name, text in ('base.folded', BASE), ('new.folded', NEW):
+                path = os.path.join(tempDir, name)
+                fp = open(path, 'wt')
+                fp.write(text)
+                fp.close()
+                paths.append(path)
+            output = subprocess.Popen([sys.executable, GPROF2DOT, '-f', 'collapsed', '--diff', '-n', '0', '-e', '0'] + paths,
+                                      stdout=subprocess.PIPE).communicate()[0]
+        finally:
+            shutil.rmtree(tempDir)
+        self.assertTrue(output.startswith('digraph'))
+        self.assertTrue('-50.00%' in output)
+        self.assertTrue('+50.00%' in output)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+"""Check the collapsed stack parser, and the folded and flame graph writers."""
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+from cStringIO import StringIO
+from xml.etree import ElementTree
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+GPROF2DOT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'gprof2dot.py')
+
+from gprof2dot import CollapsedParser, FlameGraphWriter, FoldedWriter, Function, ParseError, Profile, SnapshotParser, SAMPLES, SAMPLES2, TEMPERATURE_COLORMAP
+
+
+COLLAPSED = '''\
+main;load;parse 20
+main;load;read 30
+main;render 45
+main;render;draw;draw 5
+'''
+
+
+def parseCollapsed(text, keepStacks=True):
+    parser = CollapsedParser(StringIO(text))
+    parser.keep_stacks = keepStacks
+    return parser.parse()
+
+
+def folded(profile):
+    fp = StringIO()
+    FoldedWriter(fp).graph(profile, TEMPERATURE_COLORMAP)
+    return fp.getvalue()
+
+
+def flameFrames(profile):
+    '''(name, width) of the frames of a flame graph, sorted.'''
+    fp = StringIO()
+    FlameGraphWriter(fp).graph(profile, TEMPERATURE_COLORMAP)
+    svg = ElementTree.fromstring(fp.getvalue())
+    frames = []
+    for group in svg.findall('{http://www.w3.org/2000/svg}g'):
+        title = group.find('{http://www.w3.org/2000/svg}title').text
+        width = float(group.find('{http://www.w3.org/2000/svg}rect').get('width'))
+        frames.append((title.rsplit(': ', 1)[0], width))
+    return sorted(frames)
+
+
+class CollapsedParserTest(unittest.TestCase):
+
+    def testSamples(self):
+        profile = parseCollapsed(COLLAPSED, False)
+        self.assertEqual(profile[SAMPLES], 100)
+        self.assertEqual(profile.functions['main'][SAMPLES], 0)
+        self.assertEqual(profile.functions['render'][SAMPLES], 45)
+        self.assertEqual(profile.functions['draw'][SAMPLES], 5)
+        self.assertEqual(profile.functions['main'].calls['load'][SAMPLES2], 50)
+        self.assertTrue(profile.stacks is None)
+
+    def testFoldRoundTrip(self):
+        self.assertEqual(folded(parseCollapsed(COLLAPSED)), COLLAPSED)
+
+    def testBadLine(self):
+        self.assertRaises(ParseError, parseCollapsed, 'main;render\n')
+
+    def testCommandLineRoundTrip(self):
+        tempDir = tempfile.mkdtemp()
+        try:
+            collapsed = os.path.join(tempDir, 'stacks.folded')
+            output = os.path.join(tempDir, 'output.folded')
+            fp = open(collapsed, 'wt')
+            fp.write(COLLAPSED)
+            fp.close()
+            # No pruning, every stack is kept
+            subprocess.check_call([sys.executable, GPROF2DOT, '-f', 'collapsed', '--output-format', 'folded',
+                                   '-n', '0', '-e', '0', '-o', output, collapsed])
+            self.assertEqual(open(output).read(), COLLAPSED)
+        finally:
+            shutil.rmtree(tempDir)
+
+
+class FoldedWriterTest(unittest.TestCase):
+
+    def testSemicolonsEscaped(self):
+        profile = parseCollapsed('main;run 2\n')
+        profile.functions['run'].name = 'operator;run'
+        self.assertEqual(folded(profile), 'main;operator:run 2\n')
+
+    def testFilteredFramesMerge(self):
+        profile = parseCollapsed(COLLAPSED)
+        # Like pruning, the stacks going through load lose it and merge
+        del profile.functions['load']
+        del profile.functions['parse']
+        self.assertEqual(folded(profile), 'main 20\nmain;read 30\nmain;render 45\nmain;render;draw;draw 5\n')
+
+    def testDuplicateNames(self):
+        # Functions of different modules with the same name share a line
+        profile = Profile()
+        for functionId in 'a:libx', 'a:liby', 'main':
+            profile.add_function(Function(functionId, functionId.split(':')[0]))
+        profile.add_stack(('main', 'a:libx'), 3)
+        profile.add_stack(('main', 'a:liby'), 4)
+        self.assertEqual(folded(profile), 'main;a 7\n')
+
+    def testEmptyProfile(self):
+        profile = Profile()
+        profile.stacks = {}
+        self.assertEqual(folded(profile), '')
+        self.assertEqual(flameFrames(profile), [])
+
+
+class FlameGraphWriterTest(unittest.TestCase):
+
+    def testFrameWidths(self):
+        frames = flameFrames(parseCollapsed(COLLAPSED))
+        names = [name for name, width in frames]
+        self.assertEqual(names, ['all', 'draw', 'draw', 'load', 'main', 'parse', 'read', 'render'])
+        widths = dict(frames)
+        self.assertAlmostEqual(widths['all'], widths['main'])
+        self.assertAlmostEqual(widths['render'], widths['all']*0.5, 1)
+        self.assertAlmostEqual(widths['load'], widths['read'] + widths['parse'], 1)
+
+    def testEscaping(self):
+        frames = flameFrames(parseCollapsed('main;std::vector<int>::at&x 1\n'))
+        self.assertEqual([name for name, width in frames], ['all', 'main', 'std::vector<int>::at&x'])
+
+
+SNAPSHOT = '''\
+# snapshot
+fn 0 main
+fn 1 work
+fn 2 wait
+node 0 0 1
+node 1 1 7
+node 2 1 3
+node 1 2 2
+'''
+
+
+class SnapshotParserTest(unittest.TestCase):
+
+    def parse(self, keepStacks):
+        parser = SnapshotParser(StringIO(SNAPSHOT))
+        parser.keep_stacks = keepStacks
+        return parser.parse()
+
+    def testStacks(self):
+        profile = self.parse(True)
+        self.assertEqual(profile.stacks, {
+            ('main',): 1,
+            ('main', 'work'): 7,
+            ('main', 'work', 'work'): 3,
+            ('main', 'wait'): 2,
+        })
+        self.assertEqual(profile.functions['work'][SAMPLES], 10)
+        self.assertEqual(profile.functions['main'].calls['work'].ratio, 1.0)
+
+    def testStacksNotKept(self):
+        profile = self.parse(False)
+        self.assertTrue(profile.stacks is None)
+        self.assertEqual(profile[SAMPLES], 13)
+
+
+if __name__ == '__main__':
+    unittest.main()
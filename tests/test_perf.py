@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+"""Check that the block reader of PerfParser counts the same samples as the
+line by line regular expression parser it replaced."""
+
+import os
+import random
+import re
+import sys
+import unittest
+from cStringIO import StringIO
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from gprof2dot import ParseError, PerfParser, SAMPLES, SAMPLES2
+
+
+MODULES = ['/usr/lib/libfoo.so', '/usr/bin/app', '[kernel.kallsyms]', '/lib/libc-2.31.so']
+
+
+def frameLine(index):
+    module = MODULES[index % len(MODULES)]
+    if index % 37 == 0:
+        # No symbol, named after the address
+        return '\t%16x  (%s)' % (0x7f0000 + index, module)
+    if index % 11 == 0:
+        return '\t%16x std::vector<int>::push_back(int const&) (%s)' % (0x400000 + index, module)
+    return '\t%16x func_%d (%s)' % (0x400000 + index*16, index, module)
+
+
+def perfScript(numEvents=2000, numFunctions=300, seed=0, newline='\n'):
+    '''perf script output of random callchains, with comments and some
+    recursion.'''
+    rand = random.Random(seed)
+    lines = ['# ========', '# captured on: today', '# ========', '#']
+    for event in xrange(numEvents):
+        lines.append('app  %d [00%d] %d.%06d: cycles: ' % (1000 + event % 7, event % 4, 100 + event, event))
+        stack = []
+        index = rand.randrange(10)
+        for depth in xrange(rand.randrange(1, 30)):
+            stack.append(index)
+            if rand.random() < 0.1:
+                index = rand.choice(stack)
+            else:
+                index = (index*3 + rand.randrange(1, 4)) % numFunctions
+        lines.extend([frameLine(index) for index in reversed(stack)])
+        lines.append('')
+        if event % 50 == 0:
+            lines.append('# comment')
+    return newline.join(lines) + newline
+
+
+CALL_RE = re.compile(r'^\s+(?P<address>[0-9a-fA-F]+)\s+(?P<symbol>.*)\s+\((?P<module>[^)]*)\)$')
+
+
+def referenceSamples(text):
+    '''Function and call samples counted line by line with the regular
+    expression of the original parser.'''
+    functions = {}
+    calls = {}
+    callchain = None
+    for line in text.splitlines() + ['']:
+        if line.startswith('#'):
+            continue
+        if callchain is None:
+            if line:
+                callchain = []
+            continue
+        if line:
+            mo = CALL_RE.match(line)
+            callchain.append((mo.group('symbol') or mo.group('address')) + ':' + mo.group('module'))
+            continue
+        if callchain:
+            functions[callchain[0]] = functions.get(callchain[0], 0) + 1
+            for call in zip(callchain[1:], callchain):
+                calls[call] = calls.get(call, 0) + 1
+        callchain = None
+    return functions, calls
+
+
+def profileSamples(profile):
+    functions = {}
+    calls = {}
+    for function in profile.functions.itervalues():
+        if function[SAMPLES]:
+            functions[function.id] = function[SAMPLES]
+        for call in function.calls.itervalues():
+            calls[(function.id, call.callee_id)] = call[SAMPLES2]
+    return functions, calls
+
+
+def parse(text, blockSize=None, compact=False):
+    parser = PerfParser(StringIO(text), compact=compact)
+    if blockSize is not None:
+        parser.block_size = blockSize
+    return parser.parse()
+
+
+class PerfParserTest(unittest.TestCase):
+
+    def testMatchesLineParser(self):
+        for seed in xrange(3):
+            text = perfScript(seed=seed)
+            expected = referenceSamples(text)
+            self.assertEqual(profileSamples(parse(text)), expected)
+            self.assertEqual(profileSamples(parse(text, compact=True)), expected)
+
+    def testBlockBoundaries(self):
+        # Events and lines cut at every block
+        text = perfScript(200)
+        expected = referenceSamples(text)
+        for blockSize in 1, 7, 4096:
+            self.assertEqual(profileSamples(parse(text, blockSize)), expected)
+
+    def testCarriageReturns(self):
+        text = perfScript(200)
+        self.assertEqual(profileSamples(parse(perfScript(200, newline='\r\n'), 64)), referenceSamples(text))
+
+    def testModuleParenthesis(self):
+        text = (
+            'app 1 [000] 1.000001: cycles: \n'
+            '\t7f00 foo(int, char) (/opt/lib (deleted))\n'
+            '\t7f10 main (/opt/app)\n'
+            '\n'
+        )
+        functions = dict((function.name, function) for function in parse(text).functions.itervalues())
+        self.assertEqual(sorted(functions), ['foo(int, char)', 'main'])
+        self.assertEqual(functions['foo(int, char)'].module, 'lib (deleted)')
+        self.assertEqual(functions['foo(int, char)'][SAMPLES], 1)
+
+    def testUnbalancedParenthesis(self):
+        text = 'app 1 [000] 1.000001: cycles: \n\t7f00 foo /opt/lib)\n\n'
+        self.assertRaises(ParseError, parse, text)
+
+
+if __name__ == '__main__':
+    unittest.main()
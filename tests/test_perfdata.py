@@ -0,0 +1,265 @@
+#!/usr/bin/env python
+"""Check the record decoding of PerfDataParser on small perf.data files and
+ELF symbol tables built here, record by record."""
+
+import os
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+GPROF2DOT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'gprof2dot.py')
+
+from gprof2dot import ParseError, PerfDataParser, SAMPLES
+
+
+P = PerfDataParser
+
+# Loaded at ELF_BASE from the start of the file, and mapped at MAP_START
+# from MAP_OFFSET by the sampled processes
+ELF_BASE = 0x400000
+MAP_START = 0x7f0000001000
+MAP_OFFSET = 0x1000
+SYMBOLS = [('main', 0x401000, 0x100), ('work', 0x401100, 0x100), ('wait', 0x401200, 0x80)]
+
+PERF_CONTEXT_USER = (1 << 64) - 512
+PERF_RECORD_MISC_USER = 2
+
+SAMPLE_TYPE = P.PERF_SAMPLE_IP | P.PERF_SAMPLE_TID | P.PERF_SAMPLE_TIME | P.PERF_SAMPLE_PERIOD | P.PERF_SAMPLE_CALLCHAIN
+
+
+def elfFile(symbols):
+    '''64 bits little endian ELF file with a loaded segment and a symbol table.'''
+    strtab = '\0'
+    symtab = struct.pack('<IBBHQQ', 0, 0, 0, 0, 0, 0)
+    for name, address, size in symbols:
+        # Global function defined in section 1
+        symtab += struct.pack('<IBBHQQ', len(strtab), 0x12, 0, 1, address, size)
+        strtab += name + '\0'
+    symtabOffset = 64 + 56
+    strtabOffset = symtabOffset + len(symtab)
+    sectionsOffset = strtabOffset + len(strtab)
+    header = '\x7fELF\x02\x01\x01' + '\0'*9 + struct.pack('<HHIQQQIHHHHHH', 2, 62, 1, 0, 64, sectionsOffset, 0, 64, 56, 1, 64, 3, 0)
+    segment = struct.pack('<IIQQQQQQ', 1, 5, 0, ELF_BASE, ELF_BASE, 0x10000, 0x10000, 0x1000)
+    sections = struct.pack('<IIQQQQIIQQ', 0, 0, 0, 0, 0, 0, 0, 0, 0, 0)
+    sections += struct.pack('<IIQQQQIIQQ', 0, 2, 0, 0, symtabOffset, len(symtab), 2, 1, 8, 24)
+    sections += struct.pack('<IIQQQQIIQQ', 0, 3, 0, 0, strtabOffset, len(strtab), 0, 0, 1, 0)
+    return header + segment + symtab + strtab + sections
+
+
+def address(name, offset=0x10):
+    '''Address of a function in the mapping of the sampled processes.'''
+    for symbol, start, size in SYMBOLS:
+        if symbol == name:
+            return start - ELF_BASE - MAP_OFFSET + MAP_START + offset
+    raise KeyError(name)
+
+
+def padded(string):
+    string += '\0'
+    return string + '\0'*(-len(string) % 8)
+
+
+def record(recordType, misc, body):
+    return struct.pack('<IHH', recordType, misc, 8 + len(body)) + body
+
+
+def mmapRecord(pid, filename, start=MAP_START, length=0x2000, offset=MAP_OFFSET):
+    return record(P.PERF_RECORD_MMAP, PERF_RECORD_MISC_USER, struct.pack('<IIQQQ', pid, pid, start, length, offset) + padded(filename))
+
+
+def mmap2Record(pid, filename, start=MAP_START, length=0x2000, offset=MAP_OFFSET, prot=P.PROT_EXEC):
+    body = struct.pack('<IIQQQIIQQII', pid, pid, start, length, offset, 8, 1, 1234, 0, prot, 2)
+    return record(P.PERF_RECORD_MMAP2, PERF_RECORD_MISC_USER, body + padded(filename))
+
+
+def commRecord(pid, name, execed=True):
+    misc = PERF_RECORD_MISC_USER
+    if execed:
+        misc |= P.PERF_RECORD_MISC_COMM_EXEC
+    return record(P.PERF_RECORD_COMM, misc, struct.pack('<II', pid, pid) + padded(name))
+
+
+def forkRecord(pid, ppid):
+    return record(P.PERF_RECORD_FORK, 0, struct.pack('<IIIIQ', pid, ppid, pid, ppid, 0))
+
+
+def sampleRecord(pid, callchain, sampleType=SAMPLE_TYPE, readFormat=0, id=1, misc=PERF_RECORD_MISC_USER):
+    '''Sample of a callchain of addresses, innermost first, with the fields
+    of sampleType in the order of the kernel.'''
+    body = ''
+    if sampleType & P.PERF_SAMPLE_IDENTIFIER:
+        body += struct.pack('<Q', id)
+    if sampleType & P.PERF_SAMPLE_IP:
+        body += struct.pack('<Q', callchain[0])
+    if sampleType & P.PERF_SAMPLE_TID:
+        body += struct.pack('<II', pid, pid)
+    for flag, value in (P.PERF_SAMPLE_TIME, 1000), (P.PERF_SAMPLE_ADDR, 0), (P.PERF_SAMPLE_ID, id), (P.PERF_SAMPLE_STREAM_ID, id), (P.PERF_SAMPLE_CPU, 0), (P.PERF_SAMPLE_PERIOD, 4000):
+        if sampleType & flag:
+            body += struct.pack('<Q', value)
+    if sampleType & P.PERF_SAMPLE_READ:
+        assert readFormat == P.PERF_FORMAT_TOTAL_TIME_ENABLED | P.PERF_FORMAT_ID
+        body += struct.pack('<QQQ', 123, 456, id)
+    if sampleType & P.PERF_SAMPLE_CALLCHAIN:
+        ips = [PERF_CONTEXT_USER] + list(callchain)
+        body += struct.pack('<Q%dQ' % len(ips), len(ips), *ips)
+    return record(P.PERF_RECORD_SAMPLE, misc, body)
+
+
+def eventAttr(sampleType, readFormat=0):
+    return struct.pack('<IIQQQQ', 0, 64, 0, 4000, sampleType, readFormat).ljust(64, '\0')
+
+
+def perfData(records, attrs=((SAMPLE_TYPE, 0, 1),)):
+    '''perf.data file of records, with (sample type, read format, id) event
+    attributes.'''
+    data = ''.join(records)
+    attrSize = 64 + 16
+    attrsOffset = 104
+    idsOffset = attrsOffset + len(attrs)*attrSize
+    dataOffset = idsOffset + len(attrs)*8
+    header = struct.pack('<QQQQQQQQQ', P.magic, 104, attrSize, attrsOffset, len(attrs)*attrSize, dataOffset, len(data), 0, 0) + '\0'*32
+    section = ''
+    for index, (sampleType, readFormat, id) in enumerate(attrs):
+        section += eventAttr(sampleType, readFormat) + struct.pack('<QQ', idsOffset + index*8, 8)
+    ids = ''.join([struct.pack('<Q', id) for sampleType, readFormat, id in attrs])
+    return header + section + ids + data
+
+
+def pipedPerfData(records, attrs=((SAMPLE_TYPE, 0, 1),)):
+    '''perf record -o - output, where the attributes are records too.'''
+    attrRecords = [record(P.PERF_RECORD_HEADER_ATTR, 0, eventAttr(sampleType, readFormat) + struct.pack('<Q', id))
+                   for sampleType, readFormat, id in attrs]
+    return struct.pack('<QQ', P.magic, 16) + ''.join(attrRecords + list(records))
+
+
+class PerfDataParserTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempDir = tempfile.mkdtemp()
+        self.app = self.write('app', elfFile(SYMBOLS))
+
+    def tearDown(self):
+        shutil.rmtree(self.tempDir)
+
+    def write(self, name, data):
+        filename = os.path.join(self.tempDir, name)
+        fp = open(filename, 'wb')
+        fp.write(data)
+        fp.close()
+        return filename
+
+    def parse(self, data, compact=False):
+        parser = PerfDataParser(self.write('perf.data', data), compact=compact)
+        parser.keep_stacks = not compact
+        return parser.parse()
+
+    def stacks(self, data):
+        '''Sample counts by stack of function names, outermost first.'''
+        profile = self.parse(data)
+        stacks = {}
+        for stack, samples in profile.stacks.iteritems():
+            names = tuple([profile.functions[id].name for id in stack])
+            stacks[names] = stacks.get(names, 0) + samples
+        return stacks
+
+    def records(self, pid=100):
+        return [
+            commRecord(pid, 'app'),
+            mmap2Record(pid, self.app),
+            sampleRecord(pid, [address('work'), address('main')]),
+            sampleRecord(pid, [address('work', 0x20), address('main', 0x30)]),
+            sampleRecord(pid, [address('wait'), address('work'), address('main')]),
+            sampleRecord(pid, [address('main')]),
+            # Past the end of wait, and outside of the mapping
+            sampleRecord(pid, [address('wait', 0x90), address('main')]),
+            sampleRecord(pid, [MAP_START + 0x10000]),
+        ]
+
+    EXPECTED = {
+        ('main', 'work'): 2,
+        ('main', 'work', 'wait'): 1,
+        ('main',): 1,
+        ('main', '[unknown]'): 1,
+        ('[unknown]',): 1,
+    }
+
+    def testSamples(self):
+        self.assertEqual(self.stacks(perfData(self.records())), self.EXPECTED)
+        profile = self.parse(perfData(self.records()))
+        self.assertEqual(profile[SAMPLES], 6)
+        modules = set([function.module for function in profile.functions.itervalues()])
+        self.assertEqual(modules, set(['app', '[unknown]']))
+
+    def testCompact(self):
+        full = self.parse(perfData(self.records()))
+        compact = self.parse(perfData(self.records()), compact=True)
+        self.assertEqual(compact[SAMPLES], full[SAMPLES])
+        samples = dict((function.name, function[SAMPLES]) for function in full.functions.itervalues())
+        self.assertEqual(dict((function.name, function[SAMPLES]) for function in compact.functions.itervalues()), samples)
+
+    def testPiped(self):
+        self.assertEqual(self.stacks(pipedPerfData(self.records())), self.EXPECTED)
+
+    def testMmapForkAndExec(self):
+        records = [
+            mmapRecord(200, self.app),
+            forkRecord(201, 200),
+            sampleRecord(201, [address('work'), address('main')]),
+            # Data mappings are ignored
+            record(P.PERF_RECORD_MMAP, PERF_RECORD_MISC_USER | P.PERF_RECORD_MISC_MMAP_DATA,
+                   struct.pack('<IIQQQ', 201, 201, address('main'), 0x100, 0) + padded('/tmp/data')),
+            mmap2Record(201, '/tmp/data', start=address('wait'), length=0x100, prot=0),
+            sampleRecord(201, [address('wait'), address('main')]),
+            # A new image loses the mappings of the process
+            sampleRecord(200, [address('main')]),
+            commRecord(200, 'other'),
+            sampleRecord(200, [address('main')]),
+        ]
+        self.assertEqual(self.stacks(perfData(records)), {
+            ('main', 'work'): 1,
+            ('main', 'wait'): 1,
+            ('main',): 1,
+            ('[unknown]',): 1,
+        })
+
+    def testSampleIdentifiers(self):
+        # Two events with different sample formats and read values
+        other = P.PERF_SAMPLE_IDENTIFIER | P.PERF_SAMPLE_TID | P.PERF_SAMPLE_CPU | P.PERF_SAMPLE_READ | P.PERF_SAMPLE_CALLCHAIN
+        readFormat = P.PERF_FORMAT_TOTAL_TIME_ENABLED | P.PERF_FORMAT_ID
+        attrs = ((SAMPLE_TYPE | P.PERF_SAMPLE_IDENTIFIER, 0, 1), (other, readFormat, 2))
+        records = [
+            mmap2Record(100, self.app),
+            sampleRecord(100, [address('work'), address('main')], SAMPLE_TYPE | P.PERF_SAMPLE_IDENTIFIER, id=1),
+            sampleRecord(100, [address('wait'), address('main')], other, readFormat, id=2),
+        ]
+        expected = {('main', 'work'): 1, ('main', 'wait'): 1}
+        self.assertEqual(self.stacks(perfData(records, attrs)), expected)
+        self.assertEqual(self.stacks(pipedPerfData(records, attrs)), expected)
+        # Without identifiers the samples can not be told apart
+        attrs = ((SAMPLE_TYPE, 0, 1), (SAMPLE_TYPE | P.PERF_SAMPLE_CPU, 0, 2))
+        self.assertRaises(ParseError, self.parse, perfData(records[:2], attrs))
+
+    def testInvalidFiles(self):
+        self.assertRaises(ParseError, self.parse, '')
+        self.assertRaises(ParseError, self.parse, 'PERFFILE' + '\0'*100)
+        # Big endian files are not supported
+        self.assertRaises(ParseError, self.parse, struct.pack('>QQ', P.magic, 16))
+        self.assertRaises(ParseError, self.parse, perfData([struct.pack('<IHH', P.PERF_RECORD_SAMPLE, 0, 4)]))
+        self.assertRaises(ParseError, self.parse, perfData([sampleRecord(100, [address('main')])], attrs=()))
+
+    def testCommandLine(self):
+        filename = self.write('perf.data', perfData(self.records()))
+        output = subprocess.Popen([sys.executable, GPROF2DOT, '-f', 'perfdata', '-n', '0', '-e', '0', filename],
+                                  stdout=subprocess.PIPE).communicate()[0]
+        self.assertTrue(output.startswith('digraph'))
+        for name in 'main', 'work', 'wait':
+            self.assertTrue(name in output, name)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,590 @@
+#!/usr/bin/env python
+"""Check the thread, child process, sampling and memory collection of
+debug.profile, its timings and spans, and the rendering of its dot maps."""
+
+import collections
+import inspect
+import json
+import multiprocessing
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from debug import gprof2dot, profile
+import production.processing
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+def spinA():
+    return sum(xrange(20000))
+
+
+def spinB():
+    return sum(xrange(20000))
+
+
+def inThread(func):
+    thread = threading.Thread(target=func)
+    thread.start()
+    thread.join()
+
+
+def functionNames(stats):
+    return set([key[2] for key in stats.stats])
+
+
+class ThreadProfilerTest(unittest.TestCase):
+
+    def testThreadsBelongToTheirProfiler(self):
+        names = {}
+        def run(name, func):
+            names[name] = functionNames(profile.createProfileStats((inThread, (func,), {}))[1])
+        threads = [threading.Thread(target=run, args=('a', spinA)), threading.Thread(target=run, args=('b', spinB))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertTrue('spinA' in names['a'])
+        self.assertFalse('spinB' in names['a'])
+        self.assertTrue('spinB' in names['b'])
+        self.assertFalse('spinA' in names['b'])
+        self.assertEqual(threading.Thread.start.__name__, 'start')
+
+    def testThreadsIgnored(self):
+        stats = profile.createProfileStats((inThread, (spinA,), {}), threads=False)[1]
+        self.assertFalse('spinA' in functionNames(stats))
+
+
+CHILD_CODE = 'def childWork():\n    return sum(xrange(1000))\nchildWork()\n'
+
+
+def accumulated(inside, release):
+    inside.set()
+    release.wait()
+    return spinA()
+
+
+class ProfileAccumulatorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.emitted = []
+        self.accumulator = profile.ProfileAccumulator('test', lambda *args: self.emitted.append(args))
+
+    def spinCalls(self):
+        stats = self.emitted[-1][0]
+        return sum([nc for (filename, line, name), (cc, nc, tt, ct, callers) in stats.stats.iteritems() if name == 'spinA'])
+
+    def testConcurrentThreads(self):
+        # Both threads are inside the call at the same time
+        release = threading.Event()
+        events = []
+        threads = []
+        for index in xrange(2):
+            inside = threading.Event()
+            events.append(inside)
+            threads.append(threading.Thread(target=self.accumulator.call, args=(accumulated, (inside, release), {})))
+        for thread in threads:
+            thread.start()
+        for inside in events:
+            inside.wait()
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.accumulator.call(spinA, (), {})
+        self.accumulator.flush()
+        stats, key, calls, totalTime, final = self.emitted[-1]
+        self.assertEqual(calls, 3)
+        self.assertEqual(self.spinCalls(), 3)
+
+    def testFinishedThreadsKept(self):
+        for index in xrange(3):
+            inThread(lambda: self.accumulator.call(spinA, (), {}))
+            self.accumulator.flush()
+        self.assertEqual(len(self.emitted), 3)
+        self.assertEqual(self.spinCalls(), 3)
+        self.accumulator.flush()
+        self.assertEqual(len(self.emitted), 3)
+
+
+def launchChild():
+    subprocess.check_call([sys.executable, '-c', CHILD_CODE], env=profile.childEnviron())
+
+
+def launchProcessingChild():
+    production.processing.launch_subprocess([sys.executable, '-c', CHILD_CODE], env=dict(os.environ)).wait()
+
+
+def workerTask(index):
+    return sum(xrange(1000 + index))
+
+
+class ChildProfilesTest(unittest.TestCase):
+
+    def testChildEnviron(self):
+        environ = dict(os.environ)
+        stats = profile.createProfileStats((launchChild, (), {}), children=True)[1]
+        self.assertTrue('childWork' in functionNames(stats))
+        self.assertEqual(dict(os.environ), environ)
+
+    def testChildEnvironOutsideProfile(self):
+        self.assertFalse(profile.CHILD_PROFILE_ENV in profile.childEnviron())
+
+    def testLaunchSubprocess(self):
+        launch = production.processing.launch_subprocess
+        stats = profile.createProfileStats((launchProcessingChild, (), {}), children=True)[1]
+        self.assertTrue('childWork' in functionNames(stats))
+        self.assertTrue(production.processing.launch_subprocess is launch)
+
+    def testPoolReplacesWorkers(self):
+        # Every worker runs one task, the pool thread forks the next ones
+        childProfiles = profile.ChildProfiles()
+        childProfiles.start()
+        try:
+            pool = multiprocessing.Pool(1, maxtasksperchild=1)
+            pool.map(workerTask, range(3))
+            pool.close()
+            pool.join()
+            self.assertEqual(len(childProfiles.stop()), 3)
+        finally:
+            childProfiles.cleanup()
+
+
+FAKE_DOT = '''\
+#!{0}
+import sys
+if sys.argv[1:] != ['-Tpng']:
+    sys.exit('unsupported arguments: {{0}}'.format(sys.argv[1:]))
+sys.stdout.write('image:' + sys.stdin.read())
+'''
+
+
+def writeFakeDot(directory):
+    ''' Stand-in for dot, writes the dot source it reads back as the image '''
+    path = os.path.join(directory, 'dot')
+    fp = open(path, 'wt')
+    fp.write(FAKE_DOT.format(sys.executable))
+    fp.close()
+    os.chmod(path, 0755)
+    return path
+
+
+class RenderDotMapTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempDir = tempfile.mkdtemp()
+        self.dotExec = writeFakeDot(self.tempDir)
+        self.stats = profile.createProfileStats((spinA, (), {}))[1]
+
+    def tearDown(self):
+        shutil.rmtree(self.tempDir)
+
+    def testRenderDotMap(self):
+        outputDot = os.path.join(self.tempDir, 'graph.dot')
+        image = profile.renderDotMap(profile.getGraphProfile(self.stats), 'spin label', dotExec=self.dotExec, outputDot=outputDot)
+        self.assertTrue(image.startswith('image:digraph'))
+        self.assertTrue('spinA' in image)
+        self.assertTrue('spin label' in image)
+        self.assertEqual(open(outputDot).read(), image[len('image:'):])
+
+    def testDotFailure(self):
+        graph = profile.getGraphProfile(self.stats)
+        self.assertEqual(profile.renderDotMap(graph, 'label', imageFormat='svg', dotExec=self.dotExec), None)
+        missing = os.path.join(self.tempDir, 'missing')
+        self.assertEqual(profile.renderDotMap(graph, 'label', dotExec=missing), None)
+
+    def testRenderDotMapFile(self):
+        outputImage = os.path.join(self.tempDir, 'graph.png')
+        profile._renderDotMapFile(self.stats, 'label', outputImage, False, None, self.dotExec)
+        self.assertTrue(open(outputImage, 'rb').read().startswith('image:digraph'))
+        # Failed renders write nothing
+        os.remove(outputImage)
+        profile._renderDotMapFile(self.stats, 'label', outputImage, False, None, os.path.join(self.tempDir, 'missing'))
+        self.assertFalse(os.path.exists(outputImage))
+
+
+class DotMapQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.rendered = []
+        self.release = threading.Event()
+        self.renderDotMapFile = profile._renderDotMapFile
+        profile._renderDotMapFile = self.render
+
+    def tearDown(self):
+        self.release.set()
+        profile.stopDotMapQueue()
+        profile._renderDotMapFile = self.renderDotMapFile
+
+    def render(self, stats, label, *args):
+        self.release.wait()
+        if label == 'broken':
+            raise ValueError(label)
+        self.rendered.append(label)
+
+    def testBackpressure(self):
+        queue = profile.DotMapQueue(workers=1, maxSize=1)
+        queue.put(None, 'first')
+        # Wait for the worker to take the first task, the second one fills the queue
+        while queue.queue.qsize():
+            time.sleep(0.01)
+        queue.put(None, 'second')
+        thread = threading.Thread(target=queue.put, args=(None, 'third'))
+        thread.start()
+        thread.join(0.2)
+        self.assertTrue(thread.isAlive())
+        self.release.set()
+        thread.join()
+        queue.flush()
+        self.assertEqual(self.rendered, ['first', 'second', 'third'])
+        queue.stop()
+
+    def testFlushAndStop(self):
+        queue = profile.DotMapQueue(workers=2)
+        for label in 'a', 'broken', 'b', 'c':
+            queue.put(None, label)
+        self.release.set()
+        queue.flush()
+        self.assertEqual(sorted(self.rendered), ['a', 'b', 'c'])
+        # A failed render does not stop the workers
+        queue.put(None, 'd')
+        queue.stop()
+        self.assertEqual(sorted(self.rendered), ['a', 'b', 'c', 'd'])
+        self.assertEqual(queue.threads, [])
+
+    def testBackgroundDotMap(self):
+        self.release.set()
+        profile.createDotMap((spinA, (), {}), openImage=False, background=True, msg='queued')
+        profile.flushDotMaps()
+        self.assertEqual(len(self.rendered), 1)
+        self.assertTrue(self.rendered[0].endswith('queued'))
+        queue = profile.getDotMapQueue()
+        self.assertTrue(profile.getDotMapQueue() is queue)
+        profile.stopDotMapQueue()
+        self.assertFalse(profile.getDotMapQueue() is queue)
+
+
+def busy(seconds=0.1):
+    end = time.time() + seconds
+    while time.time() < end:
+        sum(xrange(1000))
+
+
+class SampledProfileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.labels = []
+        self.renderDotMapFile = profile._renderDotMapFile
+        profile._renderDotMapFile = lambda graph, label, *args: self.labels.append((graph, label))
+
+    def tearDown(self):
+        profile._renderDotMapFile = self.renderDotMapFile
+
+    def testSampleMap(self):
+        result = profile.sampleMap(interval=0.001, openImage=False)(busy)(0.1)
+        self.assertEqual(result, None)
+        graph, label = self.labels[0]
+        self.assertTrue(label.startswith('busy() |'))
+        names = [function.name.split(':')[-1] for function in graph.functions.itervalues()]
+        self.assertEqual(names, ['busy'])
+        self.assertTrue(graph[gprof2dot.SAMPLES] > 10)
+
+    def testExpression(self):
+        seconds = 0.05
+        profile.createSampledDotMap('busy(seconds)', interval=0.001, openImage=False)
+        self.assertTrue(self.labels[0][1].startswith('busy(seconds) |'))
+
+    def testUnknownKeyword(self):
+        self.assertRaises(TypeError, profile.createSampledDotMap, (busy, (0.01,), {}), openImage=False, colour='red')
+
+
+def assertWithinPrecision(test, value, expected):
+    test.assertTrue(abs(value - expected) <= expected * profile.TimingHistogram.precision, (value, expected))
+
+
+class TimingHistogramTest(unittest.TestCase):
+
+    def setUp(self):
+        # Keep the timings of this test apart from the process ones
+        self.timings = dict(profile._timings)
+        profile._timings.clear()
+
+    def tearDown(self):
+        profile._timings.clear()
+        profile._timings.update(self.timings)
+
+    def histogram(self, values, name=None):
+        histogram = profile.TimingHistogram(name)
+        for value in values:
+            histogram.record(value)
+        return histogram
+
+    def testPercentiles(self):
+        histogram = self.histogram([index / 1000.0 for index in xrange(1, 1001)])
+        self.assertEqual(histogram.count, 1000)
+        self.assertAlmostEqual(histogram.mean(), 0.5005)
+        for percent in 1, 50, 95, 99:
+            assertWithinPrecision(self, histogram.percentile(percent), percent / 100.0)
+        self.assertEqual(histogram.percentile(100), 1.0)
+        assertWithinPrecision(self, histogram.percentile(0), 0.001)
+
+    def testExtremeValues(self):
+        histogram = self.histogram([0.0, 1e-9, 3600.0])
+        self.assertEqual(histogram.min, 0.0)
+        self.assertEqual(histogram.percentile(50), profile.TimingHistogram.minValue)
+        self.assertEqual(histogram.percentile(100), 3600.0)
+        empty = profile.TimingHistogram()
+        self.assertEqual(empty.percentile(50), None)
+        self.assertEqual(empty.mean(), None)
+
+    def testMerge(self):
+        histogram = self.histogram([0.001] * 90)
+        histogram.merge(self.histogram([0.1] * 10))
+        self.assertEqual(histogram.count, 100)
+        self.assertEqual(histogram.max, 0.1)
+        assertWithinPrecision(self, histogram.percentile(90), 0.001)
+        assertWithinPrecision(self, histogram.percentile(95), 0.1)
+        coarse = profile.TimingHistogram()
+        coarse.precision = 0.1
+        self.assertRaises(ValueError, histogram.merge, coarse)
+
+    def testDictRoundTrip(self):
+        histogram = self.histogram([0.002, 0.004, 0.3])
+        copy = profile.TimingHistogram.fromDict(json.loads(json.dumps(histogram.toDict())), 'copy')
+        self.assertEqual(copy.buckets, histogram.buckets)
+        self.assertEqual((copy.count, copy.total, copy.min, copy.max), (histogram.count, histogram.total, histogram.min, histogram.max))
+        self.assertEqual(copy.percentile(50), histogram.percentile(50))
+
+    def testTimeIt(self):
+        @profile.timeIt(name='test.sleep')
+        def sleep():
+            time.sleep(0.01)
+        @profile.timeIt(name='test.items')
+        def items():
+            for index in xrange(3):
+                time.sleep(0.01)
+                yield index
+        sleep()
+        sleep()
+        self.assertEqual(list(items()), [0, 1, 2])
+        self.assertEqual(profile.getTiming('test.sleep').count, 2)
+        self.assertTrue(profile.getTiming('test.sleep').min > 0.005)
+        self.assertEqual(profile.getTiming('test.items').count, 1)
+        self.assertEqual(profile.getTiming('test.items:yield').count, 3)
+        self.assertTrue(profile.getTiming('test.items').total > profile.getTiming('test.items:yield').total)
+        report = profile.timingReport().splitlines()
+        self.assertEqual(sorted([line.split()[0] for line in report[1:]]), ['test.items', 'test.items:yield', 'test.sleep'])
+
+    def testExportAndMerge(self):
+        profile.getTiming('test.a').record(0.01)
+        profile.getTiming('test.b').record(0.02)
+        profile.getTiming('test.unused')
+        tempDir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tempDir, 'timings.json')
+            data = profile.exportTimings(path)
+            self.assertEqual(open(path).read(), data)
+            self.assertEqual(sorted(json.loads(data)), ['test.a', 'test.b'])
+            # Merged from a file, then from a string, as another process would
+            profile.resetTimings()
+            profile.mergeTimings(path)
+            profile.mergeTimings(data)
+        finally:
+            shutil.rmtree(tempDir)
+        self.assertEqual(profile.getTiming('test.a').count, 2)
+        self.assertAlmostEqual(profile.getTiming('test.b').total, 0.04)
+        self.assertEqual(profile.getTiming('test.unused').count, 0)
+
+
+@profile.traceIt()
+def traced(depth):
+    time.sleep(0.002)
+    if depth:
+        traced(depth - 1)
+
+
+@profile.traceIt(name='items')
+def tracedItems():
+    for index in xrange(3):
+        yield index
+
+
+class SpanTracerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tracer = profile.startTracing()
+
+    def tearDown(self):
+        profile.stopTracing()
+
+    def testChromeTrace(self):
+        with profile.span('outer'):
+            with profile.span('inner'):
+                time.sleep(0.01)
+            inThread(lambda: profile.span('thread').__enter__().__exit__(None, None, None))
+        self.assertTrue(profile.stopTracing() is self.tracer)
+        tempDir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tempDir, 'trace.json')
+            data = self.tracer.exportChromeTrace(path)
+            self.assertEqual(open(path).read(), data)
+        finally:
+            shutil.rmtree(tempDir)
+        trace = json.loads(data)
+        events = dict((event['name'], event) for event in trace['traceEvents'])
+        self.assertEqual(sorted(events), ['inner', 'outer', 'thread'])
+        outer, inner, thread = events['outer'], events['inner'], events['thread']
+        for event in outer, inner, thread:
+            self.assertEqual((event['ph'], event['pid']), ('X', os.getpid()))
+        self.assertTrue(inner['dur'] > 5000)
+        self.assertTrue(outer['ts'] <= inner['ts'])
+        self.assertTrue(inner['ts'] + inner['dur'] <= outer['ts'] + outer['dur'])
+        self.assertEqual(outer['tid'], inner['tid'])
+        self.assertNotEqual(outer['tid'], thread['tid'])
+
+    def testRingBuffer(self):
+        profile.stopTracing()
+        self.tracer = profile.startTracing(maxSpans=3)
+        for index in xrange(5):
+            with profile.span('span{0}'.format(index)):
+                pass
+        events = json.loads(self.tracer.exportChromeTrace())['traceEvents']
+        self.assertEqual([event['name'] for event in events], ['span2', 'span3', 'span4'])
+        # The totals still count every span
+        self.assertEqual(len(self.tracer.getTotals()), 5)
+
+    def testGetProfile(self):
+        with profile.span('main'):
+            traced(2)
+            self.assertEqual(list(tracedItems()), [0, 1, 2])
+        graph = self.tracer.getProfile()
+        functions = dict((function.name.split('.')[-1], function) for function in graph.functions.itervalues())
+        self.assertEqual(sorted(functions), ['items', 'main', 'traced'])
+        self.assertEqual(functions['traced'].called, 3)
+        # One span per item, and one for the call ending the generator
+        self.assertEqual(functions['items'].called, 4)
+        # Recursive spans are only counted once in the total time
+        self.assertTrue(functions['traced'][gprof2dot.TOTAL_TIME] <= functions['main'][gprof2dot.TOTAL_TIME])
+        self.assertAlmostEqual(functions['main'][gprof2dot.TOTAL_TIME_RATIO], 1.0)
+        self.assertAlmostEqual(sum([function[gprof2dot.TIME_RATIO] for function in graph.functions.itervalues()]), 1.0)
+        call = functions['main'].calls[functions['traced'].id]
+        self.assertEqual(call[gprof2dot.CALLS], 1)
+        self.assertEqual(functions['traced'].calls[functions['traced'].id][gprof2dot.CALLS], 2)
+
+    def testNotTracing(self):
+        profile.stopTracing()
+        self.assertEqual(profile.stopTracing(), None)
+        with profile.span('ignored'):
+            traced(0)
+        self.assertEqual(len(self.tracer.spans), 0)
+
+
+def sampleAtDepth(sampler, depth):
+    if depth:
+        return sampleAtDepth(sampler, depth - 1)
+    sampler.sample(profile._currentThreadId() + 1)
+
+
+class ContinuousProfilerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.outputDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.outputDir)
+
+    def parse(self, path):
+        parser = gprof2dot.SnapshotParser(open(path, 'rt'))
+        parser.keep_stacks = True
+        return parser.parse()
+
+    def testSnapshot(self):
+        sampler = profile.ContinuousProfiler(self.outputDir)
+        for index in xrange(3):
+            sampleAtDepth(sampler, 5)
+        sampleCount = sampler.sampleCount
+        graph = self.parse(sampler.flush())
+        self.assertEqual(graph[gprof2dot.SAMPLES], sampleCount)
+        self.assertTrue(sampleCount >= 3)
+        names = [name.split(':')[-1] for name in graph.functions]
+        self.assertEqual(names.count('sampleAtDepth'), 1)
+        self.assertEqual(sampler.sampleCount, 0)
+        self.assertEqual(sampler.flush(), None)
+
+    def testMaxNodes(self):
+        # Every sample adds deeper frames than the trie can hold
+        maxNodes = len(inspect.stack()) + 20
+        sampler = profile.ContinuousProfiler(self.outputDir, maxNodes=maxNodes)
+        for depth in xrange(10, 40, 5):
+            sampleAtDepth(sampler, depth)
+            self.assertTrue(len(sampler._nodeCodes) <= maxNodes)
+        self.assertEqual(len(sampler._nodeCodes), maxNodes)
+        sampleCount = sampler.sampleCount
+        graph = self.parse(sampler.flush())
+        self.assertEqual(graph[gprof2dot.SAMPLES], sampleCount)
+        truncated = [stack for stack in graph.stacks if stack[-1] == '[truncated]']
+        self.assertEqual(truncated, [('[truncated]',)])
+        self.assertTrue(graph.stacks[truncated[0]] >= 3)
+
+
+Frame = collections.namedtuple('Frame', 'filename lineno')
+StatisticDiff = collections.namedtuple('StatisticDiff', 'traceback size_diff count_diff')
+
+
+def allocate(count):
+    return [object() for index in xrange(count)]
+
+
+def allocateTwice():
+    return allocate(100), allocate(300)
+
+
+def frameIn(func):
+    return Frame(os.path.abspath(__file__).replace('.pyc', '.py'), func.func_code.co_firstlineno + 1)
+
+
+class MemoryProfileTest(unittest.TestCase):
+
+    def testBuildMemoryProfile(self):
+        stats = [
+            StatisticDiff([frameIn(allocate), frameIn(allocateTwice)], 1000, 10),
+            StatisticDiff([frameIn(allocate), frameIn(allocateTwice)], 3000, 30),
+            StatisticDiff([frameIn(allocateTwice)], 4000, 1),
+            StatisticDiff([frameIn(allocate)], -500, -5),
+        ]
+        graph = profile._buildMemoryProfile(stats)
+        functions = dict((function.name.split(':')[-1], function) for function in graph.functions.itervalues())
+        self.assertEqual(graph[gprof2dot.BYTES], 8000)
+        self.assertEqual(functions['allocate'][gprof2dot.BYTES], 4000)
+        self.assertEqual(functions['allocate'][gprof2dot.ALLOCS], 40)
+        self.assertEqual(functions['allocateTwice'][gprof2dot.TOTAL_BYTES], 8000)
+        self.assertEqual(functions['allocateTwice'][gprof2dot.TOTAL_TIME_RATIO], 1.0)
+        self.assertEqual(functions['allocate'][gprof2dot.TOTAL_TIME_RATIO], 0.5)
+        self.assertFalse(gprof2dot.TIME_RATIO in functions['allocate'])
+        call = functions['allocateTwice'].calls[functions['allocate'].id]
+        self.assertEqual(call[gprof2dot.TOTAL_BYTES], 4000)
+
+    @unittest.skipIf(tracemalloc is None, 'needs tracemalloc')
+    def testCreateMemoryProfile(self):
+        result, graph, peak = profile.createMemoryProfile((allocateTwice, (), {}))
+        names = [function.name.split(':')[-1] for function in graph.functions.itervalues()]
+        self.assertTrue('allocate' in names)
+        self.assertTrue(graph[gprof2dot.BYTES] > 0)
+
+    @unittest.skipIf(tracemalloc is not None, 'tracemalloc is available')
+    def testMemMapNeedsTracemalloc(self):
+        self.assertRaises(ImportError, profile.memMap)
+
+
+if __name__ == '__main__':
+    unittest.main()
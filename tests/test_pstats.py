@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+"""Check that pstats files loaded in batches and merged pairwise give the
+same statistics as loading them one after the other."""
+
+import cProfile
+import os
+import pstats
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from gprof2dot import PstatsParser, load_pstats, merge_pstats, parallel_pstats
+
+
+def fib(n):
+    if n < 2:
+        return n
+    return fib(n - 1) + fib(n - 2)
+
+
+def work(count):
+    return [fib(n % 12) for n in xrange(count)]
+
+
+class MergePstatsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempDir = tempfile.mkdtemp()
+        self.filenames = []
+        for index in xrange(7):
+            profiler = cProfile.Profile()
+            profiler.runcall(work, 10 + index*5)
+            filename = os.path.join(self.tempDir, 'run%d.prof' % index)
+            profiler.dump_stats(filename)
+            self.filenames.append(filename)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempDir)
+
+    def totals(self, stats):
+        '''Call counts and call graph of raw pstats, without the timings.'''
+        return dict([(function, (cc, nc, sorted(callers.keys()))) for function, (cc, nc, tt, ct, callers) in stats.iteritems()])
+
+    def testMergeMatchesSequential(self):
+        expected = pstats.Stats(*self.filenames).stats
+        dicts = [load_pstats([filename]) for filename in self.filenames]
+        # Merge pairwise, like parallel_pstats does
+        while len(dicts) > 1:
+            merged = [merge_pstats(dicts[i:i + 2]) for i in xrange(0, len(dicts) - 1, 2)]
+            if len(dicts) % 2:
+                merged.append(dicts[-1])
+            dicts = merged
+        self.assertEqual(self.totals(dicts[0]), self.totals(expected))
+
+    def testParallelMatchesSequential(self):
+        expected = pstats.Stats(*self.filenames).stats
+        stats = parallel_pstats(self.filenames, 3)
+        self.assertEqual(self.totals(stats.stats), self.totals(expected))
+
+    def testParserJobs(self):
+        profile = PstatsParser(*self.filenames, jobs=2).parse()
+        sequential = PstatsParser(*self.filenames).parse()
+        self.assertEqual(sorted(profile.functions.keys()), sorted(sequential.functions.keys()))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+"""Check that perf and xperf files parsed in shards by several jobs give the
+same profile as a single job."""
+
+import gzip
+import os
+import random
+import shutil
+import sys
+import tempfile
+import unittest
+from cStringIO import StringIO
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from test_perf import perfScript, profileSamples
+from gprof2dot import PerfParser, XPerfParser, open_input, split_shards, SAMPLES
+
+
+def xperfCsv(numRows=3000, seed=0):
+    '''XPerf sampled stacks, with rows lacking a stack.'''
+    rand = random.Random(seed)
+    modules = ['app.exe', 'ntdll.dll', 'kernel32.dll']
+    functions = ['%s!f%d' % (modules[index % 3], index) for index in xrange(100)]
+    lines = ['Process Name, Module, Function, Weight, Count, Stack']
+    for row in xrange(numRows):
+        stack = [rand.choice(functions) for depth in xrange(rand.randint(1, 10))]
+        module, function = stack[-1].split('!')
+        if row % 20 == 0:
+            stackColumn = '?'
+        else:
+            stackColumn = '[Root]/' + '/'.join(stack)
+        process = rand.choice(['app.exe (1234)', 'svc.exe (88)'])
+        lines.append('%s, %s, %s, %d, %d, %s' % (process, module, function, rand.choice([1, 2]), rand.randint(1, 3), stackColumn))
+    return '\r\n'.join(lines) + '\r\n'
+
+
+class ShardTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempDir)
+
+    def write(self, name, data):
+        filename = os.path.join(self.tempDir, name)
+        fp = open(filename, 'wb')
+        fp.write(data)
+        fp.close()
+        return filename
+
+    def testSplitShards(self):
+        filename = self.write('perf.txt', perfScript(500))
+        shards = split_shards(filename, 4, r'\n\r?\n')
+        self.assertEqual(len(shards), 4)
+        self.assertEqual(shards[0][1], 0)
+        self.assertEqual(shards[-1][2], os.path.getsize(filename))
+        data = open(filename, 'rb').read()
+        for filename, start, end in shards[1:]:
+            self.assertEqual(data[start - 2:start], '\n\n')
+
+    def testPerf(self):
+        filename = self.write('perf.txt', perfScript(3000))
+        expected = profileSamples(PerfParser(open(filename, 'rt')).parse())
+        for jobs in 2, 3:
+            self.assertEqual(profileSamples(PerfParser(open(filename, 'rt'), jobs=jobs).parse()), expected)
+        self.assertEqual(profileSamples(PerfParser(open(filename, 'rt'), compact=True, jobs=3).parse()), expected)
+
+    def testXPerf(self):
+        filename = self.write('xperf.csv', xperfCsv())
+        expected = profileSamples(XPerfParser(open(filename, 'rt')).parse())
+        for jobs in 2, 3:
+            profile = XPerfParser(open(filename, 'rt'), jobs=jobs).parse()
+            self.assertEqual(profileSamples(profile), expected)
+            self.assertEqual(profile[SAMPLES], sum(expected[0].values()))
+
+    def testCompressedWarning(self):
+        text = perfScript(200)
+        fp = StringIO()
+        archive = gzip.GzipFile(fileobj=fp, mode='wb')
+        archive.write(text)
+        archive.close()
+        filename = self.write('perf.txt.gz', fp.getvalue())
+        stderr = sys.stderr
+        sys.stderr = StringIO()
+        try:
+            profile = PerfParser(open_input(filename), jobs=2).parse()
+            warning = sys.stderr.getvalue()
+        finally:
+            sys.stderr = stderr
+        self.assertTrue('single job' in warning)
+        self.assertEqual(profileSamples(profile), profileSamples(PerfParser(StringIO(text)).parse()))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+"""Check the iterparse based sysprof and AQtime parsers on small captures,
+whatever the order of their elements."""
+
+import os
+import sys
+import unittest
+from cStringIO import StringIO
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from gprof2dot import AQtimeParser, ParseError, SysprofParser, SAMPLES, SAMPLES2, TIME, TIME_RATIO, TOTAL_TIME, TOTAL_TIME_RATIO
+
+
+def sysprofObject(id, name, samples):
+    return '<object id="%d"><name>"%s"</name><total>%d</total><self>%d</self></object>' % (id, name, samples, samples)
+
+
+def sysprofNode(id, object, parent, samples):
+    return '<node id="%d"><object>%d</object><parent>%d</parent><self>%d</self><total>%d</total></node>' % (id, object, parent, samples, samples)
+
+
+# Objects without samples are processes or modules, their nodes are skipped
+SYSPROF_OBJECTS = [
+    sysprofObject(1, '[Everything]', 0),
+    sysprofObject(2, 'main', 5),
+    sysprofObject(3, 'libfoo.so', 0),
+    sysprofObject(4, 'work', 10),
+    sysprofObject(5, 'helper &amp; co', 3),
+]
+
+SYSPROF_NODES = [
+    sysprofNode(1, 1, 0, 0),
+    sysprofNode(2, 2, 1, 5),
+    sysprofNode(3, 3, 2, 0),
+    sysprofNode(4, 4, 3, 10),
+    sysprofNode(5, 5, 4, 2),
+    sysprofNode(6, 5, 2, 1),
+]
+
+
+def sysprofCapture(objects=SYSPROF_OBJECTS, nodes=SYSPROF_NODES, nodesFirst=False):
+    sections = ['<objects>%s</objects>' % '\n'.join(objects), '<nodes>%s</nodes>' % '\n'.join(nodes)]
+    if nodesFirst:
+        sections.reverse()
+    return '<?xml version="1.0"?>\n<profile><size>%d</size>\n%s\n</profile>\n' % (len(nodes), '\n'.join(sections))
+
+
+class SysprofParserTest(unittest.TestCase):
+
+    def parse(self, text):
+        return SysprofParser(StringIO(text)).parse()
+
+    def checkProfile(self, profile):
+        self.assertEqual(sorted(profile.functions), [2, 4, 5])
+        self.assertEqual(profile[SAMPLES], 18)
+        main, work, helper = profile.functions[2], profile.functions[4], profile.functions[5]
+        self.assertEqual(main.name, 'main')
+        self.assertEqual(helper.name, 'helper & co')
+        self.assertEqual((main[SAMPLES], work[SAMPLES], helper[SAMPLES]), (5, 10, 3))
+        # The call of work goes through the skipped module node
+        self.assertEqual(sorted(main.calls), [4, 5])
+        self.assertEqual(main.calls[4][SAMPLES2], 10)
+        self.assertEqual(main.calls[5][SAMPLES2], 1)
+        self.assertEqual(work.calls[5][SAMPLES2], 2)
+        self.assertAlmostEqual(work[TIME_RATIO], 10/18.0)
+        self.assertAlmostEqual(main[TOTAL_TIME_RATIO], 1.0)
+
+    def testCapture(self):
+        self.checkProfile(self.parse(sysprofCapture()))
+
+    def testNodesBeforeObjects(self):
+        self.checkProfile(self.parse(sysprofCapture(nodesFirst=True)))
+
+    def testChildrenBeforeParents(self):
+        self.checkProfile(self.parse(sysprofCapture(nodes=list(reversed(SYSPROF_NODES)))))
+        self.checkProfile(self.parse(sysprofCapture(nodes=list(reversed(SYSPROF_NODES)), nodesFirst=True)))
+
+    def testInvalidCaptures(self):
+        self.assertRaises(ParseError, self.parse, '<?xml version="1.0"?>\n<trace></trace>\n')
+        self.assertRaises(ParseError, self.parse, '<profile><nodes>%s</nodes></profile>' % SYSPROF_NODES[0])
+        self.assertRaises(ParseError, self.parse, sysprofCapture(nodes=SYSPROF_NODES + [sysprofNode(7, 4, 42, 1)]))
+
+
+FIELDS = [('String', 'Routine Name'), ('String', 'Module Name'), ('String', 'Unit Name'),
+          ('Float', 'Time'), ('Float', 'Time with Children'), ('Integer', 'Hit Count'), ('Address', 'Address')]
+
+
+def aqtimeHeader(name, id, fields):
+    return '<TABLE_HEADER NAME="%s" ID="%d">%s</TABLE_HEADER>' % (
+        name, id, ''.join(['<TABLE_FIELD TYPE="%s">%s</TABLE_FIELD>' % field for field in fields]))
+
+
+def aqtimeRow(fields, values, children=''):
+    '''Row of a table, values given by field name.'''
+    cells = ['<FIELD ID="%d">%s</FIELD>' % (index, values[name]) for index, (type, name) in enumerate(fields)]
+    return '<ROW>%s%s</ROW>\n' % (''.join(cells), children)
+
+
+def routine(name, time, totalTime):
+    return dict([('Routine Name', name), ('Module Name', 'app.exe'), ('Unit Name', 'main.cpp'),
+                 ('Time', time), ('Time with Children', totalTime), ('Hit Count', 1), ('Address', 4096)])
+
+
+def aqtimeResults():
+    # The children table lists its fields in another order
+    childFields = list(reversed(FIELDS))
+    headers = aqtimeHeader('Routines', 0, FIELDS) + aqtimeHeader('Children', 1, childFields) + aqtimeHeader('Parents', 2, FIELDS)
+
+    def row(name, time, totalTime, children=(), parents=()):
+        tables = '<CHILDREN><DATA TABLE_ID="1">%s</DATA><DATA TABLE_ID="2">%s</DATA></CHILDREN>' % (
+            ''.join([aqtimeRow(childFields, routine(*child)) for child in children]),
+            ''.join([aqtimeRow(FIELDS, routine(*parent)) for parent in parents]))
+        return aqtimeRow(FIELDS, routine(name, time, totalTime), tables)
+
+    rows = [
+        row('main', '1.0', '4.0', children=[('work', '2.0', '3.0')]),
+        row('work', '2.0', '3.0', children=[('helper&amp;co', '1.0', '1.0')], parents=[('main', '1.0', '4.0')]),
+        row('helper&amp;co', '1.0', '1.0', parents=[('work', '2.0', '3.0')]),
+    ]
+    return '<?xml version="1.0"?>\n<AQtime_Results><HEADERS>%s</HEADERS><RESULTS><DATA TABLE_ID="0">%s</DATA></RESULTS></AQtime_Results>\n' % (
+        headers, ''.join(rows))
+
+
+class AQtimeParserTest(unittest.TestCase):
+
+    def parse(self, text):
+        return AQtimeParser(StringIO(text)).parse()
+
+    def testResults(self):
+        profile = self.parse(aqtimeResults())
+        self.assertEqual(sorted(profile.functions), ['app.exe:main.cpp:helper&co', 'app.exe:main.cpp:main', 'app.exe:main.cpp:work'])
+        main = profile.functions['app.exe:main.cpp:main']
+        work = profile.functions['app.exe:main.cpp:work']
+        helper = profile.functions['app.exe:main.cpp:helper&co']
+        self.assertEqual(helper.name, 'helper&co')
+        self.assertEqual(profile[TIME], 4.0)
+        self.assertEqual((work[TIME], work[TOTAL_TIME]), (2.0, 3.0))
+        self.assertAlmostEqual(work[TOTAL_TIME_RATIO], 0.75)
+        self.assertAlmostEqual(main[TOTAL_TIME_RATIO], 1.0)
+        # Only the children rows are calls, the parents ones are not
+        self.assertEqual(main.calls.keys(), [work.id])
+        self.assertEqual(work.calls.keys(), [helper.id])
+        self.assertEqual(helper.calls, {})
+        call = main.calls[work.id]
+        self.assertEqual((call[TIME], call[TOTAL_TIME]), (2.0, 3.0))
+
+    def testNotAQtime(self):
+        self.assertRaises(ParseError, self.parse, '<?xml version="1.0"?>\n<profile></profile>\n')
+
+
+if __name__ == '__main__':
+    unittest.main()